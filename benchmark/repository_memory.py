@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+repository_memory.py: Reports the memory cost per resource of a repository
+implementation after bootstrapping a source.
+
+Usage (from the repository root, one implementation per process so that the
+resident set sizes don't interfere):
+
+    python benchmark/repository_memory.py --repository DictRepository -n 1000000
+    python benchmark/repository_memory.py --repository ArrayRepository -n 1000000
+
+"""
+
+import os
+import sys
+import time
+import resource
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import simulator.repository
+from simulator.source import Source
+
+
+def max_rss_bytes():
+    """Peak resident set size of this process (Linux reports KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    parser = optparse.OptionParser(description="Repository memory report")
+    parser.add_option('--repository', default='DictRepository',
+                      help="the repository class to measure")
+    parser.add_option('--resources', '-n', type=int, default=1000000,
+                      help="the number of resources to bootstrap")
+    parser.add_option('--payload', type=int, default=100,
+                      help="the average payload size in bytes")
+    (args, clargs) = parser.parse_args()
+
+    config = {
+        'name': "ResourceSync Simulator",
+        'number_of_resources': args.resources,
+        'change_delay': 0,
+        'event_types': ['create', 'update', 'delete'],
+        'average_payload': args.payload,
+        'max_events': 0,
+        'stats_interval': 10,
+    }
+    source = Source(config, "http://localhost:8888", 8888)
+    repository_klass = getattr(simulator.repository, args.repository)
+    repository = repository_klass(source, {'class': args.repository})
+    source.add_repository(repository)
+
+    rss_before = max_rss_bytes()
+    then = time.time()
+    source.bootstrap()
+    elapsed = time.time() - then
+    rss_after = max_rss_bytes()
+
+    print("repository:          %s" % args.repository)
+    print("resources:           %d" % source.resource_count)
+    print("bootstrap time:      %.2fs" % elapsed)
+    print("reported size:       %d bytes" % repository.size_in_bytes)
+    print("reported per res.:   %d bytes" % repository.bytes_per_resource)
+    print("peak RSS growth:     %d bytes" % (rss_after - rss_before))
+    print("RSS per resource:    %d bytes" % (
+          (rss_after - rss_before) / max(source.resource_count, 1)))
+
+if __name__ == '__main__':
+    main()
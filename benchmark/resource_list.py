@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+resource_list.py: Measures the latency of building and serializing the
+resource list of a bootstrapped source.
+
+Usage (from the repository root):
+
+    python benchmark/resource_list.py --resources 100000 --repeat 3
+
+"""
+
+import os
+import sys
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from simulator.source import Source, DynamicResourceListBuilder
+
+
+def main():
+    parser = optparse.OptionParser(description="Resource list benchmark")
+    parser.add_option('--resources', '-n', type=int, default=100000,
+                      help="the number of resources to bootstrap")
+    parser.add_option('--payload', type=int, default=1000,
+                      help="the average payload size in bytes")
+    parser.add_option('--repeat', '-r', type=int, default=3,
+                      help="the number of timed resource list requests")
+    (args, clargs) = parser.parse_args()
+
+    config = {
+        'name': "ResourceSync Simulator",
+        'number_of_resources': args.resources,
+        'change_delay': 0,
+        'event_types': ['create', 'update', 'delete'],
+        'average_payload': args.payload,
+        'max_events': 0,
+        'stats_interval': 10,
+    }
+    source = Source(config, "http://localhost:8888", 8888)
+    builder = DynamicResourceListBuilder(source,
+                                         {'class': 'DynamicResourceListBuilder',
+                                          'uri_path': 'resourcelist.xml'})
+    source.add_resource_list_builder(builder)
+    then = time.time()
+    source.bootstrap()
+    print("bootstrap: %d resources in %.3fs" % (source.resource_count,
+          time.time() - then))
+
+    for i in range(args.repeat):
+        then = time.time()
+        resource_list = builder.generate()
+        resource_list.max_sitemap_entries = None  # single document
+        resource_list.describedby = source.describedby_uri
+        resource_list.up = source.capability_list_uri
+        xml = resource_list.as_xml()
+        print("resource list #%d: %d bytes in %.3fs" % (i + 1, len(xml),
+              time.time() - then))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+suite.py: Times the simulator's hot paths at several source sizes and writes
+the results as JSON, so that versions can be compared.
+
+For each number of resources, a source with a change memory, a resource
+list builder and dump builders is bootstrapped. Then the suite times
+resource lookups and payloads, the simulation loop (one event at a time
+and in batches), change memory notification and change list generation,
+and complete HTTP responses of each handler. The HTTP interface runs on
+a local port with its response cache disabled, so every request
+generates its document.
+
+Each benchmark is repeated up to --repeat times or for about --seconds
+seconds, whichever comes first, and at least once. Usage (from the
+repository root):
+
+    python benchmark/suite.py -n 10000,100000,1000000 -o results.json
+    python benchmark/suite.py -n 100000 -o new.json --compare results.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import optparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tornado.netutil
+import tornado.httpclient
+
+import simulator.repository
+import simulator.changememory
+from simulator.source import Source, DynamicResourceListBuilder
+from simulator.resource import Resource
+from simulator.dump import ResourceDumpBuilder, ChangeDumpBuilder
+from simulator.http import HTTPInterface, ResponseCache
+from simulator.serializer import sitemap_xml
+
+
+class Suite(object):
+    """Runs the benchmarks for one number of resources and collects the
+    results"""
+
+    def __init__(self, args, resources):
+        self.args = args
+        self.resources = resources
+        self.results = []
+
+    def measure(self, name, function, operations=1, repeat=None):
+        """Times function(), which performs operations operations and may
+        return the number of bytes it produced"""
+        times = []
+        size = None
+        repeat = repeat or self.args.repeat
+        deadline = time.time() + self.args.seconds
+        while len(times) < repeat and \
+                (len(times) == 0 or time.time() < deadline):
+            then = time.time()
+            size = function()
+            times.append(time.time() - then)
+        result = {'name': name,
+                  'resources': self.resources,
+                  'runs': len(times),
+                  'operations': operations,
+                  'min_seconds': min(times),
+                  'mean_seconds': sum(times) / len(times),
+                  'operations_per_second': (operations / min(times)
+                                            if min(times) > 0 else None)}
+        if isinstance(size, (int, long)):
+            result['bytes'] = size
+        self.results.append(result)
+        print("%8d %-28s %10.6fs %12s ops/s  (%d runs)" % (
+              self.resources, name, result['min_seconds'],
+              "%.2f" % result['operations_per_second']
+              if result['operations_per_second'] else "-", len(times)))
+        return result
+
+    def make_source(self, max_events):
+        config = {
+            'name': "ResourceSync Simulator",
+            'number_of_resources': self.resources,
+            'change_delay': 0,
+            'event_types': ['create', 'update', 'delete'],
+            'average_payload': self.args.payload,
+            'max_events': max_events,
+            'stats_interval': 10 ** 9,
+            'seed': self.args.seed,
+        }
+        source = Source(config, "http://localhost:8888", 8888)
+        klass = getattr(simulator.repository, self.args.repository)
+        source.add_repository(klass(source, {'class': self.args.repository}))
+        return source
+
+    def make_changememory(self, source):
+        klass = getattr(simulator.changememory, self.args.changememory)
+        return klass(source, {'class': self.args.changememory,
+                              'uri_path': "changelist.xml",
+                              'max_changes': self.args.events})
+
+    def run(self):
+        source = self.make_source(0)
+        source.add_resource_list_builder(DynamicResourceListBuilder(
+            source, {'class': 'DynamicResourceListBuilder',
+                     'uri_path': "resourcelist.xml",
+                     'streaming': True}))  # more than 50000 entries
+        source.add_changememory(self.make_changememory(source))
+        source.add_resource_dump_builder(ResourceDumpBuilder(
+            source, {'uri_path': "resourcedump.xml"}))
+        source.add_change_dump_builder(ChangeDumpBuilder(
+            source, {'uri_path': "changedump.xml",
+                     'max_cached_packages': 0}))
+        self.measure('bootstrap', source.bootstrap, self.resources,
+                     repeat=1)
+
+        basenames = source._repository.random_keys(self.args.lookups)
+        self.measure('resource', lambda: [source.resource(basename)
+                                          for basename in basenames],
+                     len(basenames))
+        self.measure('resource_payload',
+                     lambda: [source.resource_payload(basename)
+                              for basename in basenames[:1000]],
+                     len(basenames[:1000]))
+
+        self.measure('simulate_events', lambda: self.simulate(source, None),
+                     self.args.events // 10)
+        self.measure('simulate_batches', lambda: self.simulate(source, 'max'),
+                     self.args.events)
+
+        changes = [Resource(resource=resource, change="updated")
+                   for resource in source.random_resources(self.args.lookups)]
+        notified = self.make_changememory(self.make_source(0))
+        self.measure('changelist_notify',
+                     lambda: [notified.notify(change) for change in changes],
+                     len(changes))
+        changememory = source.changememory
+        self.measure('changelist_generate',
+                     lambda: len(sitemap_xml(changememory.generate())),
+                     len(changememory.changes))
+        self.measure_http(source, source.random_resources()[0].basename)
+        return self.results
+
+    def simulate(self, source, rate):
+        """Simulates events_per_second (rate) events; one at a time if rate
+        is None"""
+        source.config['events_per_second'] = rate
+        source.config['max_events'] = source.no_events + (
+            self.args.events if rate is not None else self.args.events // 10)
+        source.simulate_changes()
+
+    def measure_http(self, source, basename):
+        """Times complete responses of each handler"""
+        http_interface = HTTPInterface(source)
+        http_interface.settings['response_cache'] = ResponseCache(
+            max_entries=0)
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1',
+                                               family=socket.AF_INET)
+        port = sockets[0].getsockname()[1]
+        thread = threading.Thread(target=http_interface.serve,
+                                  kwargs={'sockets': sockets})
+        thread.daemon = True
+        thread.start()
+        client = tornado.httpclient.HTTPClient(max_body_size=2 ** 40)
+        change_dump = source.change_dump_builder
+        paths = [('http_home', "/"),
+                 ('http_source_description', "/.well-known/resourcesync"),
+                 ('http_capability_list', "/capabilitylist.xml"),
+                 ('http_resources', "/resources"),
+                 ('http_resource', "/resources/%s" % basename),
+                 ('http_resource_list', "/resourcelist.xml"),
+                 ('http_change_list', "/changelist.xml"),
+                 ('http_resource_dump', "/resourcedump.xml"),
+                 ('http_resource_dump_package',
+                  "/" + source.resource_dump_builder.package_path(1)),
+                 ('http_change_dump', "/changedump.xml")]
+        # with fewer events than package_size there is no complete package
+        if change_dump.first_package <= change_dump.package_count:
+            paths.append(('http_change_dump_package', "/" +
+                          change_dump.package_path(change_dump.first_package)))
+        else:
+            print("%8d %-28s skipped (no complete package)" % (
+                self.resources, 'http_change_dump_package'))
+        try:
+            for (name, path) in paths:
+                url = "http://127.0.0.1:%d%s" % (port, path)
+                self.measure(name, lambda: self.fetch(client, url))
+        finally:
+            client.close()
+            http_interface.stop()
+            thread.join()
+
+    def fetch(self, client, url):
+        """Fetches a URL and returns the body length without keeping the
+        body"""
+        received = [0]
+
+        def count(chunk):
+            received[0] += len(chunk)
+        client.fetch(url, streaming_callback=count, request_timeout=3600,
+                     decompress_response=False)
+        return received[0]
+
+
+def environment():
+    """Describes the benchmarked version and platform"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time()}
+
+
+def compare(results, baseline):
+    """Prints the ratio of the minimum times to those of a baseline"""
+    previous = dict(((result['name'], result['resources']), result)
+                    for result in baseline['results'])
+    print("\n%8s %-28s %10s %10s %8s" % ("n", "benchmark", "baseline",
+                                         "current", "ratio"))
+    for result in results:
+        old = previous.get((result['name'], result['resources']))
+        if old is None or old['min_seconds'] == 0:
+            continue
+        ratio = result['min_seconds'] / old['min_seconds']
+        print("%8d %-28s %9.4fs %9.4fs %7.2fx%s" % (
+              result['resources'], result['name'], old['min_seconds'],
+              result['min_seconds'], ratio, " slower" if ratio > 1.1 else ""))
+
+
+def main():
+    parser = optparse.OptionParser(description="Simulator benchmark suite")
+    parser.add_option('--resources', '-n', default="10000,100000,1000000",
+                      help="comma-separated numbers of resources")
+    parser.add_option('--repository', default='DictRepository',
+                      help="the repository class to benchmark")
+    parser.add_option('--changememory', default='DynamicChangeList',
+                      help="the change memory class to benchmark")
+    parser.add_option('--payload', type=int, default=1000,
+                      help="the average payload size in bytes")
+    parser.add_option('--events', type=int, default=10000,
+                      help="the number of events per simulation run")
+    parser.add_option('--lookups', type=int, default=10000,
+                      help="the number of resources looked up per run")
+    parser.add_option('--repeat', '-r', type=int, default=5,
+                      help="the maximum number of runs per benchmark")
+    parser.add_option('--seconds', type=float, default=2.0,
+                      help="the time after which no more runs are started")
+    parser.add_option('--seed', type=int, default=42,
+                      help="the seed of the simulation")
+    parser.add_option('--output', '-o', default=None,
+                      help="the JSON file to write the results to")
+    parser.add_option('--compare', '-c', default=None,
+                      help="a JSON results file to compare with")
+    (args, clargs) = parser.parse_args()
+
+    results = []
+    for resources in [int(number) for number in args.resources.split(',')]:
+        random.seed(args.seed)
+        results.extend(Suite(args, resources).run())
+    report = {'environment': environment(),
+              'options': vars(args),
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ setup(
     version='0.7',
     packages=['simulator'],
     package_data={'simulator': ['static/*','templates/*']},
-    scripts=['resync-simulator'],
+    scripts=['resync-simulator', 'resync-loadgen'],
     classifiers=["Development Status :: 4 - Beta",
                  "Intended Audience :: Developers",
                  "Operating System :: OS Independent", #is this true? know Linux & OS X ok
@@ -22,8 +22,8 @@ setup(
     long_description=open('README').read(),
     url='http://github.com/resync/simulator',
     install_requires=[
-        "resync>=0.9.3",
-        "tornado>=2.2.1"
+        "resync>=0.9.4",
+        "tornado>=4.0"
     ],
     test_suite="simulator.test",
 )
@@ -6,11 +6,20 @@ changememory.py: A record of change events
 Created by Bernhard Haslhofer on 2012-04-27.
 
 """
+import os
+import re
+import time
+import mmap
+import struct
 import logging
+import threading
 
 from resync.change_list import ChangeList
+from resync.archives import ChangeListArchive
 
 from simulator.observer import Observer
+from simulator.resource import Resource
+from simulator.serializer import sitemap_xml
 
 
 class ChangeMemory(Observer):
@@ -27,6 +36,12 @@ class ChangeMemory(Observer):
         self.uri_path = config['uri_path']
         self.max_changes = config['max_changes']
         self.changes = []  # stores change events; sorted by event id
+        self.last_changeid = 0  # the id of the most recent change event
+        # all changes up to this time have been received
+        self._delivered_until = time.time()
+        self.archive = None
+        if config.get('archive_page_size'):
+            self.archive = ChangeListArchiver(self, config['archive_page_size'])
         source.register_observer(self)
         self.logger = logging.getLogger('changememory')
         self.logger.info("Changememory config: %s " % self.config)
@@ -41,8 +56,152 @@ class ChangeMemory(Observer):
         return len(self.changes)
 
     def notify(self, change):
-        """General procdures for incoming changes. Should be overridden."""
+        """General procdures for incoming changes. Should be overridden.
+
+        Assigns monotonically increasing change ids to incoming changes."""
+        self.last_changeid += 1
+        change.changeid = self.last_changeid
         self.logger.info("Event: %s" % repr(change))
+        if self.archive is not None:
+            self.archive.add(change)
+
+    @property
+    def delivered_until(self):
+        """The time up to which all changes have been received. Changes are
+        timestamped when they are simulated but may be delivered later
+        (at the end of a batch, or by the dispatcher), so it is the
+        timestamp of the latest change received, not the current time;
+        md_until values from it never skip undelivered changes"""
+        return self._delivered_until
+
+    def _delivered(self, changes):
+        """Advances delivered_until; called once changes are stored, so
+        that lists generated up to it include them"""
+        for change in changes:
+            if change.timestamp > self._delivered_until:
+                self._delivered_until = change.timestamp
+
+
+def in_window(change, from_timestamp=None, until_timestamp=None):
+    """True if a change happened at or after from_timestamp and before
+    until_timestamp"""
+    if from_timestamp is not None and change.timestamp < from_timestamp:
+        return False
+    if until_timestamp is not None and change.timestamp >= until_timestamp:
+        return False
+    return True
+
+
+class ChangeListArchiver(object):
+    """Collects the changes of a change memory into closed change list
+    pages of page_size changes each, independently of how many changes
+    the memory itself keeps.
+
+    Closed pages never change. Their changes are kept as compact records
+    until a page is first requested; after that only its XML is kept.
+    """
+
+    def __init__(self, changememory, page_size):
+        self.changememory = changememory
+        self.page_size = page_size
+        self._open_page = []  # records of the page being filled
+        self._pages = []  # closed pages: list of records or XML string
+        self._page_windows = []  # (from, until) timestamps of closed pages
+        self._page_changeids = []  # (first, last) change ids of closed pages
+        self._first_changeid = None  # of the open page
+
+    @property
+    def source(self):
+        return self.changememory.source
+
+    @property
+    def path(self):
+        """The archive path (e.g., changelist-archive.xml)"""
+        (root, ext) = os.path.splitext(self.changememory.uri_path)
+        return "%s-archive%s" % (root, ext)
+
+    @property
+    def uri(self):
+        """The archive URI"""
+        return self.source.base_uri + "/" + self.path
+
+    def page_path(self, page_number):
+        """The path of an archived page (e.g., changelist-00001.xml)"""
+        (root, ext) = os.path.splitext(self.changememory.uri_path)
+        return "%s-%05d%s" % (root, page_number, ext)
+
+    def page_uri(self, page_number):
+        """The URI of an archived page"""
+        return self.source.base_uri + "/" + self.page_path(page_number)
+
+    @property
+    def page_path_pattern(self):
+        """Regular expression matching the page paths; the page number is
+        the first group"""
+        (root, ext) = os.path.splitext(self.changememory.uri_path)
+        return re.escape(root) + r"-([0-9]+)" + re.escape(ext)
+
+    @property
+    def page_count(self):
+        """The number of closed pages"""
+        return len(self._pages)
+
+    def add(self, change):
+        """Adds a change to the open page; closes the page when it is full"""
+        if len(self._open_page) == 0:
+            self._first_changeid = change.changeid
+        self._open_page.append((change.uri, change.timestamp, change.change,
+                                change.length, change.md5, change.sha256))
+        if len(self._open_page) >= self.page_size:
+            page = self._open_page
+            self._open_page = []
+            self._page_windows.append((page[0][1], page[-1][1]))
+            self._page_changeids.append((self._first_changeid,
+                                         change.changeid))
+            self._pages.append(page)
+
+    def page_validators(self, page_number):
+        """The ETag and last modification time of a closed page. Pages are
+        only kept in memory and numbered anew when the simulator restarts,
+        so the ETag is derived from the change ids and times of the page
+        instead of its number."""
+        (first, last) = self._page_changeids[page_number - 1]
+        (ts_from, ts_until) = self._page_windows[page_number - 1]
+        return ("\"%d-%d-%d-%d\"" % (first, last, ts_from * 1000,
+                                     ts_until * 1000), ts_until)
+
+    def generate_index(self):
+        """Generates the change list archive listing all closed pages"""
+        archive = ChangeListArchive()
+        archive.describedby = self.source.describedby_uri
+        archive.up = self.source.capability_list_uri
+        for page_number in range(1, self.page_count + 1):
+            (ts_from, ts_until) = self._page_windows[page_number - 1]
+            archive.add(Resource(uri=self.page_uri(page_number),
+                                 ts_from=ts_from, ts_until=ts_until))
+        return archive.as_xml()
+
+    def generate_page(self, page_number):
+        """Returns the XML of a closed page or None if there is no such
+        page"""
+        if page_number < 1 or page_number > self.page_count:
+            return None
+        page = self._pages[page_number - 1]
+        if isinstance(page, str):
+            return page
+        change_list = ChangeList()
+        for (uri, timestamp, change, length, md5, sha256) in page:
+            change_list.add(Resource(uri=uri, timestamp=timestamp,
+                                     change=change, length=length,
+                                     md5=md5, sha256=sha256))
+        change_list.describedby = self.source.describedby_uri
+        change_list.up = self.source.capability_list_uri
+        change_list.link_set('index', self.uri)
+        (change_list.md_from, change_list.md_until) = \
+            self._page_windows[page_number - 1]
+        xml = sitemap_xml(change_list)
+        self._pages[page_number - 1] = xml
+        return xml
 
 
 # A dynamic in-memory change set
@@ -57,10 +216,30 @@ class DynamicChangeList(ChangeMemory):
         """Returns the changememory's URI"""
         return self.source.base_uri + "/" + self.uri_path
 
-    def generate(self):
-        """Generates a list of changes"""
+    def changes_after(self, changeid, limit=None):
+        """The changes with an id greater than changeid, at most limit"""
+        changes = [change for change in self.changes[:]  # consistent copy
+                   if change.changeid > changeid]
+        if limit is not None:
+            return changes[:limit]
+        return changes
+
+    def changes_between(self, from_timestamp=None, until_timestamp=None):
+        """The changes at or after from_timestamp and before
+        until_timestamp"""
+        return [change for change in self.changes[:]  # consistent copy
+                if in_window(change, from_timestamp, until_timestamp)]
+
+    def generate(self, from_timestamp=None, until_timestamp=None, after=None):
+        """Generates a list of changes, optionally restricted to a time
+        window and/or to the changes after a given change id"""
+        if after is None:
+            changes = self.changes_between(from_timestamp, until_timestamp)
+        else:
+            changes = [change for change in self.changes_after(after)
+                       if in_window(change, from_timestamp, until_timestamp)]
         changelist = ChangeList()
-        for change in self.changes:
+        for change in changes:
             changelist.add(change)
         return changelist
 
@@ -71,3 +250,478 @@ class DynamicChangeList(ChangeMemory):
         if (self.max_changes and 
             len(self.changes)>self.max_changes):
             del self.changes[0:(len(self.changes)-self.max_changes)]
+        self._delivered([change])
+
+    def notify_batch(self, changes):
+        """Store a batch of changes, dropping old changes only once"""
+        for change in changes:
+            super(DynamicChangeList, self).notify(change)
+        self.changes.extend(changes)
+        if (self.max_changes and
+            len(self.changes)>self.max_changes):
+            del self.changes[0:(len(self.changes)-self.max_changes)]
+        self._delivered(changes)
+
+
+class RingBufferChangeList(DynamicChangeList):
+    """A change memory that keeps compact change records in a ring buffer.
+
+    Records are tuples instead of Resource objects; the oldest record is
+    overwritten in O(1) once max_changes records are stored. Without a
+    max_changes limit the buffer doubles its size when it is full.
+
+    Records can be looked up by change id or timestamp with a binary
+    search; the latter assumes that changes arrive in timestamp order, as
+    they do from the source.
+
+    Records are looked up and copied under a lock that is also held while
+    a change is stored, so that readers get a consistent view even if the
+    oldest records are overwritten meanwhile. Resource objects are created
+    from the copied records outside the lock.
+    """
+
+    INITIAL_CAPACITY = 1024
+
+    # Record fields
+    CHANGEID, URI, TIMESTAMP, CHANGE, LENGTH, MD5, SHA256 = range(7)
+
+    def __init__(self, source, config):
+        self._lock = threading.Lock()
+        super(RingBufferChangeList, self).__init__(source, config)
+
+    @property
+    def max_changes(self):
+        return self._max_changes
+
+    @max_changes.setter
+    def max_changes(self, max_changes):
+        """Sets the limit and resizes the buffer, keeping the most recent
+        records"""
+        with self._lock:
+            self._max_changes = max_changes
+            if not hasattr(self, '_records'):
+                self._records = []
+                self._start = 0
+                self._count = 0
+            capacity = max_changes or max(
+                self._count, RingBufferChangeList.INITIAL_CAPACITY)
+            self._resize(capacity)
+
+    def _resize(self, capacity):
+        records = [self._record(i)
+                   for i in range(max(0, self._count - capacity), self._count)]
+        self._records = records + [None] * (capacity - len(records))
+        self._start = 0
+        self._count = len(records)
+
+    def _record(self, index):
+        """The record at a logical index (0 is the oldest record)"""
+        return self._records[(self._start + index) % len(self._records)]
+
+    def _append(self, record):
+        capacity = len(self._records)
+        if self._count == capacity and not self._max_changes:
+            self._resize(2 * capacity)
+            capacity = len(self._records)
+        if self._count < capacity:
+            self._records[(self._start + self._count) % capacity] = record
+            self._count += 1
+        else:
+            # Overwrite the oldest record
+            self._records[self._start] = record
+            self._start = (self._start + 1) % capacity
+
+    @property
+    def changes(self):
+        """All stored changes as Resource objects, oldest first"""
+        return self.resources(0, self._count)
+
+    @changes.setter
+    def changes(self, changes):
+        """Replaces all stored changes"""
+        with self._lock:
+            self._records = [None] * len(self._records)
+            self._start = 0
+            self._count = 0
+            for change in changes:
+                self._append(self._compact(change))
+
+    @property
+    def change_count(self):
+        """The number of cached known change events"""
+        return self._count
+
+    def _compact(self, change):
+        """Creates a compact record from a change"""
+        return (getattr(change, 'changeid', None), change.uri,
+                change.timestamp, change.change, change.length,
+                change.md5, change.sha256)
+
+    def _resource(self, record):
+        """Creates a Resource object from a compact record"""
+        resource = Resource(uri=record[self.URI],
+                            timestamp=record[self.TIMESTAMP],
+                            change=record[self.CHANGE],
+                            length=record[self.LENGTH],
+                            md5=record[self.MD5],
+                            sha256=record[self.SHA256])
+        resource.changeid = record[self.CHANGEID]
+        return resource
+
+    def _records_between(self, start, stop):
+        """Copies the records between two logical indexes; the lock must
+        be held"""
+        if stop is None or stop > self._count:
+            stop = self._count
+        return [self._record(i) for i in range(start, stop)]
+
+    def resources(self, start=0, stop=None):
+        """The changes between two logical indexes as Resource objects"""
+        with self._lock:
+            records = self._records_between(start, stop)
+        return [self._resource(record) for record in records]
+
+    def _bisect(self, field, value):
+        """Returns the logical index of the first record whose field is
+        greater than or equal to value"""
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[field] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def index_of_changeid(self, changeid):
+        """Logical index of the first change with an id >= changeid"""
+        return self._bisect(self.CHANGEID, changeid)
+
+    def index_of_timestamp(self, timestamp):
+        """Logical index of the first change at or after timestamp"""
+        return self._bisect(self.TIMESTAMP, timestamp)
+
+    def changes_after(self, changeid, limit=None):
+        """The changes with an id greater than changeid, at most limit"""
+        with self._lock:
+            start = self.index_of_changeid(changeid + 1)
+            stop = None if limit is None else start + limit
+            records = self._records_between(start, stop)
+        return [self._resource(record) for record in records]
+
+    def changes_between(self, from_timestamp=None, until_timestamp=None):
+        """The changes at or after from_timestamp and before
+        until_timestamp"""
+        with self._lock:
+            start = 0
+            stop = self._count
+            if from_timestamp is not None:
+                start = self.index_of_timestamp(from_timestamp)
+            if until_timestamp is not None:
+                stop = self.index_of_timestamp(until_timestamp)
+            records = self._records_between(start, stop)
+        return [self._resource(record) for record in records]
+
+    def notify(self, change):
+        """Store a compact record of a change in the ring buffer"""
+        ChangeMemory.notify(self, change)
+        record = self._compact(change)
+        with self._lock:
+            self._append(record)
+        self._delivered([change])
+
+    def notify_batch(self, changes):
+        """Store a batch of changes; eviction is already O(1) per change"""
+        Observer.notify_batch(self, changes)
+
+
+class PersistentChangeList(DynamicChangeList):
+    """A change memory that appends change records to an on-disk log.
+
+    Two files are kept at the configured path prefix (e.g., changes.log and
+    changes.idx). The log holds one tab-separated line per change. The
+    index is memory-mapped and holds a count header plus an (offset,
+    timestamp) entry per change, so startup only needs to map the index
+    and windows of changes are found by a binary search without loading
+    the history.
+
+    All changes are kept; max_changes limits the number of most recent
+    changes in the default change list and change_count.
+
+    After follow() is called, e.g. in a forked worker process, the change
+    list only reads the files, picking up the changes appended by the
+    process that simulates the source.
+    """
+
+    HEADER = struct.Struct('<Q')  # number of indexed changes
+    ENTRY = struct.Struct('<Qd')  # log offset, timestamp
+    INDEX_GROWTH = 65536  # entries added when the index file is full
+
+    def __init__(self, source, config):
+        self.following = False
+        super(PersistentChangeList, self).__init__(source, config)
+        prefix = config.get('path', 'changememory')
+        self.log_path = prefix + ".log"
+        self.index_path = prefix + ".idx"
+        self._read_lock = threading.Lock()
+        self._open()
+
+    ##### File handling #####
+
+    def _open(self):
+        """Opens (or creates) log and index and recovers records that were
+        logged but not yet indexed"""
+        self._log_fd = os.open(self.log_path,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_reader = open(self.log_path, 'rb')
+        self._index_file = open(self.index_path, 'a+b')
+        if os.path.getsize(self.index_path) == 0:
+            self._index_file.truncate(self._index_size(self.INDEX_GROWTH))
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self._count = self.HEADER.unpack_from(self._index, 0)[0]
+        if self._count > 0:
+            self._log_size = self._offset(self._count - 1)
+            self._log_reader.seek(self._log_size)
+            self._log_size += len(self._log_reader.readline())
+        else:
+            self._log_size = 0
+        self._recover()
+        self.last_changeid = self._count
+        self.logger.info("Opened persistent changememory %s with %d changes"
+                         % (self.log_path, self._count))
+
+    def _recover(self):
+        """Indexes complete log lines after the last indexed record and
+        drops a trailing partial line"""
+        self._log_reader.seek(self._log_size)
+        for line in self._log_reader:
+            if not line.endswith("\n"):
+                break
+            timestamp = float(line.split("\t", 2)[1])
+            self._add_index_entry(self._log_size, timestamp)
+            self._log_size += len(line)
+        if os.path.getsize(self.log_path) > self._log_size:
+            os.ftruncate(self._log_fd, self._log_size)
+
+    def _index_size(self, entries):
+        return self.HEADER.size + entries * self.ENTRY.size
+
+    def _add_index_entry(self, offset, timestamp):
+        if self._index_size(self._count + 1) > len(self._index):
+            with self._read_lock:  # readers must not use the old mapping
+                self._index.flush()
+                self._index.close()
+                self._index_file.truncate(
+                    self._index_size(self._count + self.INDEX_GROWTH))
+                self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self.ENTRY.pack_into(self._index, self._index_size(self._count),
+                             offset, timestamp)
+        # Publish the entry by updating the count last
+        self._count += 1
+        self.HEADER.pack_into(self._index, 0, self._count)
+
+    def _offset(self, index):
+        return self.ENTRY.unpack_from(self._index, self._index_size(index))[0]
+
+    def _timestamp(self, index):
+        return self.ENTRY.unpack_from(self._index, self._index_size(index))[1]
+
+    def close(self):
+        """Flushes and closes log and index"""
+        if not self.following:
+            self._index.flush()
+            os.close(self._log_fd)
+        self._index.close()
+        self._index_file.close()
+        self._log_reader.close()
+
+    def follow(self):
+        """Stops writing and only reads the log and index appended by
+        another process from now on. The files are opened again so that
+        no file offsets are shared with the writing process."""
+        os.close(self._log_fd)
+        self._log_reader.close()
+        self._log_reader = open(self.log_path, 'rb')
+        self._index.close()
+        self._index_file.close()
+        self._index_file = open(self.index_path, 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        self.following = True
+        self._sync()
+
+    def _sync(self):
+        """Picks up the changes indexed by the writing process, mapping the
+        index again if it grew"""
+        if not self.following:
+            return
+        with self._read_lock:
+            count = self.HEADER.unpack_from(self._index, 0)[0]
+            if self._index_size(count) > len(self._index):
+                self._index.close()
+                self._index = mmap.mmap(self._index_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            self._count = count
+            self._last_changeid = count
+            if count > 0:
+                self._delivered_until = max(self._delivered_until,
+                                            self._timestamp(count - 1))
+
+    ##### Records #####
+
+    def _format(self, change):
+        return "%d\t%r\t%s\t%s\t%d\t%s\t%s\n" % (
+            change.changeid, change.timestamp, change.change, change.uri,
+            change.length or 0, change.md5 or "", change.sha256 or "")
+
+    def _parse(self, line):
+        (changeid, timestamp, change, uri, length, md5, sha256) = \
+            line.rstrip("\n").split("\t")
+        resource = Resource(uri=uri, timestamp=float(timestamp),
+                            change=change, length=int(length),
+                            md5=md5 or None, sha256=sha256 or None)
+        resource.changeid = int(changeid)
+        return resource
+
+    def resources(self, start=0, stop=None):
+        """The changes between two positions in the log as Resource
+        objects (0 is the oldest change). Only indexed changes are read, so
+        the result is consistent while changes are appended."""
+        with self._read_lock:
+            count = self._count
+            if stop is None or stop > count:
+                stop = count
+            if start >= stop:
+                return []
+            first = self._offset(start)
+            last = self._offset(stop) if stop < count else None
+            self._log_reader.seek(first)
+            if last is None:
+                data = self._log_reader.read()
+            else:
+                data = self._log_reader.read(last - first)
+        lines = data.splitlines(True)[:stop - start]
+        return [self._parse(line) for line in lines]
+
+    def _bisect(self, timestamp, count):
+        """Position of the first of count changes at or after timestamp;
+        the read lock must be held, since the index may be mapped again
+        meanwhile"""
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    ##### ChangeMemory interface #####
+
+    @property
+    def delivered_until(self):
+        """The time up to which all changes have been received, including
+        those indexed by the writing process"""
+        self._sync()
+        return self._delivered_until
+
+    @property
+    def last_changeid(self):
+        self._sync()
+        return self._last_changeid
+
+    @last_changeid.setter
+    def last_changeid(self, last_changeid):
+        self._last_changeid = last_changeid
+
+    @property
+    def changes(self):
+        """The most recent max_changes changes, oldest first"""
+        self._sync()
+        start = 0
+        if self.max_changes:
+            start = max(0, self._count - self.max_changes)
+        return self.resources(start)
+
+    @changes.setter
+    def changes(self, changes):
+        """Appends changes to the log (the log is never truncated)"""
+        for change in changes:
+            self.last_changeid += 1
+            change.changeid = self.last_changeid
+            self._append(change)
+
+    @property
+    def change_count(self):
+        """The number of changes in the default change list"""
+        self._sync()
+        if self.max_changes:
+            return min(self._count, self.max_changes)
+        return self._count
+
+    @property
+    def logged_count(self):
+        """The number of changes in the log"""
+        self._sync()
+        return self._count
+
+    def changes_after(self, changeid, limit=None):
+        """The changes with an id greater than changeid, at most limit;
+        change ids are log positions starting at 1"""
+        self._sync()
+        start = max(0, changeid)
+        if limit is not None:
+            return self.resources(start, start + limit)
+        return self.resources(start)
+
+    def changes_between(self, from_timestamp=None, until_timestamp=None):
+        """The changes at or after from_timestamp and before
+        until_timestamp"""
+        self._sync()
+        with self._read_lock:
+            count = self._count
+            start = 0
+            stop = count
+            if from_timestamp is not None:
+                start = self._bisect(from_timestamp, count)
+            if until_timestamp is not None:
+                stop = self._bisect(until_timestamp, count)
+        return self.resources(start, stop)
+
+    def generate(self, from_timestamp=None, until_timestamp=None, after=None):
+        """Generates a list of the most recent changes or of the changes in
+        the given window"""
+        if from_timestamp is None and until_timestamp is None and after is None:
+            changelist = ChangeList()
+            for change in self.changes:
+                changelist.add(change)
+            return changelist
+        return super(PersistentChangeList, self).generate(
+            from_timestamp, until_timestamp, after)
+
+    def _append(self, change):
+        line = self._format(change)
+        os.write(self._log_fd, line)
+        self._add_index_entry(self._log_size, change.timestamp)
+        self._log_size += len(line)
+
+    def notify(self, change):
+        """Append a change to the log and index"""
+        ChangeMemory.notify(self, change)
+        self._append(change)
+        self._delivered([change])
+
+    def notify_batch(self, changes):
+        """Append a batch of changes to the log with a single write, then
+        index them"""
+        lines = []
+        for change in changes:
+            ChangeMemory.notify(self, change)
+            lines.append(self._format(change))
+        os.write(self._log_fd, "".join(lines))
+        for (change, line) in zip(changes, lines):
+            self._add_index_entry(self._log_size, change.timestamp)
+            self._log_size += len(line)
+        self._delivered(changes)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+dump.py: Resource Dump and Change Dump capabilities.
+
+A dump lists ZIP packages, each holding a manifest (a sitemap describing
+the package contents) and the payloads of a range of resources or changes.
+Packages are generated as a stream of byte strings while the repository or
+the change memory is iterated; only the ZIP central directory (a few dozen
+bytes per entry) is kept until the end of a package.
+"""
+
+import os
+import re
+import time
+import zlib
+import logging
+import collections
+import zipfile
+
+from resync.change_list import ChangeList
+from resync.change_dump import ChangeDump
+from resync.resource_dump import ResourceDump
+from resync.resource_dump_manifest import ResourceDumpManifest
+
+from simulator.resource import Resource
+
+
+class ChangeDumpManifest(ChangeList):
+    """The manifest of a Change Dump package (not provided by resync)"""
+
+    def __init__(self, resources=None, md=None, ln=None, uri=None):
+        super(ChangeDumpManifest, self).__init__(resources=resources, md=md,
+                                                 ln=ln, uri=uri)
+        self.capability_name = 'changedump-manifest'
+
+
+class ZipStream(object):
+    """Writes a ZIP file as a sequence of byte strings.
+
+    Acts as the (write-only, non-seekable) file object of a ZipFile; the
+    add methods return the bytes written since the last call.
+    """
+
+    def __init__(self, compress=False):
+        self._parts = []
+        self._offset = 0
+        self.compress = compress
+        self.zip_file = zipfile.ZipFile(
+            self, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+            allowZip64=True)
+
+    def write(self, data):
+        self._parts.append(data)
+        self._offset += len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Returns and forgets the bytes written so far"""
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+    def _zip_info(self, arcname, timestamp):
+        zip_info = zipfile.ZipInfo(arcname, time.gmtime(timestamp)[:6])
+        zip_info.external_attr = 0o644 << 16
+        zip_info.compress_type = self.zip_file.compression
+        return zip_info
+
+    def add(self, arcname, data, timestamp):
+        """Adds a file and returns its bytes"""
+        self.zip_file.writestr(self._zip_info(arcname, timestamp), data)
+        return self.drain()
+
+    def add_chunks(self, arcname, length, chunks, timestamp):
+        """Adds a file of the given length whose content is yielded by
+        chunks() and yields its bytes. Uncompressed files are written
+        chunk by chunk; chunks() is called twice, once for the CRC."""
+        if self.compress:
+            data = b"".join([chunk.tobytes() for chunk in chunks()])
+            yield self.add(arcname, data, timestamp)
+            return
+        zip_info = self._zip_info(arcname, timestamp)
+        crc = 0
+        for chunk in chunks():
+            crc = zlib.crc32(chunk.tobytes(), crc)
+        zip_info.CRC = crc & 0xffffffff
+        zip_info.file_size = zip_info.compress_size = length
+        zip_info.header_offset = self._offset
+        self.write(zip_info.FileHeader(length > zipfile.ZIP64_LIMIT))
+        yield self.drain()
+        for chunk in chunks():
+            yield chunk.tobytes()
+            self._offset += len(chunk)
+        self.zip_file.filelist.append(zip_info)
+        self.zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def close(self):
+        """Writes the central directory and returns the remaining bytes"""
+        self.zip_file.close()
+        return self.drain()
+
+
+class DumpBuilder(object):
+    """Base class of the dump builders: paths and URIs of the dump and its
+    packages (e.g., resourcedump.xml and resourcedump-00001.zip)"""
+
+    complete_packages = False  # True if packages never change
+
+    def __init__(self, source, config):
+        self.source = source
+        self.config = config
+        self.package_size = config.get('package_size', 1000)
+        self.compress = bool(config.get('compress', False))
+        self.logger = logging.getLogger('dump_builder')
+
+    @property
+    def path(self):
+        """The dump path (from the config file)"""
+        return self.config['uri_path']
+
+    @property
+    def uri(self):
+        """The dump URI"""
+        return self.source.base_uri + "/" + self.path
+
+    def package_path(self, package_number):
+        """The path of a package (e.g., resourcedump-00001.zip)"""
+        (root, ext) = os.path.splitext(self.path)
+        return "%s-%05d.zip" % (root, package_number)
+
+    def package_uri(self, package_number):
+        """The URI of a package"""
+        return self.source.base_uri + "/" + self.package_path(package_number)
+
+    @property
+    def package_path_pattern(self):
+        """Regular expression matching the package paths; the package
+        number is the first group"""
+        (root, ext) = os.path.splitext(self.path)
+        return re.escape(root) + r"-([0-9]+)\.zip"
+
+    def is_available(self, package_number):
+        """True if the package can be generated"""
+        return 1 <= package_number <= self.package_count
+
+    def package_validators(self, package_number):
+        """The ETag and last modification time of a package, or None if
+        they are those of the source"""
+        return None
+
+    def add_links(self, dump):
+        dump.describedby = self.source.describedby_uri
+        dump.up = self.source.capability_list_uri
+
+    def package_entry(self, package_number, **kwargs):
+        """The entry of a package in the dump document"""
+        return Resource(uri=self.package_uri(package_number),
+                        mime_type="application/zip", **kwargs)
+
+    def basename(self, uri):
+        """The basename of a resource URI"""
+        return uri.rsplit("/", 1)[1]
+
+    def stream_package(self, manifest, contents):
+        """Yields the bytes of a ZIP package holding manifest.xml and the
+        payloads of the (path, resource) pairs in contents"""
+        stream = ZipStream(self.compress)
+        yield stream.add("manifest.xml", manifest.as_xml().encode('utf-8'),
+                         time.time())
+        engine = self.source.payload_engine
+        for (path, resource) in contents:
+            basename = self.basename(resource.uri)
+            length = resource.length
+            chunks = (lambda: engine.chunks(basename, length))
+            for data in stream.add_chunks(path, length, chunks,
+                                          resource.timestamp):
+                yield data
+        yield stream.close()
+
+
+class ResourceDumpBuilder(DumpBuilder):
+    """Publishes the current state of the source as a Resource Dump with
+    one package per package_size resource ids"""
+
+    @property
+    def package_count(self):
+        return (self.source.max_res_id - 1) // self.package_size + 1
+
+    def package_resources(self, package_number):
+        """The resources whose payloads are in a package"""
+        first = (package_number - 1) * self.package_size
+        resources = []
+        for res_id in xrange(first, first + self.package_size):
+            resource = self.source.resource(str(res_id))
+            if resource is not None:
+                resources.append(resource)
+        return resources
+
+    def generate(self):
+        """Generates the Resource Dump XML"""
+        resource_dump = ResourceDump()
+        self.add_links(resource_dump)
+        resource_dump.md_at = 'now'
+        for package_number in range(1, self.package_count + 1):
+            resource_dump.add(self.package_entry(package_number))
+        return resource_dump.as_xml()
+
+    def generate_package(self, package_number):
+        """Yields the bytes of a package or returns None if there is no
+        such package"""
+        if not self.is_available(package_number):
+            return None
+        resources = self.package_resources(package_number)
+        contents = [("resources/%s" % self.basename(resource.uri), resource)
+                    for resource in resources]
+        manifest = ResourceDumpManifest()
+        self.add_links(manifest)
+        manifest.md_at = 'now'
+        for (path, resource) in contents:
+            resource.path = "/" + path
+            manifest.add(resource)
+        return self.stream_package(manifest, contents)
+
+
+class ChangeDumpBuilder(DumpBuilder):
+    """Publishes the changes in the change memory as a Change Dump with one
+    package per package_size change ids.
+
+    Only complete packages are listed. They never change, so the bytes of
+    the max_cached_packages most recently requested ones are cached.
+    """
+
+    complete_packages = True
+
+    def __init__(self, source, config):
+        super(ChangeDumpBuilder, self).__init__(source, config)
+        self.max_cached_packages = config.get('max_cached_packages', 8)
+        self._package_cache = collections.OrderedDict()
+        self._package_windows = {}  # {package number, (from, until)}
+
+    @property
+    def changememory(self):
+        return self.source.changememory
+
+    @property
+    def package_count(self):
+        """The number of complete packages"""
+        return self.changememory.last_changeid // self.package_size
+
+    @property
+    def first_package(self):
+        """The first package whose changes are all still in the change
+        memory"""
+        oldest = self.changememory.changes_after(0, 1)
+        if len(oldest) == 0:
+            return self.package_count + 1
+        return (oldest[0].changeid + self.package_size - 2) // \
+            self.package_size + 1
+
+    def package_changes(self, package_number):
+        after = (package_number - 1) * self.package_size
+        return self.changememory.changes_after(after, self.package_size)
+
+    def package_window(self, package_number):
+        """The timestamps of the first and last change in a package"""
+        window = self._package_windows.get(package_number)
+        if window is None:
+            first = (package_number - 1) * self.package_size
+            last = package_number * self.package_size - 1
+            window = (self.changememory.changes_after(first, 1)[0].timestamp,
+                      self.changememory.changes_after(last, 1)[0].timestamp)
+            self._package_windows[package_number] = window
+        return window
+
+    def is_available(self, package_number):
+        return (package_number in self._package_cache or
+                self.first_package <= package_number <= self.package_count)
+
+    def package_validators(self, package_number):
+        """Derived from the change ids and the time window of the package.
+        Change ids of in-memory change memories start at 1 again after a
+        restart, and the window tells those packages apart."""
+        (ts_from, ts_until) = self.package_window(package_number)
+        return ("\"%d-%d-%d-%d\"" % (
+            (package_number - 1) * self.package_size + 1,
+            package_number * self.package_size,
+            ts_from * 1000, ts_until * 1000), ts_until)
+
+    def generate(self):
+        """Generates the Change Dump XML"""
+        change_dump = ChangeDump()
+        self.add_links(change_dump)
+        first_package = self.first_package
+        if first_package <= self.package_count:
+            change_dump.md_from = self.package_window(first_package)[0]
+        else:
+            change_dump.md_from = 'now'
+        change_dump.md_until = 'now'
+        for package_number in range(first_package, self.package_count + 1):
+            (ts_from, ts_until) = self.package_window(package_number)
+            change_dump.add(self.package_entry(package_number,
+                                               ts_from=ts_from,
+                                               ts_until=ts_until))
+        return change_dump.as_xml()
+
+    def generate_package(self, package_number):
+        """Yields the bytes of a complete package or returns None if there
+        is no such package"""
+        if package_number in self._package_cache:
+            return iter(self._package_cache[package_number])
+        if not self.is_available(package_number):
+            return None
+        return self._cache_package(package_number,
+                                   self._stream_package(package_number))
+
+    def _stream_package(self, package_number):
+        changes = self.package_changes(package_number)
+        # keep the window for the validators of the cached package
+        self._package_windows[package_number] = (changes[0].timestamp,
+                                                 changes[-1].timestamp)
+        manifest = ChangeDumpManifest()
+        self.add_links(manifest)
+        manifest.md_from = changes[0].timestamp
+        manifest.md_until = changes[-1].timestamp
+        contents = []
+        for change in changes:
+            entry = Resource(resource=change)  # don't modify the memory
+            if change.change != "deleted":
+                path = "changes/%d/%s" % (change.changeid,
+                                          self.basename(change.uri))
+                entry.path = "/" + path
+                contents.append((path, entry))
+            manifest.add(entry)
+        return self.stream_package(manifest, contents)
+
+    def _cache_package(self, package_number, stream):
+        """Passes the bytes of a package through and caches them once the
+        package was streamed completely"""
+        parts = []
+        for data in stream:
+            parts.append(data)
+            yield data
+        self._package_cache[package_number] = parts
+        while len(self._package_cache) > self.max_cached_packages:
+            self._package_cache.popitem(last=False)
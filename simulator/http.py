@@ -7,24 +7,38 @@ non-blocking Tornado web server (http://www.tornadoweb.org/)
 Created by Bernhard Haslhofer on 2012-04-24.
 """
 
+import time
+import json
 import threading
 import os.path
 import logging
+import email.utils
+import gzip
+import collections
+from io import BytesIO
 
+import tornado.gen
+import tornado.httputil
 import tornado.httpserver
 import tornado.ioloop
+import tornado.log
 import tornado.web
 
 from resync.source_description import SourceDescription
 from resync.capability_list import CapabilityList
 from resync.change_list import ChangeList
+from resync.resource_list import ResourceList
+from resync.w3c_datetime import str_to_datetime
 
 from simulator.source import Source
+from simulator.serializer import sitemap_xml
+from simulator.payload import byte_range
 
 
 class HTTPInterface(threading.Thread):
     """The repository's HTTP interface. To make sure it doesn't interrupt
-    the simulation, it runs in a separate thread.
+    the simulation, it runs in a separate thread. Alternatively, serve()
+    runs it on the calling thread together with an IOLoopSimulation.
 
     http://stackoverflow.com/questions/323972/
         is-there-any-way-to-kill-a-thread-in-python (Stoppable Threads)
@@ -41,11 +55,14 @@ class HTTPInterface(threading.Thread):
         self._stop = threading.Event()
         self.source = source
         self.port = source.port
+        self.http_server = None
         self.settings = dict(
             title=u"ResourceSync Change Simulator",
             template_path=os.path.join(os.path.dirname(__file__), "templates"),
             static_path=Source.STATIC_FILE_PATH,
             autoescape=None,
+            response_cache=ResponseCache(),
+            log_function=self.log_request,
         )
         self.handlers = [
             (r"/", HomeHandler, dict(source=self.source)),
@@ -59,46 +76,196 @@ class HTTPInterface(threading.Thread):
                 dict(source=self.source)),
             (r"/(favicon\.ico)", tornado.web.StaticFileHandler,
                 dict(path=self.settings['static_path'])),
+            (r"/metrics", MetricsHandler, dict(source=self.source)),
         ]
 
         """Initialize resource_list handlers"""
         if self.source.has_resource_list_builder:
             resource_list_builder = self.source.resource_list_builder
             if resource_list_builder.config['class'] == "DynamicResourceListBuilder":
+                if resource_list_builder.paged:
+                    self.handlers = self.handlers + \
+                        [(r"/%s" % resource_list_builder.path,
+                            ResourceListIndexHandler,
+                            dict(resource_list_builder=resource_list_builder,
+                                 source=self.source)),
+                         (r"/%s" % resource_list_builder.page_path_pattern,
+                            ResourceListPageHandler,
+                            dict(resource_list_builder=resource_list_builder,
+                                 source=self.source))]
+                else:
+                    self.handlers = self.handlers + \
+                        [(r"/%s" % resource_list_builder.path,
+                            ResourceListHandler,
+                            dict(resource_list_builder=resource_list_builder,
+                                 source=self.source))]
+            elif resource_list_builder.config['class'] == "IncrementalResourceListBuilder":
                 self.handlers = self.handlers + \
                     [(r"/%s" % resource_list_builder.path,
-                        ResourceListHandler,
+                        IncrementalResourceListHandler,
                         dict(resource_list_builder=resource_list_builder,
                              source=self.source))]
 
         """Initialize changememory handlers"""
         if self.source.has_changememory:
             changememory = self.source.changememory
-            if changememory.config['class'] == "DynamicChangeList":
+            if changememory.config['class'] in ("DynamicChangeList",
+                                                "RingBufferChangeList",
+                                                "PersistentChangeList"):
                 self.handlers = self.handlers + \
                     [(r"/%s" % changememory.uri_path,
                         DynamicChangeListHandler,
                         dict(changememory=changememory,
                              source=self.source))]
+            if changememory.archive is not None:
+                self.handlers = self.handlers + \
+                    [(r"/%s" % changememory.archive.path,
+                        ChangeListArchiveHandler,
+                        dict(changememory=changememory,
+                             source=self.source)),
+                     (r"/%s" % changememory.archive.page_path_pattern,
+                        ChangeListArchivePageHandler,
+                        dict(changememory=changememory,
+                             source=self.source))]
 
-    def run(self):
+        """Initialize dump handlers"""
+        for dump_builder in (self.source.resource_dump_builder,
+                             self.source.change_dump_builder):
+            if dump_builder is not None:
+                self.handlers = self.handlers + \
+                    [(r"/%s" % dump_builder.path,
+                        DumpHandler,
+                        dict(dump_builder=dump_builder,
+                             source=self.source)),
+                     (r"/%s" % dump_builder.package_path_pattern,
+                        DumpPackageHandler,
+                        dict(dump_builder=dump_builder,
+                             source=self.source))]
+
+    def enable_admin(self, profiler):
+        """Adds the admin endpoints, which control the given profiler
+        (see ProfileHandler); call before the interface is started"""
+        self.handlers = self.handlers + \
+            [(r"/admin/profile", ProfileHandler, dict(profiler=profiler))]
+
+    def listen(self, sockets=None):
+        """Creates the HTTP server and binds it to the port, or lets it
+        accept connections on already bound sockets"""
         self.logger.info("Starting up HTTP Interface on port %i" % (self.port))
         application = tornado.web.Application(
             handlers=self.handlers,
             debug=True,
+            autoreload=sockets is None,  # doesn't work in forked workers
             **self.settings)
         self.http_server = tornado.httpserver.HTTPServer(application)
-        self.http_server.listen(self.port)
+        if sockets is None:
+            self.http_server.listen(self.port)
+        else:
+            self.http_server.add_sockets(sockets)
+
+    def run(self):
+        self.listen()
         tornado.ioloop.IOLoop.instance().start()
 
+    def serve(self, simulation=None, sockets=None):
+        """Serves requests on the IOLoop of the calling thread instead of
+        a separate thread. If an IOLoopSimulation is given, it runs on the
+        same IOLoop and serving ends once it finished. Returns after
+        stop() was called."""
+        self.listen(sockets)
+        ioloop = tornado.ioloop.IOLoop.instance()
+        if simulation is not None:
+            simulation.start(on_finished=self._shutdown)
+        try:
+            ioloop.start()
+        finally:
+            if simulation is not None:
+                simulation.stop()
+            self.http_server.stop()
+
+    def _shutdown(self):
+        """Stops accepting connections and stops the IOLoop; must run on
+        the IOLoop"""
+        if self.http_server is not None:
+            self.http_server.stop()
+        tornado.ioloop.IOLoop.instance().stop()
+
     def stop(self):
+        """Stops the HTTP interface from any thread and waits for the
+        interface thread (if started) to end"""
         self.logger.info("Stopping HTTP Interface")
-        tornado.ioloop.IOLoop.instance().stop()
+        tornado.ioloop.IOLoop.instance().add_callback(self._shutdown)
         self._stop.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
 
     def stopped(self):
         return self._stop.isSet()
 
+    def log_request(self, handler):
+        """Records a finished request in the source's metrics and logs it
+        like Tornado does by default"""
+        status = handler.get_status()
+        request_time = handler.request.request_time()
+        self.source.metrics.observe_request(type(handler).__name__, status,
+                                            request_time)
+        if status < 400:
+            log_method = tornado.log.access_log.info
+        elif status < 500:
+            log_method = tornado.log.access_log.warning
+        else:
+            log_method = tornado.log.access_log.error
+        log_method("%d %s %.2fms", status, handler._request_summary(),
+                   1000.0 * request_time)
+
+
+class ResponseCache(object):
+    """Caches generated documents by key (e.g., the request URI) together
+    with the source version they were generated at and a gzip-compressed
+    copy of their body.
+
+    Only the latest version of a document is kept; the least recently
+    stored documents are evicted beyond max_entries.
+    """
+
+    Entry = collections.namedtuple('Entry', ['version', 'body', 'gzipped'])
+
+    def __init__(self, max_entries=256, compresslevel=6):
+        self.max_entries = max_entries
+        self.compresslevel = compresslevel
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """The cached entry of a document or None if there is none for the
+        given version"""
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, version, body):
+        """Caches and returns the entry of a document"""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        entry = ResponseCache.Entry(version, body, self.compress(body))
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def compress(self, body):
+        buf = BytesIO()
+        gzip_file = gzip.GzipFile(mode='wb', fileobj=buf, mtime=0,
+                                  compresslevel=self.compresslevel)
+        gzip_file.write(body)
+        gzip_file.close()
+        return buf.getvalue()
+
 
 class BaseRequestHandler(tornado.web.RequestHandler):
     SUPPORTED_METHODS = ("GET")
@@ -106,14 +273,157 @@ class BaseRequestHandler(tornado.web.RequestHandler):
     def initialize(self, source):
         self.source = source
 
+    def validators(self):
+        """The ETag and last modification time of the requested document.
+        Derived from the source version by default, since documents only
+        change when the source does; the time of the latest change keeps
+        ETags unique across restarts."""
+        last_modified = self.source.last_modified
+        return ("\"%d-%d\"" % (self.source.version, last_modified * 1000),
+                last_modified)
+
+    def not_modified(self):
+        """Sets the validator headers and answers 304 Not Modified if the
+        client's copy is current. Handlers return without generating a
+        body if this is True."""
+        (etag, last_modified) = self.validators()
+        if etag is not None:
+            self.set_header("Etag", etag)
+        if last_modified is not None:
+            self.set_header("Last-Modified",
+                            tornado.httputil.format_timestamp(last_modified))
+        if self.request.headers.get("If-None-Match") is not None:
+            modified = not self.check_etag_header()
+        else:
+            modified = self.modified_since(last_modified)
+        if not modified:
+            self.set_status(304)
+        return not modified
+
+    def modified_since(self, last_modified):
+        """False if the If-Modified-Since header is at or after
+        last_modified (HTTP dates have a resolution of seconds)"""
+        header = self.request.headers.get("If-Modified-Since")
+        if header is None or last_modified is None:
+            return True
+        date = email.utils.parsedate_tz(header)
+        if date is None:
+            return True
+        return int(last_modified) > email.utils.mktime_tz(date)
+
+    def accepts_gzip(self):
+        """True if the client accepts gzip-encoded responses"""
+        for coding in self.request.headers.get("Accept-Encoding", "").split(","):
+            parts = [part.strip() for part in coding.split(";")]
+            if parts[0] == "gzip":
+                return not (len(parts) > 1 and
+                            parts[1].replace(" ", "") in ("q=0", "q=0.0"))
+        return False
+
+    def write_document(self, generate, version=None):
+        """Writes an XML document from the response cache, calling
+        generate() to create it if the cache holds no copy of the current
+        source version. Sends the gzip-compressed copy if the client
+        accepts it."""
+        if version is None:
+            version = self.source.version
+        cache = self.settings['response_cache']
+        key = self.request.uri
+        entry = cache.get(key, version)
+        if entry is None:
+            then = time.time()
+            body = generate()
+            self.source.metrics.observe_generation(type(self).__name__,
+                                                   time.time() - then)
+            entry = cache.put(key, version, body)
+        self.set_header("Content-Type", "application/xml")
+        self.set_header("Vary", "Accept-Encoding")
+        if self.accepts_gzip():
+            self.set_header("Content-Encoding", "gzip")
+            self.write(entry.gzipped)
+        else:
+            self.write(entry.body)
+
 
 class HomeHandler(BaseRequestHandler):
     """Root URI handler"""
     def get(self):
+        if self.not_modified():
+            return
         self.render("home.html",
                     resource_count=self.source.resource_count,
                     source=self.source)
 
+class MetricsHandler(BaseRequestHandler):
+    """Serves the live metrics in the Prometheus text format, or as JSON
+    with ?format=json"""
+
+    def get(self):
+        self.set_header("Cache-Control", "no-cache")
+        metrics = self.source.metrics
+        if self.get_argument('format', None) == 'json':
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(metrics.collect(self.source),
+                                  sort_keys=True))
+        else:
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(metrics.prometheus(self.source))
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Controls the profiler (see simulator.profiler):
+
+    POST /admin/profile?seconds=30&interval=0.005 -- starts profiling
+    DELETE /admin/profile -- stops profiling
+    GET /admin/profile -- the status as JSON, or the samples so far with
+        ?format=collapsed (flame graph input), pstats (pstats.Stats file)
+        or text (the top functions by cumulative time)
+    """
+    SUPPORTED_METHODS = ("GET", "POST", "DELETE")
+
+    def initialize(self, profiler):
+        self.profiler = profiler
+
+    def get_float_argument(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid %s" % name)
+
+    def post(self):
+        try:
+            self.profiler.start(seconds=self.get_float_argument('seconds'),
+                                interval=self.get_float_argument('interval'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(409, str(e))
+        self.set_status(202)
+        self.write(self.profiler.status())
+
+    def delete(self):
+        self.profiler.stop()
+        self.write(self.profiler.status())
+
+    def get(self):
+        self.set_header("Cache-Control", "no-cache")
+        output = self.get_argument('format', None)
+        if output is None:
+            self.write(self.profiler.status())
+        elif output == 'collapsed':
+            self.set_header("Content-Type", "text/plain")
+            self.write(self.profiler.collapsed())
+        elif output == 'pstats':
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition",
+                            "attachment; filename=simulator.pstats")
+            self.write(self.profiler.dump_stats())
+        elif output == 'text':
+            self.set_header("Content-Type", "text/plain")
+            self.write(self.profiler.report())
+        else:
+            raise tornado.web.HTTPError(400, "Unknown format %s" % output)
+
 # Resource Handlers
 
 
@@ -132,11 +442,15 @@ class ResourcesHandler(BaseRequestHandler):
 class SourceDescriptionHandler(BaseRequestHandler):
     """The HTTP request handler for the Source Description"""
     def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.generate_source_description)
+
+    def generate_source_description(self):
         source_description = SourceDescription()
         source_description.describedby = self.source.describedby_uri
         source_description.add_capability_list(self.source.capability_list_uri)
-        self.set_header("Content-Type", "application/xml")
-        self.write(source_description.as_xml())
+        return source_description.as_xml()
 
 
 # Capability List Handler
@@ -145,6 +459,11 @@ class SourceDescriptionHandler(BaseRequestHandler):
 class CapabilityListHandler(BaseRequestHandler):
     """The HTTP request handler for the Capability List"""
     def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.generate_capability_list)
+
+    def generate_capability_list(self):
         capability_list = CapabilityList()
         capability_list.describedby = self.source.describedby_uri
         capability_list.add_capability(uri=self.source.resource_list_builder.uri,
@@ -152,68 +471,297 @@ class CapabilityListHandler(BaseRequestHandler):
         if self.source.has_changememory:
             capability_list.add_capability(uri=self.source.changememory.base_uri,
                                            name='changelist')
-        self.set_header("Content-Type", "application/xml")
-        self.write(capability_list.as_xml())
+            if self.source.changememory.archive is not None:
+                capability_list.add_capability(
+                    uri=self.source.changememory.archive.uri,
+                    name='changelist-archive')
+        if self.source.has_resource_dump_builder:
+            capability_list.add_capability(
+                uri=self.source.resource_dump_builder.uri,
+                name='resourcedump')
+        if self.source.has_change_dump_builder:
+            capability_list.add_capability(
+                uri=self.source.change_dump_builder.uri,
+                name='changedump')
+        return capability_list.as_xml()
 
 # Resource Handler
 
 
 class ResourceHandler(BaseRequestHandler):
-    """Resource handler"""
+    """Resource handler; streams payloads in chunks and serves single byte
+    ranges (Range: bytes=...) with 206 Partial Content"""
+
+    def validators(self):
+        """The MD5 digest (or the timestamp if it isn't computed) and the
+        timestamp of the resource"""
+        resource = self.resource
+        if resource.md5 is not None:
+            return ("\"%s\"" % resource.md5, resource.timestamp)
+        return ("\"%r\"" % resource.timestamp, resource.timestamp)
+
+    @tornado.gen.coroutine
     def get(self, basename):
         resource = self.source.resource(basename)
         if resource is None:
             self.send_error(404)
+            return
+        self.resource = resource
+        if self.not_modified():
+            return
+        length = resource.length
+        try:
+            requested = byte_range(self.request.headers.get("Range"), length)
+        except ValueError:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % length)
+            return
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("Accept-Ranges", "bytes")
+        if requested is None:
+            (start, stop) = (0, length)
         else:
-            self.set_header("Content-Type", "text/plain")
-            self.set_header("Content-Length", resource.length)
-            self.set_header("Last-Modified", resource.lastmod)
-            self.set_header("Etag", "\"%s\"" % resource.md5)
-            payload = self.source.resource_payload(basename)
-            self.write(payload)
+            (start, stop) = requested
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, stop - 1, length))
+        self.set_header("Content-Length", stop - start)
+        for chunk in self.source.payload_engine.chunks(basename, length,
+                                                       start, stop):
+            # Tornado only writes byte strings; copies one chunk at a time
+            self.write(chunk.tobytes())
+            yield self.flush()
 
 # ResourceList Handlers
 
 
-class ResourceListHandler(tornado.web.RequestHandler):
+class ResourceListHandler(BaseRequestHandler):
     """The HTTP request handler for the ResourceList"""
 
     def initialize(self, source, resource_list_builder):
         self.source = source
         self.resource_list_builder = resource_list_builder
 
-    def generate_resource_list(self):
-        """Creates a resource_list"""
-        resource_list = self.resource_list_builder.generate()
+    def build_resource_list(self):
+        """Creates an empty resource_list with links to the source's
+        documents and returns it with the records of its resources"""
+        (resource_list, records) = self.resource_list_builder.generate_records()
+        self.add_links(resource_list)
+        return (resource_list, records)
+
+    def add_links(self, resource_list):
+        """Adds links and metadata to a resource_list"""
         resource_list.describedby = self.source.describedby_uri
         resource_list.up = self.source.capability_list_uri
-        resource_list.md_at = 'now'
-        return resource_list.as_xml()
+        if resource_list.md_at is None:  # not generated from a snapshot
+            resource_list.md_at = self.source.delivered_until
 
+    def generate_resource_list(self):
+        """Creates a resource_list"""
+        (resource_list, records) = self.build_resource_list()
+        return self.source.serializer.as_xml(resource_list, records)
+
+    @tornado.gen.coroutine
     def get(self):
+        if self.not_modified():
+            return
+        if not self.resource_list_builder.streaming:
+            self.write_document(self.generate_resource_list)
+            return
         self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_resource_list())
+        # Write the resource list chunk by chunk; waiting for each flush
+        # to complete keeps memory bounded and yields to the IOLoop so
+        # that slow clients don't block other requests.
+        then = time.time()
+        elapsed = 0.0  # generation time, not waiting for the client
+        (resource_list, records) = self.build_resource_list()
+        for chunk in self.source.serializer.chunks(
+                resource_list, records, self.resource_list_builder.chunk_size):
+            elapsed += time.time() - then
+            self.write(chunk)
+            yield self.flush()
+            then = time.time()
+        self.source.metrics.observe_generation(type(self).__name__,
+                                               elapsed + time.time() - then)
+
+
+class IncrementalResourceListHandler(ResourceListHandler):
+    """The HTTP request handler for incrementally built ResourceLists"""
+
+    def generate_resource_list(self):
+        """Creates a resource_list from pre-serialized resources"""
+        resource_list = ResourceList()
+        self.add_links(resource_list)
+        return self.resource_list_builder.generate_xml(resource_list)
+
+    def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.generate_resource_list)
+
+
+class ResourceListIndexHandler(ResourceListHandler):
+    """The HTTP request handler for the index of a paged ResourceList"""
+
+    def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.resource_list_builder.generate_index)
+
+
+class ResourceListPageHandler(ResourceListHandler):
+    """The HTTP request handler for the pages of a paged ResourceList"""
+
+    def get(self, page_number):
+        if not 1 <= int(page_number) <= self.resource_list_builder.page_count:
+            self.send_error(404)
+            return
+        if self.not_modified():
+            return
+        self.write_document(lambda: self.resource_list_builder.generate_page(
+            int(page_number)))
 
 # Changememory Handlers
 
 
-class DynamicChangeListHandler(tornado.web.RequestHandler):
+class DynamicChangeListHandler(BaseRequestHandler):
     """The HTTP request handler for dynamically generated changelists"""
 
     def initialize(self, source, changememory):
         self.source = source
         self.changememory = changememory
 
+    def get_timestamp_argument(self, name):
+        """Parses a W3C datetime query argument into a timestamp"""
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return str_to_datetime(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid %s datetime" % name)
+
+    def get_changeid_argument(self, name):
+        """Parses a change id query argument"""
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid %s change id" % name)
+
     def generate_change_list(self):
-        """Serialize the changes in the changememory"""
-        change_list = self.changememory.generate()
-        #change_list = ChangeList(resources=changes)
+        """Serialize the changes in the changememory, optionally only those
+        in the window given by the from/until (W3C datetime) and after
+        (change id) query arguments"""
+        from_timestamp = self.get_timestamp_argument('from')
+        until_timestamp = self.get_timestamp_argument('until')
+        after = self.get_changeid_argument('after')
+        # The change memory returns a consistent copy of its changes, which
+        # includes all changes delivered until then; changes simulated
+        # meanwhile may still be on their way
+        delivered_until = self.changememory.delivered_until
+        change_list = self.changememory.generate(from_timestamp,
+                                                 until_timestamp, after)
         change_list.describedby = self.source.describedby_uri
         change_list.up = self.source.capability_list_uri
-        change_list.md_from = change_list.resources[0].timestamp
-        change_list.md_until = 'now'
-        return change_list.as_xml()
+        if from_timestamp is not None:
+            change_list.md_from = from_timestamp
+        elif len(change_list.resources) > 0:
+            change_list.md_from = change_list.resources[0].timestamp
+        else:
+            change_list.md_from = delivered_until
+        if until_timestamp is not None:
+            change_list.md_until = min(until_timestamp, delivered_until)
+        else:
+            change_list.md_until = delivered_until
+        return sitemap_xml(change_list)
 
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_change_list())
+        if self.not_modified():
+            return
+        self.write_document(self.generate_change_list)
+
+
+class ChangeListArchiveHandler(DynamicChangeListHandler):
+    """The HTTP request handler for the Change List Archive"""
+
+    def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.changememory.archive.generate_index)
+
+
+class ChangeListArchivePageHandler(DynamicChangeListHandler):
+    """The HTTP request handler for archived, immutable changelist pages"""
+
+    def validators(self):
+        """Derived from the changes of the page, which never change while
+        the simulator runs"""
+        return self.changememory.archive.page_validators(self.page_number)
+
+    def get(self, page_number):
+        page_number = int(page_number)
+        if not 1 <= page_number <= self.changememory.archive.page_count:
+            self.send_error(404)
+            return
+        self.page_number = page_number
+        # Pages are numbered anew after a restart, so caches must
+        # revalidate them; that's cheap with the strong ETag
+        self.set_header("Cache-Control", "public, no-cache")
+        if self.not_modified():
+            return
+        # Archived pages never change, so any cached copy is current
+        self.write_document(lambda: self.changememory.archive.generate_page(
+            page_number), version=0)
+
+# Dump Handlers
+
+
+class DumpHandler(BaseRequestHandler):
+    """The HTTP request handler for Resource Dumps and Change Dumps"""
+
+    def initialize(self, source, dump_builder):
+        self.source = source
+        self.dump_builder = dump_builder
+
+    def get(self):
+        if self.not_modified():
+            return
+        self.write_document(self.dump_builder.generate)
+
+
+class DumpPackageHandler(DumpHandler):
+    """The HTTP request handler for dump packages; streams the ZIP file
+    while it is generated"""
+
+    def validators(self):
+        """Derived from the contents of complete packages, which never
+        change while the simulator runs"""
+        validators = self.dump_builder.package_validators(self.package_number)
+        if validators is not None:
+            return validators
+        return super(DumpPackageHandler, self).validators()
+
+    @tornado.gen.coroutine
+    def get(self, package_number):
+        package_number = int(package_number)
+        if not self.dump_builder.is_available(package_number):
+            self.send_error(404)
+            return
+        self.package_number = package_number
+        if self.dump_builder.complete_packages:
+            # Packages are numbered anew after a restart of an in-memory
+            # change memory, so caches must revalidate them
+            self.set_header("Cache-Control", "public, no-cache")
+        if self.not_modified():
+            return
+        package = self.dump_builder.generate_package(package_number)
+        if package is None:  # dropped from the change memory meanwhile
+            self.send_error(404)
+            return
+        self.set_header("Content-Type", "application/zip")
+        for data in package:
+            self.write(data)
+            yield self.flush()
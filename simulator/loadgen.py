@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+loadgen.py: A swarm of ResourceSync destinations that loads a running
+simulator (see resync-loadgen).
+
+Each destination discovers the capability list through the source
+description and then follows a polling pattern:
+
+* full: a baseline sync (the resource list and its resources), then an
+  incremental sync from the change list every poll interval
+* baseline: a baseline sync every poll interval
+* incremental: incremental syncs only, from the time it started
+
+An incremental sync requests the changes since the md_until time of the
+previous change list (?from=...) and fetches the created and updated
+resources. All destinations share one asynchronous HTTP client on one
+IOLoop, so a single process can keep hundreds of requests in flight.
+Latencies, sizes and status codes are recorded per endpoint (the
+capability of a document, or 'resource').
+"""
+
+import math
+import time
+import random
+import logging
+import urllib
+import collections
+import xml.etree.cElementTree as ElementTree
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+RS_NS = "{http://www.openarchives.org/rs/terms/}"
+SOURCE_DESCRIPTION_PATH = "/.well-known/resourcesync"
+PATTERNS = ('full', 'baseline', 'incremental')
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of a sorted list of values"""
+    if len(values) == 0:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Sitemap(object):
+    """The parts of a ResourceSync document that destinations use"""
+
+    def __init__(self, capability=None, md_at=None, md_until=None,
+                 is_index=False, entries=None):
+        self.capability = capability
+        self.md_at = md_at
+        self.md_until = md_until
+        self.is_index = is_index
+        self.entries = entries or []  # [(loc, {rs:md attributes})]
+
+    @classmethod
+    def parse(cls, body):
+        root = ElementTree.fromstring(body)
+        sitemap = cls(is_index=root.tag == SITEMAP_NS + "sitemapindex")
+        md = root.find(RS_NS + "md")
+        if md is not None:
+            sitemap.capability = md.get('capability')
+            sitemap.md_at = md.get('at')
+            sitemap.md_until = md.get('until')
+        tag = "sitemap" if sitemap.is_index else "url"
+        for element in root.iter(SITEMAP_NS + tag):
+            md = element.find(RS_NS + "md")
+            sitemap.entries.append(
+                (element.findtext(SITEMAP_NS + "loc"),
+                 dict(md.attrib) if md is not None else {}))
+        return sitemap
+
+
+class Stats(object):
+    """Latencies, sizes and status codes of the requests per endpoint;
+    errors are server errors and failed requests (599), while 404s of
+    resources deleted since they were listed are expected"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.latencies = collections.defaultdict(list)  # {endpoint, [secs]}
+        self.bytes = collections.Counter()  # {endpoint, bytes}
+        self.codes = collections.defaultdict(collections.Counter)
+        self.syncs = collections.Counter()  # {'baseline', count}
+
+    def record(self, endpoint, seconds, code, size):
+        self.latencies[endpoint].append(seconds)
+        self.bytes[endpoint] += size
+        self.codes[endpoint][code] += 1
+
+    def summary(self, elapsed=None):
+        """Requests, throughput and latency percentiles per endpoint"""
+        if elapsed is None:
+            elapsed = time.time() - self.started
+        endpoints = {}
+        for (endpoint, latencies) in self.latencies.items():
+            latencies = sorted(latencies)
+            codes = self.codes[endpoint]
+            summary = {
+                'requests': len(latencies),
+                'errors': sum(count for (code, count) in codes.items()
+                              if code >= 500),
+                'codes': dict((str(code), count)
+                              for (code, count) in codes.items()),
+                'requests_per_second': len(latencies) / elapsed,
+                'bytes': self.bytes[endpoint],
+                'bytes_per_second': self.bytes[endpoint] / elapsed,
+                'mean_seconds': sum(latencies) / len(latencies),
+                'max_seconds': latencies[-1]}
+            for percent in PERCENTILES:
+                summary['p%d_seconds' % percent] = percentile(latencies,
+                                                              percent)
+            endpoints[endpoint] = summary
+        return {'elapsed_seconds': elapsed,
+                'syncs': dict(self.syncs),
+                'endpoints': endpoints}
+
+    def report(self, elapsed=None):
+        """The summary as a table"""
+        summary = self.summary(elapsed)
+        lines = ["%-16s %9s %7s %9s %10s %9s %9s %9s %9s" % (
+            "endpoint", "requests", "errors", "req/s", "KB/s", "p50 ms",
+            "p90 ms", "p99 ms", "max ms")]
+        for (endpoint, s) in sorted(summary['endpoints'].items()):
+            lines.append("%-16s %9d %7d %9.1f %10.1f %9.1f %9.1f %9.1f "
+                         "%9.1f" % (
+                             endpoint, s['requests'], s['errors'],
+                             s['requests_per_second'],
+                             s['bytes_per_second'] / 1024.0,
+                             s['p50_seconds'] * 1000,
+                             s['p90_seconds'] * 1000,
+                             s['p99_seconds'] * 1000,
+                             s['max_seconds'] * 1000))
+        lines.append("%d baseline and %d incremental syncs in %.1fs" % (
+            summary['syncs'].get('baseline', 0),
+            summary['syncs'].get('incremental', 0),
+            summary['elapsed_seconds']))
+        return "\n".join(lines)
+
+
+class Destination(object):
+    """A destination that keeps itself in sync with the source"""
+
+    def __init__(self, generator, number):
+        self.generator = generator
+        self.number = number
+        self.logger = logging.getLogger('loadgen')
+        self.capabilities = {}  # {capability, uri}
+        self.md_until = None  # of the last change list
+
+    @property
+    def stats(self):
+        return self.generator.stats
+
+    @gen.coroutine
+    def fetch(self, endpoint, url, keep_body=True):
+        """Fetches url and records the request; returns the response, or
+        None if the request failed"""
+        received = [0]
+
+        def count(chunk):
+            received[0] += len(chunk)
+        request = HTTPRequest(
+            url, request_timeout=self.generator.timeout,
+            streaming_callback=None if keep_body else count)
+        then = time.time()
+        response = yield self.generator.client.fetch(request,
+                                                     raise_error=False)
+        if keep_body and response.body is not None:
+            received[0] = len(response.body)
+        self.stats.record(endpoint, time.time() - then, response.code,
+                          received[0])
+        if response.code != 200:
+            self.logger.debug("Destination %d: %s %s" % (
+                self.number, response.code, url))
+            raise gen.Return(None)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def fetch_sitemap(self, endpoint, url):
+        """Fetches a document; the entries of an index are replaced by
+        those of its sitemaps"""
+        response = yield self.fetch(endpoint, url)
+        if response is None:
+            raise gen.Return(None)
+        sitemap = Sitemap.parse(response.body)
+        if sitemap.is_index:
+            entries = []
+            for (loc, md) in sitemap.entries:
+                if not self.generator.running:
+                    break
+                page = yield self.fetch_sitemap(endpoint, loc)
+                if page is not None:
+                    entries.extend(page.entries)
+            sitemap.entries = entries
+        raise gen.Return(sitemap)
+
+    @gen.coroutine
+    def fetch_resources(self, urls):
+        """Fetches the resources with up to parallel requests at once;
+        returns False if the run ended first"""
+        if self.generator.max_fetch >= 0:
+            urls = urls[:self.generator.max_fetch]
+        pending = collections.deque(urls)
+
+        @gen.coroutine
+        def worker():
+            while pending and self.generator.running:
+                yield self.fetch('resource', pending.popleft(),
+                                 keep_body=False)
+        yield [worker() for i in range(self.generator.parallel)]
+        raise gen.Return(len(pending) == 0)
+
+    @gen.coroutine
+    def discover(self):
+        """Finds the capabilities via the source description; returns
+        False if that failed"""
+        description = yield self.fetch_sitemap(
+            'description', self.generator.url + SOURCE_DESCRIPTION_PATH)
+        if description is None or len(description.entries) == 0:
+            raise gen.Return(False)
+        capability_list = yield self.fetch_sitemap(
+            'capabilitylist', description.entries[0][0])
+        if capability_list is None:
+            raise gen.Return(False)
+        self.capabilities = dict((md.get('capability'), loc)
+                                 for (loc, md) in capability_list.entries)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def baseline_sync(self):
+        resource_list = yield self.fetch_sitemap(
+            'resourcelist', self.capabilities['resourcelist'])
+        if resource_list is None:
+            return
+        # the following incremental syncs start from the resource list
+        if resource_list.md_at is not None:
+            self.md_until = resource_list.md_at
+        complete = yield self.fetch_resources([loc for (loc, md)
+                                               in resource_list.entries])
+        if complete:
+            self.stats.syncs['baseline'] += 1
+
+    @gen.coroutine
+    def incremental_sync(self):
+        url = self.capabilities['changelist']
+        if self.md_until is not None:
+            url += "?" + urllib.urlencode({'from': self.md_until})
+        change_list = yield self.fetch_sitemap('changelist', url)
+        if change_list is None:
+            return
+        if change_list.md_until is not None:
+            self.md_until = change_list.md_until
+        complete = yield self.fetch_resources(
+            [loc for (loc, md) in change_list.entries
+             if md.get('change') != 'deleted'])
+        if complete:
+            self.stats.syncs['incremental'] += 1
+
+    @gen.coroutine
+    def run(self):
+        generator = self.generator
+        found = yield self.discover()
+        if not found:
+            self.logger.warning("Destination %d: discovery failed" %
+                                self.number)
+            return
+        pattern = generator.pattern
+        if pattern != 'baseline' and 'changelist' not in self.capabilities:
+            self.logger.warning("Destination %d: the source has no change "
+                                "list, syncing baselines only" % self.number)
+            pattern = 'baseline'
+        if pattern == 'incremental':
+            self.md_until = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                          time.gmtime())
+        elif generator.running:
+            yield self.baseline_sync()
+        # spread the polls of the destinations over the interval
+        delay = random.uniform(0, generator.poll_interval)
+        while generator.running:
+            yield generator.sleep(delay)
+            if not generator.running:
+                break
+            then = time.time()
+            if pattern == 'baseline':
+                yield self.baseline_sync()
+            else:
+                yield self.incremental_sync()
+            delay = max(0, generator.poll_interval - (time.time() - then))
+
+
+class LoadGenerator(object):
+    """Runs destinations concurrent destinations against the simulator at
+    url for duration seconds"""
+
+    def __init__(self, url, destinations=10, duration=60.0, pattern='full',
+                 poll_interval=10.0, parallel=1, max_fetch=-1,
+                 ramp_up=0.0, timeout=60.0):
+        if pattern not in PATTERNS:
+            raise ValueError("Unknown pattern %s" % pattern)
+        self.url = url.rstrip('/')
+        self.destinations = destinations
+        self.duration = duration
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.parallel = parallel
+        self.max_fetch = max_fetch
+        self.ramp_up = ramp_up
+        self.timeout = timeout
+        self.logger = logging.getLogger('loadgen')
+        self.stats = Stats()
+        self.client = None
+        self.deadline = None
+
+    @property
+    def running(self):
+        return time.time() < self.deadline
+
+    @gen.coroutine
+    def sleep(self, seconds):
+        """Sleeps seconds, but not beyond the deadline"""
+        yield gen.sleep(max(0, min(seconds, self.deadline - time.time())))
+
+    @gen.coroutine
+    def run(self):
+        """Runs the destinations and returns the stats"""
+        # one connection per possible request, so that requests aren't
+        # queued (and timed) in the client
+        self.client = AsyncHTTPClient(
+            force_instance=True,
+            max_clients=self.destinations * self.parallel,
+            max_body_size=2 ** 40)
+        self.stats = Stats()
+        self.deadline = self.stats.started + self.duration
+        self.logger.info("Running %d destinations (%s) against %s for %ss" %
+                         (self.destinations, self.pattern, self.url,
+                          self.duration))
+        try:
+            yield [self.start_destination(number)
+                   for number in range(self.destinations)]
+        finally:
+            self.client.close()
+        raise gen.Return(self.stats)
+
+    @gen.coroutine
+    def start_destination(self, number):
+        if self.destinations > 1:
+            yield self.sleep(self.ramp_up * number / (self.destinations - 1))
+        if self.running:
+            yield Destination(self, number).run()
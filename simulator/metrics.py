@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+metrics.py: Live metrics of the simulator, served at /metrics.
+
+The source counts change events and the HTTP interface records request
+latencies and document generation times. Gauges (resources, change memory
+occupancy, memory usage, dispatcher queue) are read from the source when
+the metrics are collected. Metrics are rendered in the Prometheus text
+exposition format or as JSON.
+
+Event counts are kept in a ctypes structure, which a SharedArrayRepository
+holds in shared memory, so that worker processes report the events
+counted by the simulating process.
+"""
+
+import os
+import time
+import ctypes
+import bisect
+import resource
+import threading
+import collections
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_WINDOW = 10  # seconds over which event rates are averaged
+CHANGE_TYPES = ('created', 'updated', 'deleted')
+CHANGE_INDEXES = dict((change, index)
+                      for (index, change) in enumerate(CHANGE_TYPES))
+DISPATCHER_COUNTERS = (('enqueued', "Events queued by the dispatcher"),
+                       ('delivered', "Events delivered by the dispatcher"),
+                       ('dropped', "Events dropped by the dispatcher"),
+                       ('coalesced', "Events coalesced by the dispatcher"),
+                       ('batches', "Batches delivered by the dispatcher"))
+
+
+def rss_bytes():
+    """The resident set size of this process (the peak size if the
+    current one isn't available)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class EventCounts(ctypes.Structure):
+    """Change events per type in total and per second of the last
+    RATE_WINDOW seconds, in a ring of slots indexed by the second"""
+    _fields_ = [('totals', ctypes.c_uint64 * len(CHANGE_TYPES)),
+                ('seconds', ctypes.c_int64 * (RATE_WINDOW + 1)),
+                ('recent', (ctypes.c_uint64 * len(CHANGE_TYPES)) *
+                 (RATE_WINDOW + 1))]
+
+
+class Histogram(object):
+    """Counts observations in buckets with the given upper bounds, plus
+    one for larger values"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        """The count, sum and cumulative bucket counts (Prometheus style,
+        the last bound is '+Inf')"""
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        cumulative = []
+        total = 0
+        for (bound, count) in zip(bounds, self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Metrics(object):
+    """Collects the metrics of a source and its HTTP interface; safe to
+    update from the simulation and the HTTP threads"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()  # {(handler, code), count}
+        self.latencies = {}  # {handler, Histogram}
+        self.generation_times = {}  # {document, Histogram}
+        # replaced by the shared counts of a SharedArrayRepository (see
+        # Source.add_repository)
+        self.event_counts = EventCounts()
+
+    def observe_request(self, handler, code, seconds):
+        with self._lock:
+            self.requests[(handler, code)] += 1
+            if handler not in self.latencies:
+                self.latencies[handler] = Histogram()
+            self.latencies[handler].observe(seconds)
+
+    def observe_generation(self, document, seconds):
+        with self._lock:
+            if document not in self.generation_times:
+                self.generation_times[document] = Histogram()
+            self.generation_times[document].observe(seconds)
+
+    @property
+    def event_counts(self):
+        return self._event_counts
+
+    @event_counts.setter
+    def event_counts(self, event_counts):
+        self._event_counts = event_counts
+        # each access to a field of a ctypes structure creates an object
+        self._totals = event_counts.totals
+        self._seconds = event_counts.seconds
+        self._recent = list(event_counts.recent)
+
+    def count_event(self, change):
+        """Counts a change event of the given type (e.g., 'created')"""
+        index = CHANGE_INDEXES[change]
+        second = int(time.time())
+        slot = second % (RATE_WINDOW + 1)
+        recent = self._recent[slot]
+        with self._lock:
+            self._totals[index] += 1
+            if self._seconds[slot] != second:
+                ctypes.memset(recent, 0, ctypes.sizeof(recent))
+                self._seconds[slot] = second
+            recent[index] += 1
+
+    @property
+    def events(self):
+        """Events per change type"""
+        totals = self.event_counts.totals
+        return dict((change, totals[index])
+                    for (index, change) in enumerate(CHANGE_TYPES))
+
+    def event_rates(self):
+        """Events per second and change type, averaged over the last
+        RATE_WINDOW complete seconds"""
+        second = int(time.time())
+        counts = self.event_counts
+        rates = dict((change, 0.0) for change in CHANGE_TYPES)
+        for slot in range(RATE_WINDOW + 1):
+            if second - RATE_WINDOW <= counts.seconds[slot] < second:
+                recent = counts.recent[slot]
+                for (index, change) in enumerate(CHANGE_TYPES):
+                    rates[change] += recent[index] / float(RATE_WINDOW)
+        return rates
+
+    def collect(self, source):
+        """All metrics as a dict"""
+        with self._lock:
+            metrics = {
+                'start_time': self.started,
+                'requests': [{'handler': handler, 'code': code,
+                              'count': count}
+                             for ((handler, code), count)
+                             in sorted(self.requests.items())],
+                'request_latency': dict(
+                    (handler, histogram.as_dict())
+                    for (handler, histogram) in self.latencies.items()),
+                'generation_time': dict(
+                    (document, histogram.as_dict())
+                    for (document, histogram)
+                    in self.generation_times.items())}
+        metrics['events'] = self.events
+        metrics['events_per_second'] = self.event_rates()
+        metrics['resources'] = source.resource_count
+        metrics['repository_bytes'] = source._repository.size_in_bytes
+        metrics['version'] = source.version
+        metrics['rss_bytes'] = rss_bytes()
+        if source.has_changememory:
+            metrics['changememory'] = {
+                'changes': source.changememory.change_count,
+                'max_changes': source.changememory.max_changes or None}
+        if source.dispatcher is not None:
+            metrics['dispatcher'] = source.dispatcher.stats
+        return metrics
+
+    def prometheus(self, source):
+        """All metrics in the Prometheus text exposition format"""
+        metrics = self.collect(source)
+        lines = []
+
+        def header(name, kind, text):
+            lines.append("# HELP simulator_%s %s" % (name, text))
+            lines.append("# TYPE simulator_%s %s" % (name, kind))
+
+        def sample(name, value, **labels):
+            if labels:
+                name += "{%s}" % ",".join(
+                    '%s="%s"' % (key, escape(labels[key]))
+                    for key in sorted(labels))
+            lines.append("simulator_%s %s" % (name, number(value)))
+
+        def histograms(name, label, values):
+            for key in sorted(values):
+                histogram = values[key]
+                for (bound, count) in histogram['buckets']:
+                    sample(name + "_bucket", count, le=bound,
+                           **{label: key})
+                sample(name + "_sum", histogram['sum'], **{label: key})
+                sample(name + "_count", histogram['count'], **{label: key})
+
+        header("start_time_seconds", "gauge", "Start time of the process")
+        sample("start_time_seconds", metrics['start_time'])
+        header("http_requests_total", "counter",
+               "HTTP requests by handler and status code")
+        for request in metrics['requests']:
+            sample("http_requests_total", request['count'],
+                   handler=request['handler'], code=request['code'])
+        header("http_request_duration_seconds", "histogram",
+               "HTTP request latency by handler")
+        histograms("http_request_duration_seconds", 'handler',
+                   metrics['request_latency'])
+        header("document_generation_seconds", "histogram",
+               "Time to generate a document that wasn't cached, by handler")
+        histograms("document_generation_seconds", 'document',
+                   metrics['generation_time'])
+        header("events_total", "counter", "Change events by type")
+        for (change, count) in sorted(metrics['events'].items()):
+            sample("events_total", count, type=change)
+        header("events_per_second", "gauge",
+               "Change events per second by type, averaged over %d "
+               "seconds" % RATE_WINDOW)
+        for (change, rate) in sorted(metrics['events_per_second'].items()):
+            sample("events_per_second", rate, type=change)
+        header("resources", "gauge", "Resources in the repository")
+        sample("resources", metrics['resources'])
+        header("repository_bytes", "gauge",
+               "Estimated memory footprint of the repository")
+        sample("repository_bytes", metrics['repository_bytes'])
+        header("version", "gauge", "Version counter of the source documents")
+        sample("version", metrics['version'])
+        header("resident_memory_bytes", "gauge",
+               "Resident set size of the process")
+        sample("resident_memory_bytes", metrics['rss_bytes'])
+        if 'changememory' in metrics:
+            header("changememory_changes", "gauge",
+                   "Changes held by the change memory")
+            sample("changememory_changes",
+                   metrics['changememory']['changes'])
+            if metrics['changememory']['max_changes'] is not None:
+                header("changememory_max_changes", "gauge",
+                       "Capacity of the change memory")
+                sample("changememory_max_changes",
+                       metrics['changememory']['max_changes'])
+        if 'dispatcher' in metrics:
+            stats = metrics['dispatcher']
+            header("dispatcher_queue_depth", "gauge", "Queued events")
+            sample("dispatcher_queue_depth", stats['depth'])
+            for (name, text) in DISPATCHER_COUNTERS:
+                header("dispatcher_%s_total" % name, "counter", text)
+                sample("dispatcher_%s_total" % name, stats[name])
+        return "\n".join(lines) + "\n"
+
+
+def number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape(value):
+    """Escapes a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
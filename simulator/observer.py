@@ -7,6 +7,14 @@ Copyright 2012, ResourceSync.org. All rights reserved.
 
 """
 
+import time
+import logging
+import threading
+import collections
+
+import tornado.ioloop
+
+
 class Observer(object):
     """Observers are informed about events"""
     
@@ -16,18 +24,235 @@ class Observer(object):
     def notify(self, event):
         pass
 
+    def notify_batch(self, events):
+        """Informs about several events at once; observers that can handle
+        batches more efficiently should override this"""
+        for event in events:
+            self.notify(event)
+
 
 class Observable(object):
     """Observable subjects issue events and nofiy registered Observers"""
     
     def __init__(self):
         self.observers = []
+        self.dispatcher = None  # delivers events asynchronously if set
     
     def register_observer(self, observer):
         self.observers.append(observer)
         
+    def set_dispatcher(self, dispatcher):
+        """Delivers events through an asynchronous dispatcher instead of
+        notifying observers directly"""
+        self.dispatcher = dispatcher
+
     def notify_observers(self, event):
         """Notifies observers about change events"""
+        if self.dispatcher is not None:
+            self.dispatcher.put([event])
+            return
         for observer in self.observers:
             observer.notify(event)
-        
\ No newline at end of file
+
+    def notify_observers_batch(self, events):
+        """Notifies observers about a batch of change events"""
+        if self.dispatcher is not None:
+            self.dispatcher.put(events)
+            return
+        self.deliver_batch(events)
+
+    def deliver_batch(self, events):
+        """Delivers a batch of events to all observers"""
+        for observer in self.observers:
+            observer.notify_batch(events)
+        self.batch_delivered(events)
+
+    def batch_delivered(self, events):
+        """Called after the observers received a batch of events"""
+        pass
+
+
+class AsyncDispatcher(object):
+    """Queues the events of an observable and delivers them to its
+    observers in batches of up to batch_size events, either on a worker
+    thread (mode: thread) or on the Tornado IOLoop (mode: ioloop).
+
+    The queue holds up to max_queue events. When it is full, the policy
+    decides what happens to new events:
+
+    block -- the producer waits until there is space again
+    drop -- new events are dropped
+    coalesce -- an event replaces the queued event of the same resource
+        (a queued creation stays a creation; a creation followed by a
+        deletion cancels out); events of other resources wait as in block
+
+    Events are coalesced whenever possible under the coalesce policy, not
+    only if the queue is full. Don't use the block or coalesce policies
+    with the ioloop mode if events are produced on the IOLoop itself.
+    """
+
+    POLICIES = ('block', 'drop', 'coalesce')
+
+    def __init__(self, observable, config):
+        self.observable = observable
+        self.config = config
+        self.mode = config.get('mode', 'thread')
+        self.policy = config.get('policy', 'block')
+        if self.policy not in self.POLICIES:
+            raise ValueError("Unknown dispatcher policy %s" % self.policy)
+        self.max_queue = config.get('max_queue', 10000)
+        self.batch_size = config.get('batch_size', 1000)
+        self.logger = logging.getLogger('dispatcher')
+        self._queue = collections.OrderedDict()  # {key, event}
+        self._sequence = 0  # keys of events that aren't coalesced
+        self._condition = threading.Condition()
+        self._delivering = False
+        self._stopped = False
+        # metrics
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.max_depth = 0
+        if self.mode == 'thread':
+            self._worker = threading.Thread(target=self._run,
+                                            name="dispatcher")
+            self._worker.daemon = True
+            self._worker.start()
+        elif self.mode == 'ioloop':
+            self._ioloop = tornado.ioloop.IOLoop.instance()
+        else:
+            raise ValueError("Unknown dispatcher mode %s" % self.mode)
+
+    @property
+    def depth(self):
+        """The number of queued events"""
+        return len(self._queue)
+
+    @property
+    def stats(self):
+        """Queue depth and throughput metrics"""
+        return {'depth': self.depth, 'max_depth': self.max_depth,
+                'enqueued': self.enqueued, 'delivered': self.delivered,
+                'dropped': self.dropped, 'coalesced': self.coalesced,
+                'batches': self.batches}
+
+    ##### Producer side #####
+
+    def put(self, events):
+        """Queues events according to the policy"""
+        with self._condition:
+            for event in events:
+                self._put(event)
+            self._wake()
+
+    def _wake(self):
+        """Makes sure queued events will be delivered"""
+        self.max_depth = max(self.max_depth, len(self._queue))
+        if len(self._queue) == 0:
+            return
+        if self.mode == 'thread':
+            self._condition.notify_all()
+        elif not self._delivering:
+            self._delivering = True
+            self._ioloop.add_callback(self._deliver_on_ioloop)
+
+    def _put(self, event):
+        if self.policy == 'coalesce':
+            queued = self._queue.get(event.uri)
+            if queued is not None:
+                self._coalesce(queued, event)
+                return
+        if len(self._queue) >= self.max_queue:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            self._wake()
+            while len(self._queue) >= self.max_queue and not self._stopped:
+                self._condition.wait()
+        self.enqueued += 1
+        if self.policy == 'coalesce':
+            self._queue[event.uri] = event
+        else:
+            self._sequence += 1
+            self._queue[self._sequence] = event
+
+    def _coalesce(self, queued, event):
+        """Replaces a queued event with a newer event of the same resource"""
+        self.coalesced += 1
+        del self._queue[event.uri]
+        if queued.change == "created" and event.change == "deleted":
+            return
+        if queued.change == "created":
+            event.change = "created"
+        self._queue[event.uri] = event
+
+    ##### Consumer side #####
+
+    def _take(self):
+        """Removes and returns the next batch of events"""
+        batch = []
+        while len(self._queue) > 0 and len(batch) < self.batch_size:
+            batch.append(self._queue.popitem(last=False)[1])
+        self._condition.notify_all()  # wake up blocked producers
+        return batch
+
+    def _deliver(self, batch):
+        try:
+            self.observable.deliver_batch(batch)
+        except Exception:
+            self.logger.exception("Failed to deliver %d events" % len(batch))
+        self.delivered += len(batch)
+        self.batches += 1
+
+    def _run(self):
+        """Delivers batches on the worker thread"""
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._stopped:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    return
+                batch = self._take()
+                self._delivering = True
+            self._deliver(batch)
+            with self._condition:
+                self._delivering = False
+                self._condition.notify_all()
+
+    def _deliver_on_ioloop(self):
+        """Delivers one batch on the IOLoop and reschedules itself while
+        events are queued"""
+        with self._condition:
+            batch = self._take()
+        self._deliver(batch)
+        with self._condition:
+            if len(self._queue) > 0:
+                self._ioloop.add_callback(self._deliver_on_ioloop)
+            else:
+                self._delivering = False
+                self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Waits until all queued events were delivered; returns False on
+        timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while len(self._queue) > 0 or self._delivering:
+                if deadline is None:
+                    self._condition.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self._condition.wait(deadline - time.time())
+        return True
+
+    def stop(self):
+        """Stops the worker thread after the queued events were
+        delivered"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self.mode == 'thread':
+            self._worker.join()
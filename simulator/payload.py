@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+payload.py: Generation of the dummy payloads of simulated resources.
+
+The payload of a resource is its basename repeated to fill the resource's
+length, padded with "x" characters (e.g., "1212x" for basename "12" and
+length 5). Since the payload is periodic, any byte range of it can be
+served as slices of one precomputed buffer per basename instead of
+building the whole payload.
+"""
+
+import re
+
+
+class PayloadEngine(object):
+    """Yields payloads as memoryview slices of a repeating buffer.
+
+    Payloads larger than chunk_size are sliced from buffers holding the
+    basename repeated to about chunk_size bytes, which are kept for up to
+    max_buffers basenames.
+    """
+
+    def __init__(self, chunk_size=65536, max_buffers=64):
+        self.chunk_size = chunk_size
+        self.max_buffers = max_buffers
+        self._buffers = {}  # basename -> repeating buffer
+
+    def _buffer(self, basename):
+        """The repeating buffer of a basename; its length is a multiple of
+        the basename length"""
+        buf = self._buffers.get(basename)
+        if buf is None:
+            repetitions = max(1, self.chunk_size // len(basename))
+            buf = memoryview(basename * repetitions)
+            if len(self._buffers) >= self.max_buffers:
+                self._buffers.clear()
+            self._buffers[basename] = buf
+        return buf
+
+    def chunks(self, basename, length, start=0, stop=None):
+        """Yields the bytes start to stop (exclusive) of the payload of a
+        resource in chunks of at most chunk_size bytes"""
+        basename = basename.encode('ascii')  # URL arguments are unicode
+        if stop is None or stop > length:
+            stop = length
+        if length <= self.chunk_size:
+            # small payloads are cheaper to build than to look up
+            if start < stop:
+                yield memoryview(self.payload(basename, length))[start:stop]
+            return
+        period = len(basename)
+        repeated = length - length % period  # end of the repeated part
+        buf = self._buffer(basename)
+        position = start
+        while position < min(stop, repeated):
+            offset = position % period
+            end = min(stop, repeated, position + len(buf) - offset)
+            yield buf[offset:offset + end - position]
+            position = end
+        if position < stop:
+            yield memoryview(b"x" * (stop - position))
+
+    def payload(self, basename, length):
+        """The complete payload of a resource as a string"""
+        basename = basename.encode('ascii')
+        period = len(basename)
+        return basename * (length // period) + b"x" * (length % period)
+
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def byte_range(header, length):
+    """Parses an HTTP Range header for a body of the given length.
+
+    Returns a (start, stop) tuple with stop exclusive, or None if the whole
+    body should be sent (no header, multiple or malformed ranges). Raises a
+    ValueError if the range can't be satisfied.
+    """
+    if header is None:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    (first, last) = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # suffix range: the last bytes of the body
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        return (max(0, length - suffix), length)
+    start = int(first)
+    stop = length if last == "" else min(length, int(last) + 1)
+    if last != "" and int(last) < start:
+        return None
+    if start >= length:
+        raise ValueError("Range starts after the end of the body")
+    return (start, stop)
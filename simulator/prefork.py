@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+prefork.py: Serving the HTTP interface of a source from several processes.
+
+The simulating process forks worker processes that accept connections on
+shared sockets. The workers serve from the repository and change memory
+of the simulating process: the SharedArrayRepository lives in shared
+memory and the PersistentChangeList is read from its files, so neither is
+copied.
+"""
+
+import os
+import signal
+import random
+import logging
+
+import tornado.ioloop
+import tornado.netutil
+
+
+def check_shareable(source):
+    """Raises a ValueError if the source can't be served by workers"""
+    if getattr(source._repository, 'state', None) is None:
+        raise ValueError("Workers require the SharedArrayRepository")
+    if source.has_changememory:
+        changememory = source.changememory
+        if not hasattr(changememory, 'follow'):
+            raise ValueError("Workers require the PersistentChangeList "
+                             "(or no change memory)")
+        if changememory.archive is not None:
+            raise ValueError("Workers don't support change list archives")
+    if source.has_resource_list_builder:
+        builder = source.resource_list_builder
+        if (builder.config['class'] != "DynamicResourceListBuilder" or
+                builder.paged):
+            raise ValueError("Workers require an unpaged "
+                             "DynamicResourceListBuilder")
+    if (source.dispatcher is not None and
+            source.dispatcher.mode != 'thread'):
+        raise ValueError("Workers require a dispatcher in thread mode")
+
+
+class WorkerPool(object):
+    """Forks worker processes that serve an HTTPInterface on a shared
+    port while the calling process simulates the source.
+
+    Workers only read the source; caches (e.g., the response cache) are
+    kept per worker. They are stopped with SIGTERM; Ctrl-C is left to the
+    simulating process, which stops the workers.
+    """
+
+    def __init__(self, http_interface, workers):
+        self.http_interface = http_interface
+        self.source = http_interface.source
+        self.workers = workers
+        self.pids = []
+        self.logger = logging.getLogger('prefork')
+
+    def start(self):
+        """Binds the port and forks the workers"""
+        check_shareable(self.source)
+        if tornado.ioloop.IOLoop.initialized():
+            raise RuntimeError("Cannot fork workers after the IOLoop was "
+                               "created")
+        sockets = tornado.netutil.bind_sockets(self.source.port)
+        for number in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(number, sockets)
+            self.pids.append(pid)
+        for sock in sockets:
+            sock.close()  # the simulating process doesn't accept
+        self.logger.info("Started %d workers: %s" % (self.workers,
+                                                      self.pids))
+
+    def _run_worker(self, number, sockets):
+        """Serves requests until SIGTERM; never returns"""
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self._terminate)
+            random.seed()  # don't repeat the other processes' choices
+            if self.source.has_changememory:
+                self.source.changememory.follow()
+            self.logger.info("Worker %d serving" % number)
+            self.http_interface.serve(sockets=sockets)
+        except Exception:
+            self.logger.exception("Worker %d failed" % number)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _terminate(self, signum, frame):
+        tornado.ioloop.IOLoop.instance().add_callback_from_signal(
+            self.http_interface._shutdown)
+
+    def stop(self):
+        """Stops the workers and waits for them to exit"""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already exited
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+profiler.py: On-demand sampling profiler for all threads of the simulator.
+
+While it runs, a background thread records the Python stacks of all other
+threads (the simulation, the HTTP interface's IOLoop, the dispatcher)
+every interval seconds. Time spent waiting for locks or I/O shows up in
+the waiting frames. Nothing is hooked into the profiled code, so there is
+no overhead while the profiler is stopped.
+
+Results are available as collapsed stacks (one "thread;frame;...;frame
+count" line per stack, the input of flamegraph.pl and speedscope) or as
+pstats statistics. In pstats, call counts are sample counts and times are
+sample counts times the interval.
+"""
+
+import os
+import sys
+import time
+import pstats
+import logging
+import marshal
+import threading
+import collections
+from StringIO import StringIO
+
+
+class Profiler(object):
+    """Samples the stacks of all threads while it runs"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.logger = logging.getLogger('profiler')
+        self.samples = collections.Counter()  # {(thread, stack), count}
+        self.sample_count = 0
+        self.started = None
+        self.stopped = None
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, seconds=None, interval=None, path=None):
+        """Starts sampling, for the given number of seconds if set, and
+        forgets previous samples. If path is set, the result is saved
+        there once the profiler stops."""
+        with self._lock:
+            if self._running:
+                raise ValueError("The profiler is already running")
+            if interval is not None:
+                self.interval = interval
+            self.samples = collections.Counter()
+            self.sample_count = 0
+            self.started = time.time()
+            self.stopped = None
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            args=(seconds, path),
+                                            name="profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        self.logger.info("Profiling every %.3fs%s" % (
+            self.interval, "" if seconds is None else " for %ss" % seconds))
+
+    def stop(self):
+        """Stops sampling and waits for the sampling thread to end"""
+        with self._lock:
+            self._running = False
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, seconds, path):
+        deadline = None if seconds is None else time.time() + seconds
+        own = threading.current_thread().ident
+        while self._running:
+            if deadline is not None and time.time() >= deadline:
+                break
+            self._sample(own)
+            time.sleep(self.interval)
+        self._running = False
+        self.stopped = time.time()
+        self.logger.info("Profiled %d samples in %.1fs" % (
+            self.sample_count, self.stopped - self.started))
+        if path is not None:
+            self.save(path)
+
+    def _sample(self, own):
+        names = dict((thread.ident, thread.name)
+                     for thread in threading.enumerate())
+        stacks = []
+        for (ident, frame) in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                              code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            stacks.append((names.get(ident, str(ident)), tuple(stack)))
+        with self._lock:
+            for key in stacks:
+                self.samples[key] += 1
+            self.sample_count += 1
+
+    def _samples(self):
+        """A copy of the samples taken so far"""
+        with self._lock:
+            return dict(self.samples)
+
+    ##### Results #####
+
+    def collapsed(self):
+        """The samples as collapsed stacks, the root frame first"""
+        lines = []
+        for ((thread, stack), count) in sorted(self._samples().items()):
+            frames = [thread] + ["%s (%s:%d)" % (name,
+                                                 os.path.basename(filename),
+                                                 line)
+                                 for (filename, line, name) in stack]
+            lines.append("%s %d" % (";".join(frames), count))
+        return "\n".join(lines) + "\n"
+
+    def create_stats(self):
+        """Builds the pstats statistics of the samples (called by
+        pstats.Stats)"""
+        calls = collections.Counter()  # samples with the function on stack
+        own = collections.Counter()  # samples with the function on top
+        callers = collections.defaultdict(collections.Counter)
+        for ((thread, stack), count) in self._samples().items():
+            for function in set(stack):
+                calls[function] += count
+            if stack:
+                own[stack[-1]] += count
+            for edge in set(zip(stack, stack[1:])):
+                callers[edge[1]][edge[0]] += count
+        interval = self.interval
+        self.stats = {}
+        for (function, count) in calls.items():
+            self.stats[function] = (
+                count, count, own[function] * interval, count * interval,
+                dict((caller, (number, number, 0.0, number * interval))
+                     for (caller, number) in callers[function].items()))
+
+    def dump_stats(self):
+        """The pstats statistics in the format of pstats.Stats.dump_stats"""
+        self.create_stats()
+        return marshal.dumps(self.stats)
+
+    def report(self, limit=50):
+        """The limit functions with the highest cumulative time as text"""
+        stream = StringIO()
+        stats = pstats.Stats(self, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def save(self, path):
+        """Saves the result; as pstats if path ends with .prof or
+        .pstats, as collapsed stacks otherwise"""
+        if os.path.splitext(path)[1] in ('.prof', '.pstats'):
+            with open(path, 'wb') as output:
+                output.write(self.dump_stats())
+        else:
+            with open(path, 'w') as output:
+                output.write(self.collapsed())
+        self.logger.info("Saved profile to %s" % path)
+
+    def status(self):
+        return {'running': self.running, 'started': self.started,
+                'stopped': self.stopped, 'interval': self.interval,
+                'samples': self.sample_count}
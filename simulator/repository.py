@@ -0,0 +1,718 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+repository.py: Storage implementations for the resources held by a source.
+
+A repository maps resource basenames (e.g., "1") to resource records, which
+are dicts with the keys 'timestamp', 'length', 'md5' and 'sha256'. All
+implementations behave like a dict so that the source can use them
+interchangeably. They also keep an indexed list of their basenames so that
+random resources can be picked in constant time, using the module's
+generator or a given random.Random (e.g., a seeded one).
+
+Readers on other threads (e.g., the HTTP interface) take snapshots, which
+are consistent point-in-time views of a repository that keeps changing.
+
+For bulk loading (bootstrap, snapshot files), the records of an empty
+repository can be loaded from and dumped to columns indexed by integer
+basename: a dict with 'high' (the highest basename + 1), 'live' (a
+bytearray flagging the existing basenames), 'timestamps' (an array of
+doubles), 'lengths' (an array of unsigned ints) and 'md5' and 'sha-256'
+(concatenated raw digests, or None).
+"""
+
+import sys
+import time
+import mmap
+import ctypes
+import random
+import base64
+import weakref
+import itertools
+import threading
+from array import array
+
+from simulator.metrics import EventCounts
+
+try:
+    import numpy
+except ImportError:  # optional; speeds up bulk loading
+    numpy = None
+
+DIGEST_SIZES = {'md5': 16, 'sha-256': 32}
+
+
+def live_slots(live):
+    """The positions of the non-zero bytes of a bytearray, as an array of
+    unsigned ints"""
+    if numpy is not None:
+        slots = numpy.flatnonzero(numpy.frombuffer(bytes(live), numpy.uint8))
+        return array('I', slots.astype(numpy.uint32).tostring())
+    return array('I', [slot for slot in xrange(len(live)) if live[slot]])
+
+
+class Snapshot(object):
+    """A point-in-time view of a repository.
+
+    Taking a snapshot only copies the basenames. While the snapshot is
+    open, the repository saves the record of a basename before it is
+    first changed (copy-on-write), so the snapshot keeps seeing the
+    records as they were when it was taken. Close snapshots when done;
+    each open snapshot adds a little work to every change.
+    """
+
+    def __init__(self, repository, basenames, count, version):
+        self.repository = repository
+        self.basenames = basenames  # iterable of the basenames at version
+        self.count = count
+        self.version = version  # number of changes of the repository
+        self.timestamp = time.time()
+        self._saved = {}  # {basename, record before the change or None}
+
+    def __len__(self):
+        return self.count
+
+    def get(self, basename):
+        """The record of a basename at the time of the snapshot or None"""
+        try:
+            record = self.repository[basename]
+        except KeyError:
+            record = None
+        # Records are saved before they change, so a change that raced
+        # with the lookup above is caught here
+        if basename in self._saved:
+            return self._saved[basename]
+        return record
+
+    def __iter__(self):
+        """Iterates over the (basename, record) pairs of the snapshot"""
+        for basename in self.basenames:
+            record = self.get(basename)
+            if record is not None:
+                yield (basename, record)
+
+    def close(self):
+        self.repository.release_snapshot(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotSupport(object):
+    """Snapshots for repository implementations. Changes must call
+    _changing() with the write lock held before they modify a record."""
+
+    def _init_snapshots(self):
+        self.version = 0  # number of changes
+        self._snapshots = []  # weak references to the open snapshots
+        self._write_lock = threading.Lock()
+
+    def snapshot(self):
+        """Takes a Snapshot of the current state"""
+        with self._write_lock:
+            snapshot = Snapshot(self, self._snapshot_basenames(), len(self),
+                                self.version)
+            self._snapshots.append(weakref.ref(snapshot))
+        return snapshot
+
+    def release_snapshot(self, snapshot):
+        """Stops saving records for a snapshot"""
+        with self._write_lock:
+            self._snapshots = [ref for ref in self._snapshots
+                               if ref() not in (None, snapshot)]
+
+    @property
+    def open_snapshots(self):
+        return len([ref for ref in self._snapshots if ref() is not None])
+
+    def _changing(self, basename):
+        """Saves the current record of a basename for the open snapshots
+        that don't have it yet"""
+        self.version += 1
+        if len(self._snapshots) == 0:
+            return
+        record = None
+        released = False
+        for ref in self._snapshots:
+            snapshot = ref()
+            if snapshot is None:
+                released = True  # garbage collected without close()
+            elif basename not in snapshot._saved:
+                if record is None:
+                    record = self.get(basename)
+                snapshot._saved[basename] = record
+        if released:
+            self._snapshots = [ref for ref in self._snapshots
+                               if ref() is not None]
+
+
+class DictRepository(dict, SnapshotSupport):
+    """The default repository: a dict of basenames and record dicts.
+
+    Simple and flexible, but every resource costs a dict, a key string and
+    several boxed values.
+    """
+
+    def __init__(self, source=None, config=None):
+        super(DictRepository, self).__init__()
+        self.config = config or {}
+        self._basenames = []  # all basenames, in no particular order
+        self._positions = {}  # basename -> position in _basenames
+        self._init_snapshots()
+
+    def __setitem__(self, basename, record):
+        with self._write_lock:
+            self._changing(basename)
+            if basename not in self._positions:
+                self._positions[basename] = len(self._basenames)
+                self._basenames.append(basename)
+            super(DictRepository, self).__setitem__(basename, record)
+
+    def __delitem__(self, basename):
+        with self._write_lock:
+            if basename in self:
+                self._changing(basename)
+            super(DictRepository, self).__delitem__(basename)
+            # Swap the last basename into the freed position
+            position = self._positions.pop(basename)
+            last = self._basenames.pop()
+            if position < len(self._basenames):
+                self._basenames[position] = last
+                self._positions[last] = position
+
+    # The other mutating dict methods go through __setitem__ and
+    # __delitem__, which keep the basename index and snapshots in sync
+
+    def pop(self, basename, *default):
+        if basename not in self:
+            if default:
+                return default[0]
+            raise KeyError(basename)
+        record = dict.__getitem__(self, basename)
+        del self[basename]
+        return record
+
+    def popitem(self):
+        if len(self._basenames) == 0:
+            raise KeyError("popitem(): repository is empty")
+        basename = self._basenames[-1]
+        return (basename, self.pop(basename))
+
+    def setdefault(self, basename, record=None):
+        if basename not in self:
+            self[basename] = record
+        return dict.__getitem__(self, basename)
+
+    def update(self, *args, **kwargs):
+        for (basename, record) in dict(*args, **kwargs).items():
+            self[basename] = record
+
+    def clear(self):
+        for basename in list(self._basenames):
+            del self[basename]
+
+    def _snapshot_basenames(self):
+        return dict.keys(self)
+
+    def load_columns(self, columns):
+        """Loads records from columns into the empty repository"""
+        live = columns['live']
+        timestamps = columns['timestamps']
+        lengths = columns['lengths']
+        md5s = columns.get('md5')
+        sha256s = columns.get('sha-256')
+        with self._write_lock:
+            for slot in live_slots(live):
+                basename = str(slot)
+                md5 = sha256 = None
+                if md5s is not None:
+                    md5 = base64.b64encode(md5s[slot * 16:(slot + 1) * 16])
+                if sha256s is not None:
+                    sha256 = base64.b64encode(
+                        sha256s[slot * 32:(slot + 1) * 32])
+                self._positions[basename] = len(self._basenames)
+                self._basenames.append(basename)
+                dict.__setitem__(self, basename,
+                                 {'timestamp': timestamps[slot],
+                                  'length': lengths[slot],
+                                  'md5': md5, 'sha256': sha256})
+            self.version += 1
+
+    def dump_columns(self, fixity):
+        """The records as columns; basenames must be integers"""
+        high = max([int(basename) for basename in self] or [-1]) + 1
+        columns = {'high': high, 'live': bytearray(high),
+                   'timestamps': array('d', [0.0]) * high,
+                   'lengths': array('I', [0]) * high}
+        for name in fixity:
+            columns[name] = bytearray(high * DIGEST_SIZES[name])
+        for (basename, record) in self.items():
+            slot = int(basename)
+            columns['live'][slot] = 1
+            columns['timestamps'][slot] = record['timestamp']
+            columns['lengths'][slot] = record['length']
+            for (name, key) in (('md5', 'md5'), ('sha-256', 'sha256')):
+                if name in columns and record.get(key) is not None:
+                    size = DIGEST_SIZES[name]
+                    columns[name][slot * size:(slot + 1) * size] = \
+                        base64.b64decode(record[key])
+        for name in fixity:
+            columns[name] = bytes(columns[name])
+        return columns
+
+    def random_keys(self, number=1, generator=random):
+        """A random sample of number basenames, at most all basenames"""
+        basenames = self._basenames
+        number = min(number, len(basenames))
+        return [basenames[position] for position in
+                generator.sample(xrange(len(basenames)), number)]
+
+    def random_key(self, generator=random):
+        """A single random basename or None if the repository is empty"""
+        if len(self._basenames) == 0:
+            return None
+        return generator.choice(self._basenames)
+
+    @property
+    def size_in_bytes(self):
+        """Estimated memory footprint, based on a sample of records"""
+        size = sys.getsizeof(self)
+        sample = list(itertools.islice(self.iteritems(), 100))
+        if len(sample) == 0:
+            return size
+        sample_size = 0
+        for (basename, record) in sample:
+            sample_size += sys.getsizeof(basename) + sys.getsizeof(record)
+            for value in record.values():
+                sample_size += sys.getsizeof(value)
+        return size + sample_size * len(self) / len(sample)
+
+    @property
+    def bytes_per_resource(self):
+        """Estimated memory footprint per stored resource"""
+        if len(self) == 0:
+            return 0
+        return self.size_in_bytes / len(self)
+
+
+class ArrayRepository(SnapshotSupport):
+    """A compact, columnar repository for very large sources.
+
+    Basenames must be integers, which are used directly as slot ids into
+    parallel typed arrays holding timestamp, length, raw digest bytes and a
+    liveness flag. Costs about 40 bytes per resource (MD5 only) instead of
+    several hundred for the DictRepository.
+    """
+
+    DIGEST_SIZES = DIGEST_SIZES
+
+    def __init__(self, source=None, config=None):
+        self.config = config or {}
+        fixity = ['md5'] if source is None else source.fixity
+        self.capacity = 0
+        self.count = 0
+        self.timestamps = array('d')
+        self.lengths = array('I')
+        self.live = array('B')
+        self.positions = array('I')  # slot -> position in slots
+        self.slots = array('I')  # live slots, in no particular order
+        self.md5s = bytearray() if 'md5' in fixity else None
+        self.sha256s = bytearray() if 'sha-256' in fixity else None
+        self._grow(self.config.get('initial_capacity', 1024))
+        self._init_snapshots()
+
+    def _grow(self, capacity):
+        """Extends all columns to hold at least capacity slots"""
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.timestamps.extend(array('d', [0.0]) * extra)
+        self.lengths.extend(array('I', [0]) * extra)
+        self.live.extend(array('B', [0]) * extra)
+        self.positions.extend(array('I', [0]) * extra)
+        if self.md5s is not None:
+            self.md5s.extend(bytearray(extra * self.DIGEST_SIZES['md5']))
+        if self.sha256s is not None:
+            self.sha256s.extend(bytearray(extra * self.DIGEST_SIZES['sha-256']))
+        self.capacity = capacity
+
+    def _slot(self, basename):
+        """The slot id of a basename or None if it can't be stored here"""
+        try:
+            slot = int(basename)
+        except (TypeError, ValueError):
+            return None
+        if slot < 0:
+            return None
+        return slot
+
+    def _live_slot(self, basename):
+        slot = self._slot(basename)
+        if slot is None or slot >= self.capacity or not self.live[slot]:
+            raise KeyError(basename)
+        return slot
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, basename):
+        slot = self._slot(basename)
+        return (slot is not None and slot < self.capacity and
+                bool(self.live[slot]))
+
+    def __getitem__(self, basename):
+        slot = self._live_slot(basename)
+        return {'timestamp': self.timestamps[slot],
+                'length': self.lengths[slot],
+                'md5': self._get_digest(self.md5s, 'md5', slot),
+                'sha256': self._get_digest(self.sha256s, 'sha-256', slot)}
+
+    def __setitem__(self, basename, record):
+        slot = self._slot(basename)
+        if slot is None:
+            raise KeyError("ArrayRepository requires integer basenames, "
+                           "got %s" % repr(basename))
+        with self._write_lock:
+            self._changing(basename)
+            self._set(slot, record)
+
+    def _set(self, slot, record):
+        if slot >= self.capacity:
+            self._grow(max(slot + 1, 2 * self.capacity))
+        self.timestamps[slot] = record['timestamp']
+        self.lengths[slot] = record['length']
+        self._set_digest(self.md5s, 'md5', slot, record.get('md5'))
+        self._set_digest(self.sha256s, 'sha-256', slot, record.get('sha256'))
+        if not self.live[slot]:
+            self.live[slot] = 1
+            self.positions[slot] = len(self.slots)
+            self.slots.append(slot)
+            self.count += 1
+
+    def __delitem__(self, basename):
+        with self._write_lock:
+            slot = self._live_slot(basename)
+            self._changing(basename)
+            self._delete(slot)
+
+    def _delete(self, slot):
+        self.live[slot] = 0
+        self.count -= 1
+        # Swap the last live slot into the freed position
+        position = self.positions[slot]
+        last = self.slots.pop()
+        if position < len(self.slots):
+            self.slots[position] = last
+            self.positions[last] = position
+
+    def random_keys(self, number=1, generator=random):
+        """A random sample of number basenames, at most all basenames"""
+        slots = self.slots
+        number = min(number, len(slots))
+        return [str(slots[position]) for position in
+                generator.sample(xrange(len(slots)), number)]
+
+    def random_key(self, generator=random):
+        """A single random basename or None if the repository is empty"""
+        if len(self.slots) == 0:
+            return None
+        return str(generator.choice(self.slots))
+
+    def __iter__(self):
+        live = self.live
+        for slot in xrange(self.capacity):
+            if live[slot]:
+                yield str(slot)
+
+    def keys(self):
+        return list(iter(self))
+
+    def _snapshot_basenames(self):
+        live = self.live[:]
+        return (str(slot) for slot in xrange(len(live)) if live[slot])
+
+    def load_columns(self, columns):
+        """Loads records from columns into the empty repository, copying
+        whole columns"""
+        high = columns['high']
+        with self._write_lock:
+            if high > self.capacity:
+                self._grow(high)
+            self.timestamps[0:high] = columns['timestamps']
+            self.lengths[0:high] = columns['lengths']
+            self.live[0:high] = array('B', bytes(columns['live']))
+            for (column, name) in ((self.md5s, 'md5'),
+                                   (self.sha256s, 'sha-256')):
+                if column is not None and columns.get(name) is not None:
+                    column[0:len(columns[name])] = columns[name]
+            self.slots = live_slots(columns['live'])
+            for (position, slot) in enumerate(self.slots):
+                self.positions[slot] = position
+            self.count = len(self.slots)
+            self.version += 1
+
+    def dump_columns(self, fixity):
+        """The records as columns"""
+        high = (max(self.slots) + 1) if len(self.slots) > 0 else 0
+        columns = {'high': high, 'live': bytearray(self.live[0:high]),
+                   'timestamps': self.timestamps[0:high],
+                   'lengths': self.lengths[0:high]}
+        for (column, name) in ((self.md5s, 'md5'), (self.sha256s, 'sha-256')):
+            if name in fixity and column is not None:
+                columns[name] = bytes(column[0:high * DIGEST_SIZES[name]])
+        return columns
+
+    def iterkeys(self):
+        return iter(self)
+
+    def get(self, basename, default=None):
+        try:
+            return self[basename]
+        except KeyError:
+            return default
+
+    def _get_digest(self, column, name, slot):
+        if column is None:
+            return None
+        size = self.DIGEST_SIZES[name]
+        return base64.b64encode(bytes(column[slot * size:(slot + 1) * size]))
+
+    def _set_digest(self, column, name, slot, digest):
+        if column is None or digest is None:
+            return
+        size = self.DIGEST_SIZES[name]
+        column[slot * size:(slot + 1) * size] = base64.b64decode(digest)
+
+    @property
+    def size_in_bytes(self):
+        """Memory footprint of all columns"""
+        size = 0
+        for column in (self.timestamps, self.lengths, self.live,
+                       self.positions, self.slots):
+            size += column.buffer_info()[1] * column.itemsize
+        for column in (self.md5s, self.sha256s):
+            if column is not None:
+                size += len(column)
+        return size
+
+    @property
+    def bytes_per_resource(self):
+        """Memory footprint per stored resource"""
+        if self.count == 0:
+            return 0
+        return self.size_in_bytes / self.count
+
+    def __repr__(self):
+        return "<ArrayRepository: %d resources in %d slots>" % (
+            self.count, self.capacity)
+
+
+class SharedArrayRepository(ArrayRepository):
+    """An ArrayRepository in shared memory, for serving a source from
+    several processes.
+
+    All columns are ctypes arrays in one anonymous shared mmap. Worker
+    processes forked after the repository was created read the records
+    written by the simulating process from the same memory, without
+    copying them. The capacity (the highest resource id + 1) is therefore
+    fixed; it defaults to four times the number of bootstrapped resources.
+
+    Each slot has a sequence number that is odd while the slot is written
+    (a seqlock), so that readers in other processes retry instead of
+    returning a torn record. The header also holds the version, the last
+    modification time, the next resource id and the event counts of the
+    source, which the source keeps there instead of in its own attributes
+    (see Source.add_repository).
+
+    Snapshots taken in the simulating process are point-in-time views as
+    for the other repositories; in other processes every record of a
+    snapshot is consistent, but the snapshot includes changes made while
+    it is iterated.
+    """
+
+    class Header(ctypes.Structure):
+        _fields_ = [('count', ctypes.c_uint64),  # live slots
+                    ('high', ctypes.c_uint64),  # highest slot ever used + 1
+                    ('version', ctypes.c_uint64),
+                    ('last_modified', ctypes.c_double),
+                    ('max_res_id', ctypes.c_uint64),
+                    ('events', EventCounts)]  # counted by the source
+
+    def __init__(self, source=None, config=None):
+        self.config = config or {}
+        fixity = ['md5'] if source is None else source.fixity
+        capacity = self.config.get('capacity')
+        if capacity is None:
+            capacity = 1024
+            if source is not None:
+                capacity = max(capacity,
+                               4 * source.config['number_of_resources'])
+        self.capacity = capacity
+        columns = [('timestamps', ctypes.c_double, 1),
+                   ('lengths', ctypes.c_uint32, 1),
+                   ('live', ctypes.c_uint8, 1),
+                   ('sequences', ctypes.c_uint32, 1),
+                   ('positions', ctypes.c_uint32, 1),  # slot -> position
+                   ('slots', ctypes.c_uint32, 1)]  # live slots
+        for name in ('md5', 'sha-256'):
+            if name in fixity:
+                columns.append((name, ctypes.c_char, self.DIGEST_SIZES[name]))
+        # Lay out the header and the columns, aligned to 8 bytes
+        offsets = {}
+        size = ctypes.sizeof(self.Header)
+        for (name, ctype, width) in columns:
+            offsets[name] = size
+            size += ctypes.sizeof(ctype) * width * capacity
+            size = (size + 7) // 8 * 8
+        self._mmap = mmap.mmap(-1, size)  # anonymous, MAP_SHARED
+        self._live_offset = offsets['live']
+        self.header = self.Header.from_buffer(self._mmap, 0)
+        for (name, ctype, width) in columns:
+            column = (ctype * (width * capacity)).from_buffer(
+                self._mmap, offsets[name])
+            setattr(self, {'md5': 'md5s', 'sha-256': 'sha256s'}.get(name, name),
+                    column)
+        if 'md5' not in fixity:
+            self.md5s = None
+        if 'sha-256' not in fixity:
+            self.sha256s = None
+        self._init_snapshots()
+
+    @property
+    def state(self):
+        """The shared version, last_modified and max_res_id of the source"""
+        return self.header
+
+    @property
+    def count(self):
+        return self.header.count
+
+    def _grow(self, capacity):
+        raise ValueError("SharedArrayRepository is full (capacity %d); "
+                         "configure a larger capacity" % self.capacity)
+
+    def has_room(self, basename):
+        """Returns True if a resource with basename can be stored; ids are
+        not reused, so once the highest id reaches the capacity no more
+        resources can be created"""
+        slot = self._slot(basename)
+        return slot is not None and slot < self.capacity
+
+    def __getitem__(self, basename):
+        slot = self._live_slot(basename)
+        sequences = self.sequences
+        while True:
+            sequence = sequences[slot]
+            if sequence & 1:
+                continue  # being written
+            record = super(SharedArrayRepository, self).__getitem__(basename)
+            if sequences[slot] == sequence:
+                return record
+
+    def _set(self, slot, record):
+        if slot >= self.capacity:
+            self._grow(slot + 1)
+        header = self.header
+        self.sequences[slot] += 1
+        self.timestamps[slot] = record['timestamp']
+        self.lengths[slot] = record['length']
+        self._set_digest(self.md5s, 'md5', slot, record.get('md5'))
+        self._set_digest(self.sha256s, 'sha-256', slot, record.get('sha256'))
+        self.sequences[slot] += 1
+        if not self.live[slot]:
+            self.live[slot] = 1
+            self.positions[slot] = header.count
+            self.slots[header.count] = slot
+            header.count += 1
+            header.high = max(header.high, slot + 1)
+
+    def _delete(self, slot):
+        header = self.header
+        self.live[slot] = 0
+        # Swap the last live slot into the freed position
+        header.count -= 1
+        position = self.positions[slot]
+        last = self.slots[header.count]
+        if position < header.count:
+            self.slots[position] = last
+            self.positions[last] = position
+
+    def random_keys(self, number=1, generator=random):
+        """A random sample of number basenames, at most all basenames; in
+        processes other than the simulating one they may have just been
+        deleted"""
+        count = self.header.count
+        number = min(number, count)
+        return [str(self.slots[position]) for position in
+                generator.sample(xrange(count), number)]
+
+    def random_key(self, generator=random):
+        count = self.header.count
+        if count == 0:
+            return None
+        return str(self.slots[generator.randrange(count)])
+
+    def __iter__(self):
+        live = self.live
+        for slot in xrange(self.header.high):
+            if live[slot]:
+                yield str(slot)
+
+    def _snapshot_basenames(self):
+        high = self.header.high
+        live = bytearray(self._mmap[self._live_offset:self._live_offset + high])
+        return (str(slot) for slot in xrange(high) if live[slot])
+
+    def _copy(self, column, data):
+        """Copies a string or array into the start of a column"""
+        if isinstance(data, array):
+            data = data.tostring()
+        ctypes.memmove(column, bytes(data), len(data))
+
+    def load_columns(self, columns):
+        """Loads records from columns into the empty repository, copying
+        whole columns into shared memory"""
+        high = columns['high']
+        with self._write_lock:
+            if high > self.capacity:
+                self._grow(high)
+            self._copy(self.timestamps, columns['timestamps'])
+            self._copy(self.lengths, columns['lengths'])
+            for (column, name) in ((self.md5s, 'md5'),
+                                   (self.sha256s, 'sha-256')):
+                if column is not None and columns.get(name) is not None:
+                    self._copy(column, columns[name])
+            slots = live_slots(columns['live'])
+            self._copy(self.slots, slots)
+            for (position, slot) in enumerate(slots):
+                self.positions[slot] = position
+            self.header.count = len(slots)
+            self.header.high = high
+            # Publish the records last
+            self._copy(self.live, columns['live'])
+            self.version += 1
+
+    def dump_columns(self, fixity):
+        """The records as columns"""
+        high = self.header.high
+        columns = {'high': high,
+                   'live': bytearray(self._mmap[self._live_offset:
+                                                self._live_offset + high]),
+                   'timestamps': array('d', self.timestamps[0:high]),
+                   'lengths': array('I', self.lengths[0:high])}
+        for (column, name) in ((self.md5s, 'md5'), (self.sha256s, 'sha-256')):
+            if name in fixity and column is not None:
+                columns[name] = column[0:high * DIGEST_SIZES[name]]
+        return columns
+
+    @property
+    def size_in_bytes(self):
+        """Size of the shared memory"""
+        return len(self._mmap)
+
+    def __repr__(self):
+        return "<SharedArrayRepository: %d resources in %d slots>" % (
+            self.count, self.capacity)
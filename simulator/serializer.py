@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+serializer.py: Incremental serialization of ResourceSync sitemap documents.
+
+resync's as_xml() builds one element tree and one string for a whole
+document. The functions here produce the same XML piece by piece so that
+large documents can be written out while the resources are iterated.
+
+Entries of the fixed shape the simulator produces (<loc>, <lastmod> and an
+<rs:md> with change, hash and length) are formatted directly as strings,
+byte for byte like the element tree, without building elements. Entries
+can also be written straight from repository records (RecordSerializer),
+without creating Resource objects.
+"""
+
+import sys
+import math
+from datetime import datetime
+from xml.etree.ElementTree import tostring
+
+from resync.sitemap import Sitemap
+from resync.list_base_with_index import ListBaseIndexError
+
+LASTMOD_CACHE_SIZE = 100000  # whole seconds with a cached date and time
+# resync keeps these in Resource._extra; they are written to <rs:md>
+MD_EXTRAS = ('capability', 'ts_at', 'ts_completed', 'ts_from', 'ts_until')
+
+_lastmod_seconds = {}  # {whole second, "YYYY-MM-DDThh:mm:ss"}
+
+
+class _Preamble(object):
+    """The top-level <rs:ln> and <rs:md> of a resource container, without
+    any resources"""
+
+    def __init__(self, resources):
+        self.ln = resources.ln
+        self.md = resources.md
+
+    def __iter__(self):
+        return iter([])
+
+
+def sitemap_head(resources, sitemapindex=False):
+    """Returns the XML declaration, root start tag and the <rs:ln>/<rs:md>
+    elements of a resource container"""
+    root_element = ('sitemapindex' if sitemapindex else 'urlset')
+    xml = Sitemap().resources_as_xml(_Preamble(resources),
+                                     sitemapindex=sitemapindex)
+    if xml.endswith(" />"):
+        return xml[:-3] + ">"
+    return xml[:-len("</%s>" % root_element)]
+
+
+def sitemap_tail(sitemapindex=False):
+    """Returns the root end tag"""
+    return ("</sitemapindex>" if sitemapindex else "</urlset>")
+
+
+def sitemap_entry(resource, sitemap=None, sitemapindex=False):
+    """Returns the <url> (or <sitemap>) element of a single resource"""
+    if sitemap is None:
+        sitemap = Sitemap()
+    item_element = ('sitemap' if sitemapindex else 'url')
+    element = sitemap.resource_etree_element(resource,
+                                             element_name=item_element)
+    return tostring(element, encoding='utf-8')
+
+
+def lastmod(timestamp):
+    """Formats a timestamp like resync's datetime_to_str (the W3C datetime
+    in UTC, with microseconds unless there are none); the date and time of
+    recent whole seconds are cached"""
+    # Rounded to microseconds the way datetime.utcfromtimestamp does
+    second = int(timestamp)
+    microseconds = timestamp - second
+    microseconds = int(math.floor(microseconds * 1e6 + 0.5)
+                       if microseconds >= 0.0
+                       else math.ceil(microseconds * 1e6 - 0.5))
+    if microseconds < 0:
+        second -= 1
+        microseconds += 1000000
+    if microseconds == 1000000:
+        second += 1
+        microseconds = 0
+    prefix = _lastmod_seconds.get(second)
+    if prefix is None:
+        if len(_lastmod_seconds) >= LASTMOD_CACHE_SIZE:
+            _lastmod_seconds.clear()
+        prefix = datetime.utcfromtimestamp(second).isoformat()
+        _lastmod_seconds[second] = prefix
+    if microseconds:
+        return "%s.%06dZ" % (prefix, microseconds)
+    return prefix + "Z"
+
+
+def escape_text(text):
+    """Escapes element text like ElementTree"""
+    if "&" in text or "<" in text or ">" in text:
+        text = text.replace("&", "&amp;").replace("<", "&lt;") \
+            .replace(">", "&gt;")
+    return text
+
+
+def escape_attribute(text):
+    """Escapes an attribute value like ElementTree"""
+    if "&" in text or "<" in text or ">" in text or '"' in text or \
+            "\n" in text:
+        text = text.replace("&", "&amp;").replace("<", "&lt;") \
+            .replace(">", "&gt;").replace('"', "&quot;") \
+            .replace("\n", "&#10;")
+    return text
+
+
+def url_entry(loc, timestamp=None, change=None, md5=None, sha256=None,
+              length=None):
+    """Returns a <url> element; loc must be escaped already"""
+    xml = "<url><loc>" + loc + "</loc>"
+    if timestamp is not None:
+        xml += "<lastmod>" + lastmod(timestamp) + "</lastmod>"
+    # <rs:md> attributes in ElementTree's (sorted) order
+    md = ""
+    if change is not None:
+        md += ' change="' + change + '"'
+    if md5 is not None:
+        md += ' hash="md5:' + escape_attribute(md5)
+        if sha256 is not None:
+            md += " sha-256:" + escape_attribute(sha256)
+        md += '"'
+    elif sha256 is not None:
+        md += ' hash="sha-256:' + escape_attribute(sha256) + '"'
+    if length is not None:
+        md += ' length="' + escape_attribute(str(length)) + '"'
+    if md:
+        xml += "<rs:md" + md + " />"
+    return xml + "</url>"
+
+
+def resource_entry(resource, sitemap=None):
+    """Returns the <url> element of a resource like sitemap_entry. Resources
+    with attributes the simulator doesn't set (e.g., links, a path or a
+    capability) are passed to sitemap_entry."""
+    extra = resource._extra
+    if resource.ln is not None or resource.path is not None or \
+            resource.mime_type is not None or resource.sha1 is not None or \
+            not isinstance(resource.uri, str) or \
+            (extra and any(extra.get(key) is not None
+                           for key in MD_EXTRAS)):
+        return sitemap_entry(resource, sitemap)
+    return url_entry(escape_text(resource.uri), resource.timestamp,
+                     resource.change, resource.md5, resource.sha256,
+                     resource.length)
+
+
+def check_single_file(resources):
+    """Raises ListBaseIndexError like as_xml() if a list has too many
+    entries for a single document"""
+    if hasattr(resources, 'requires_multifile') and \
+            resources.requires_multifile():
+        raise ListBaseIndexError(
+            "Attempt to write single XML string for list with %d entries "
+            "when max_sitemap_entries is set to %d" %
+            (len(resources), resources.max_sitemap_entries))
+
+
+def sitemap_chunks(resources, chunk_size=1000, sitemapindex=False):
+    """Yields the XML of a resource container (e.g., a ResourceList) in
+    chunks of at most chunk_size entries.
+
+    The concatenated chunks are identical to resources.as_xml() but the
+    resources are only iterated, never held in memory at once.
+    """
+    resources.default_capability()
+    sitemap = Sitemap()
+    chunk = [sitemap_head(resources, sitemapindex)]
+    for resource in resources:
+        if sitemapindex:
+            chunk.append(sitemap_entry(resource, sitemap, sitemapindex))
+        else:
+            chunk.append(resource_entry(resource, sitemap))
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append(sitemap_tail(sitemapindex))
+    yield "".join(chunk)
+
+
+def sitemap_xml(resources):
+    """Returns the same XML as resources.as_xml()"""
+    check_single_file(resources)
+    return "".join(sitemap_chunks(resources, chunk_size=sys.maxsize,
+                                  sitemapindex=resources.sitemapindex))
+
+
+class RecordSerializer(object):
+    """Writes the entries of resources straight from their repository
+    records (see simulator.repository); the resource URIs are uri_prefix
+    followed by the basename"""
+
+    def __init__(self, uri_prefix):
+        self.uri_prefix = escape_text(uri_prefix)
+
+    def entry(self, basename, record):
+        """Returns the <url> element of a resource"""
+        return url_entry(self.uri_prefix + basename, record['timestamp'],
+                         None, record['md5'], record['sha256'],
+                         record['length'])
+
+    def chunks(self, resources, records, chunk_size=1000):
+        """Like sitemap_chunks; resources is an empty resource container
+        with the document's metadata and links, records iterates over
+        (basename, record) pairs"""
+        resources.default_capability()
+        entry = self.entry
+        chunk = [sitemap_head(resources)]
+        for (basename, record) in records:
+            chunk.append(entry(basename, record))
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append(sitemap_tail())
+        yield "".join(chunk)
+
+    def as_xml(self, resources, records):
+        """Like sitemap_xml, for records"""
+        check_single_file(resources)
+        return "".join(self.chunks(resources, records, chunk_size=sys.maxsize))
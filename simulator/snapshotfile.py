@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+snapshotfile.py: Saving a source to a file and restoring it at startup.
+
+A snapshot file holds the repository as columns (see simulator.repository)
+and the changes of an in-memory change memory, so that large sources can
+be restored in seconds instead of being bootstrapped again. The file
+starts with a magic line and the length of a JSON header, which describes
+the source (including the configuration it was bootstrapped with) and the
+offsets of the sections that follow:
+
+    live        one byte per resource id, 1 if the resource exists
+    timestamps  one double per resource id
+    lengths     one unsigned int per resource id
+    md5         16 raw bytes per resource id (if md5 is in the fixity)
+    sha-256     32 raw bytes per resource id (if sha-256 is in the fixity)
+    changes     marshalled change records
+
+Sections are copied from a memory mapping of the file straight into the
+repository's columns. The PersistentChangeList keeps its own files, so
+its changes are not saved.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import marshal
+
+from simulator.resource import Resource
+from simulator.changememory import PersistentChangeList
+
+from array import array
+
+MAGIC = b"ResourceSync Simulator snapshot 1\n"
+LENGTH = struct.Struct('<Q')  # length of the JSON header
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def save(source, path):
+    """Writes the source's repository and change memory to a file; the
+    file is replaced atomically"""
+    columns = source._repository.dump_columns(source.fixity)
+    sections = [('live', bytes(columns['live'])),
+                ('timestamps', columns['timestamps'].tostring()),
+                ('lengths', columns['lengths'].tostring())]
+    for name in source.fixity:
+        sections.append((name, bytes(columns[name])))
+    changememory = source.changememory
+    last_changeid = 0
+    if (changememory is not None and
+            not isinstance(changememory, PersistentChangeList)):
+        last_changeid = changememory.last_changeid
+        records = [(change.changeid, change.uri, change.timestamp,
+                    change.change, change.length, change.md5, change.sha256)
+                   for change in changememory.changes]
+        sections.append(('changes', marshal.dumps(records)))
+    header = {'fixity': source.fixity,
+              'number_of_resources': source.config['number_of_resources'],
+              'average_payload': source.config['average_payload'],
+              'byteorder': sys.byteorder,
+              'high': columns['high'],
+              'count': source.resource_count,
+              'version': source.version,
+              'last_modified': source.last_modified,
+              'max_res_id': source.max_res_id,
+              'last_changeid': last_changeid,
+              'sections': {}}
+    offset = 0  # relative to the start of the sections
+    for (name, data) in sections:
+        header['sections'][name] = [offset, len(data)]
+        offset = _align(offset + len(data))
+    header = json.dumps(header)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(MAGIC + LENGTH.pack(len(header)) + header)
+        for (name, data) in sections:
+            snapshot.write(b"\0" * (_align(snapshot.tell()) -
+                                    snapshot.tell()))
+            snapshot.write(data)
+    os.rename(tmp_path, path)
+
+
+def restore(source, path):
+    """Loads the repository and change memory of an empty source from a
+    file written by save()"""
+    if source.resource_count > 0:
+        raise ValueError("Cannot restore into a non-empty repository")
+    with open(path, 'rb') as snapshot:
+        data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[0:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a snapshot file" % path)
+        length = LENGTH.unpack_from(data, len(MAGIC))[0]
+        position = len(MAGIC) + LENGTH.size
+        header = json.loads(data[position:position + length])
+        start = _align(position + length)
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("%s was saved on another platform" % path)
+        if list(header['fixity']) != list(source.fixity):
+            raise ValueError("%s was saved with fixity %s" %
+                             (path, header['fixity']))
+        for name in ('number_of_resources', 'average_payload'):
+            if header.get(name) != source.config[name]:
+                raise ValueError("%s was saved with %s %s" %
+                                 (path, name, header.get(name)))
+
+        def section(name):
+            if name not in header['sections']:
+                return None
+            (offset, size) = header['sections'][name]
+            return data[start + offset:start + offset + size]
+
+        columns = {'high': header['high'],
+                   'live': bytearray(section('live')),
+                   'timestamps': array('d', section('timestamps')),
+                   'lengths': array('I', section('lengths'))}
+        for name in source.fixity:
+            columns[name] = section(name)
+        source._repository.load_columns(columns)
+        source.version = header['version']
+        source.last_modified = header['last_modified']
+        source.max_res_id = header['max_res_id']
+        changes = section('changes')
+        if changes is not None and source.has_changememory:
+            resources = []
+            for (changeid, uri, timestamp, change, length, md5, sha256) in \
+                    marshal.loads(changes):
+                resource = Resource(uri=uri, timestamp=timestamp,
+                                    change=change, length=length, md5=md5,
+                                    sha256=sha256)
+                resource.changeid = changeid
+                resources.append(resource)
+            source.changememory.changes = resources
+            source.changememory.last_changeid = header['last_changeid']
+    finally:
+        data.close()
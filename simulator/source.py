@@ -10,31 +10,98 @@ Created by Bernhard Haslhofer on 2012-04-24.
 """
 
 import os
+import re
 import random
 import pprint
 import logging
 import time
+import base64
+import hashlib
+import math
+import threading
+from array import array
 
-from resync.utils import compute_md5_for_string
-from resync.resource_list import ResourceList
+import tornado.ioloop
 
-from simulator.observer import Observable
+try:
+    import numpy
+except ImportError:  # optional; speeds up the bootstrap
+    numpy = None
+
+from resync.resource_list import ResourceList, ResourceListOrdered
+
+from simulator.observer import Observer, Observable
 from simulator.resource import Resource
+from simulator.repository import DictRepository, DIGEST_SIZES
+from simulator.payload import PayloadEngine
+from simulator import snapshotfile
+from simulator.trace import TraceWriter, TraceReader
+from simulator.metrics import Metrics
+from simulator.serializer import sitemap_head, sitemap_tail, RecordSerializer
+
+
+def compute_sha256_for_string(string):
+    """Compute SHA-256 digest over some string payload (base64 encoded like
+    resync's MD5 digests)"""
+    return base64.b64encode(hashlib.sha256(string).digest())
+
+def poisson(expected, generator=random):
+    """A random number of events from a Poisson distribution with the given
+    expected value (normal approximation for large expected values)"""
+    if expected <= 0:
+        return 0
+    if expected > 50:
+        return max(0, int(round(generator.gauss(expected,
+                                                math.sqrt(expected)))))
+    limit = math.exp(-expected)
+    number = 0
+    product = generator.random()
+    while product > limit:
+        number += 1
+        product *= generator.random()
+    return number
+
+def random_lengths(number, maximum, generator=random):
+    """An array of number random payload lengths between 0 and maximum; a
+    NumPy generator, if used, is seeded from the given generator"""
+    if numpy is not None:
+        state = numpy.random.RandomState(generator.getrandbits(32))
+        lengths = state.randint(0, maximum + 1, number)
+        return array('I', lengths.astype(numpy.uint32).tostring())
+    randint = generator.randint
+    return array('I', [randint(0, maximum) for i in xrange(number)])
 
 #### Source-specific capability implementations ####
 
 
-class DynamicResourceListBuilder(object):
-    """Generates an resource_list snapshot from a source"""
+class DynamicResourceListBuilder(Observer):
+    """Generates an resource_list snapshot from a source
+
+    If page_size is configured, the resource list is published as a
+    resource list index pointing to pages of page_size resource ids each
+    (e.g., resourcelist-00001.xml). Rendered pages are cached until one of
+    their resources changes.
+    """
 
     def __init__(self, source, config):
         self.source = source
         self.config = config
         self.logger = logging.getLogger('resource_list_builder')
+        self.page_size = config.get('page_size')
+        self.page_count = 0
+        self._page_cache = {}  # {page number, xml}
+        self._page_versions = {}  # {page number, number of changes}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        if self.paged:
+            source.register_observer(self)
 
     def bootstrap(self):
-        """Bootstrapping procedures implemented in subclasses"""
-        pass
+        """Determines the number of pages after the source is bootstrapped"""
+        if self.paged:
+            for basename in self.source._repository.keys():
+                self.page_count = max(self.page_count,
+                                      self.page_number(basename))
 
     @property
     def path(self):
@@ -46,21 +113,227 @@ class DynamicResourceListBuilder(object):
         """The resource_list URI (e.g., http://localhost:8080/resourcelist.xml)"""
         return self.source.base_uri + "/" + self.path
 
+    @property
+    def streaming(self):
+        """True if resource lists should be written out in chunks"""
+        return bool(self.config.get('streaming', False))
+
+    @property
+    def chunk_size(self):
+        """The number of resources serialized per streamed chunk"""
+        return self.config.get('chunk_size', 1000)
+
     def generate(self):
-        """Generates an resource_list (snapshot from the source)"""
+        """Generates an resource_list (snapshot from the source). The
+        resources are iterated from a repository snapshot, so the list is
+        consistent as of its md_at time even if the source keeps
+        changing."""
         then = time.time()
-        resource_list = ResourceList(resources=self.source.resources, count=self.source.resource_count)
+        snapshot = self.source.snapshot()
+        resource_list = ResourceList(
+            resources=self.source.snapshot_resources(snapshot),
+            count=len(snapshot))
+        resource_list.md_at = min(snapshot.timestamp,
+                                  self.source.delivered_until)
         now = time.time()
         self.logger.info("Generated resource_list: %f" % (now-then))
         return resource_list
 
+    def generate_records(self):
+        """Like generate(), but returns an empty resource_list with the
+        metadata and an iterator over the (basename, record) pairs of the
+        snapshot, to be serialized with the source's RecordSerializer"""
+        then = time.time()
+        snapshot = self.source.snapshot()
+        resource_list = ResourceList(count=len(snapshot))
+        resource_list.md_at = min(snapshot.timestamp,
+                                  self.source.delivered_until)
+        now = time.time()
+        self.logger.info("Generated resource_list: %f" % (now-then))
+        return (resource_list, self.source.snapshot_records(snapshot))
+
+    ##### Resource list pages #####
+
+    @property
+    def paged(self):
+        """True if the resource list is split into pages"""
+        return bool(self.page_size)
+
+    def page_number(self, basename):
+        """The number of the page listing a resource (starting at 1)"""
+        return int(basename) // self.page_size + 1
+
+    def page_path(self, page_number):
+        """The path of a page (e.g., resourcelist-00001.xml)"""
+        (root, ext) = os.path.splitext(self.path)
+        return "%s-%05d%s" % (root, page_number, ext)
+
+    def page_uri(self, page_number):
+        """The URI of a page"""
+        return self.source.base_uri + "/" + self.page_path(page_number)
+
+    @property
+    def page_path_pattern(self):
+        """Regular expression matching the page paths; the page number is
+        the first group"""
+        (root, ext) = os.path.splitext(self.path)
+        return re.escape(root) + r"-([0-9]+)" + re.escape(ext)
+
+    def page_records(self, page_number):
+        """Iterates over the (basename, record) pairs listed in a page"""
+        first = (page_number - 1) * self.page_size
+        repository = self.source._repository
+        for res_id in xrange(first, first + self.page_size):
+            basename = str(res_id)
+            record = repository.get(basename)
+            if record is not None:
+                yield (basename, record)
+
+    def page_resources(self, page_number):
+        """Iterates over the resources listed in a page"""
+        for (basename, record) in self.page_records(page_number):
+            yield self.source._resource(basename, record)
+
+    def generate_index(self):
+        """Generates the resource list index pointing to all pages"""
+        index = ResourceList(resources_class=ResourceListOrdered)
+        index.sitemapindex = True
+        index.describedby = self.source.describedby_uri
+        index.up = self.source.capability_list_uri
+        index.md_at = self.source.delivered_until
+        for page_number in range(1, self.page_count + 1):
+            index.add(Resource(uri=self.page_uri(page_number)))
+        return index.as_xml()
+
+    def generate_page(self, page_number):
+        """Returns the XML of a page, from the cache if none of its resources
+        changed since it was last rendered. Returns None if there is no such
+        page."""
+        if page_number < 1 or page_number > self.page_count:
+            return None
+        xml = self._page_cache.get(page_number)
+        if xml is not None:
+            self.cache_hits += 1
+            return xml
+        self.cache_misses += 1
+        version = self._page_versions.get(page_number, 0)
+        then = time.time()
+        records = list(self.page_records(page_number))
+        resource_list = ResourceList(count=len(records))
+        resource_list.describedby = self.source.describedby_uri
+        resource_list.up = self.source.capability_list_uri
+        resource_list.link_set('index', self.uri)
+        resource_list.md_at = self.source.delivered_until
+        xml = self.source.serializer.as_xml(resource_list, records)
+        # Don't cache the page if it changed while it was being rendered
+        if self._page_versions.get(page_number, 0) == version:
+            self._page_cache[page_number] = xml
+        self.logger.info("Generated resource_list page %d: %f" %
+                         (page_number, time.time() - then))
+        return xml
+
+    def notify(self, change):
+        """Invalidates the cached page of a changed resource"""
+        page_number = self.page_number(change.basename)
+        self._page_versions[page_number] = \
+            self._page_versions.get(page_number, 0) + 1
+        self._page_cache.pop(page_number, None)
+        if page_number > self.page_count:
+            self.page_count = page_number
+
+
+class IncrementalResourceListBuilder(DynamicResourceListBuilder):
+    """Keeps a pre-serialized <url> element for each resource and patches
+    only those touched by change events.
+
+    Elements are grouped into buckets of bucket_size consecutive resource
+    ids. Each bucket caches its concatenated XML, so generating a resource
+    list re-joins only the buckets that changed since the last request.
+    """
+
+    def __init__(self, source, config):
+        super(IncrementalResourceListBuilder, self).__init__(source, config)
+        self.bucket_size = config.get('bucket_size', 1000)
+        self._buckets = {}  # {bucket number, {basename, xml}}
+        self._bucket_versions = {}  # {bucket number, number of changes}
+        self._bucket_xml = {}  # {bucket number, (version, xml)}
+        source.register_observer(self)
+
+    @property
+    def paged(self):
+        """Incremental resource lists are never paged"""
+        return False
+
+    def bootstrap(self):
+        """Serializes all resources of the bootstrapped source"""
+        then = time.time()
+        for (basename, record) in self.source.snapshot_records(
+                self.source.snapshot()):
+            self._set_entry(basename, record)
+        self.logger.info("Serialized %d resources: %f" %
+                         (self.source.resource_count, time.time() - then))
+
+    def _bucket_number(self, basename):
+        return int(basename) // self.bucket_size
+
+    def _set_entry(self, basename, record):
+        bucket_number = self._bucket_number(basename)
+        bucket = self._buckets.setdefault(bucket_number, {})
+        if record is None:
+            bucket.pop(basename, None)
+        else:
+            bucket[basename] = self.source.serializer.entry(basename, record)
+        self._bucket_versions[bucket_number] = \
+            self._bucket_versions.get(bucket_number, 0) + 1
+
+    def _bucket_entries(self, bucket_number):
+        """The concatenated XML of all resources in a bucket"""
+        version = self._bucket_versions.get(bucket_number, 0)
+        cached = self._bucket_xml.get(bucket_number)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        xml = "".join(self._buckets[bucket_number].values())
+        self._bucket_xml[bucket_number] = (version, xml)
+        return xml
+
+    def generate_xml(self, resource_list):
+        """Returns the XML of a resource list. The resource_list argument
+        is an empty ResourceList that only provides links and metadata."""
+        then = time.time()
+        resource_list.default_capability()
+        xml = [sitemap_head(resource_list)]
+        for bucket_number in sorted(self._buckets.keys()):
+            xml.append(self._bucket_entries(bucket_number))
+        xml.append(sitemap_tail())
+        self.logger.info("Generated resource_list: %f" % (time.time() - then))
+        return "".join(xml)
+
+    def notify(self, change):
+        """Re-serializes the resource of a change event"""
+        basename = change.basename
+        if change.change == "deleted":
+            self._set_entry(basename, None)
+        else:
+            self._set_entry(basename, self.source._repository.get(basename))
+
 #### Source Simulator ####
 
 
+class SourceState(object):
+    """The counters of a source that change with it. Repositories shared
+    between processes provide their own (e.g., SharedArrayRepository)."""
+
+    def __init__(self):
+        self.version = 0  # bumped whenever documents may have changed
+        self.last_modified = time.time()  # time of the latest change
+        self.max_res_id = 1  # the next resource id
+
+
 class Source(Observable):
     """A source contains a list of resources and changes over time"""
 
     RESOURCE_PATH = "/resources"  # to append to base_uri
+    DEFAULT_FIXITY = ['md5']  # digests computed for each resource
     STATIC_FILE_PATH = os.path.join(os.path.dirname(__file__), "static")
 
     def __init__(self, config, base_uri, port):
@@ -71,14 +344,78 @@ class Source(Observable):
         self.logger.info("Source config: %s " % self.config)
         self.port = port
         self.base_uri = base_uri
-        self.max_res_id = 1
-        self._repository = {}  # {basename, {timestamp, length}}
+        self._state = SourceState()
+        self.fixity = Source.DEFAULT_FIXITY
+        if config is not None and 'fixity' in config:
+            self.fixity = config['fixity']
+        # {basename, {timestamp, length, md5, sha256}}
+        self._repository = DictRepository(self)
+        self.payload_engine = PayloadEngine()
         self.resource_list_builder = None  # The resource_list builder implementation
         self.changememory = None  # The change memory implementation
+        self.resource_dump_builder = None  # The resource dump implementation
+        self.change_dump_builder = None  # The change dump implementation
         self.no_events = 0
+        self._batch = None  # changes of the batch being simulated
+        self._carry = 0.0  # fractional events of the uniform arrival
+        self._skipped_events = 0  # trace events that couldn't be replayed
+        self._warned_full = False  # about a repository without room
+        self._version_lock = threading.Lock()
+        # all random choices of the simulation; reproducible if seeded
+        self.random = random.Random(None if config is None
+                                    else config.get('seed'))
+        self.trace = None  # records the change events if set
+        self.metrics = Metrics()
+        # writes resource list entries straight from repository records
+        self.serializer = RecordSerializer(base_uri + Source.RESOURCE_PATH +
+                                           "/")
+
+    @property
+    def version(self):
+        """An opaque counter that increases whenever the repository changes
+        and again when observers received a batch of changes; used to
+        validate generated documents. It is not the number of changes."""
+        return self._state.version
+
+    @version.setter
+    def version(self, version):
+        self._state.version = version
+
+    @property
+    def last_modified(self):
+        """The time of the latest change"""
+        return self._state.last_modified
+
+    @last_modified.setter
+    def last_modified(self, last_modified):
+        self._state.last_modified = last_modified
+
+    @property
+    def max_res_id(self):
+        """The id of the next created resource"""
+        return self._state.max_res_id
+
+    @max_res_id.setter
+    def max_res_id(self, max_res_id):
+        self._state.max_res_id = max_res_id
 
     ##### Source capabilities #####
 
+    def add_repository(self, repository):
+        """Replaces the default repository implementation; must be called
+        before bootstrapping"""
+        if len(self._repository) > 0:
+            raise Exception("Cannot replace a non-empty repository")
+        self._repository = repository
+        state = getattr(repository, 'state', None)
+        if state is not None:
+            # keep the counters where other processes can read them
+            state.version = self.version
+            state.last_modified = self.last_modified
+            state.max_res_id = self.max_res_id
+            self._state = state
+            self.metrics.event_counts = state.events
+
     def add_resource_list_builder(self, resource_list_builder):
         """Adds an resource_list builder implementation"""
         self.resource_list_builder = resource_list_builder
@@ -97,13 +434,104 @@ class Source(Observable):
         """Returns True if a source maintains a change memory"""
         return bool(self.changememory is not None)
 
+    @property
+    def delivered_until(self):
+        """The time up to which the change memory received all changes (the
+        current time without a change memory). Documents use it for md_at
+        and md_until, so that destinations that continue from them with
+        ?from= don't miss changes that are still being delivered."""
+        if self.has_changememory:
+            return self.changememory.delivered_until
+        return time.time()
+
+    def add_resource_dump_builder(self, resource_dump_builder):
+        """Adds a resource dump builder implementation"""
+        self.resource_dump_builder = resource_dump_builder
+
+    @property
+    def has_resource_dump_builder(self):
+        """Returns True if the Source publishes a resource dump"""
+        return bool(self.resource_dump_builder is not None)
+
+    def add_change_dump_builder(self, change_dump_builder):
+        """Adds a change dump builder implementation; requires a change
+        memory"""
+        if not self.has_changememory:
+            raise ValueError("A change dump builder requires a changememory")
+        self.change_dump_builder = change_dump_builder
+
+    @property
+    def has_change_dump_builder(self):
+        """Returns True if the Source publishes a change dump"""
+        return bool(self.change_dump_builder is not None)
+
     ##### Bootstrap Source ######
 
     def bootstrap(self):
         """Bootstrap the source with a set of resources"""
         self.logger.info("Bootstrapping source...")
-        for i in range(self.config['number_of_resources']):
-            self._create_resource(notify_observers=False)
+        then = time.time()
+        number = self.config['number_of_resources']
+        if len(self._repository) == 0:
+            self._bootstrap_resources(number)
+        else:
+            for i in range(number):
+                self._create_resource(notify_observers=False)
+        self.logger.info("Created %d resources: %f" %
+                         (number, time.time() - then))
+        self._bootstrap_capabilities()
+
+    def restore(self, path):
+        """Bootstraps the source from a snapshot file instead of creating
+        resources (see simulator.snapshotfile)"""
+        self.logger.info("Restoring source from %s..." % path)
+        then = time.time()
+        snapshotfile.restore(self, path)
+        self.logger.info("Restored %d resources: %f" %
+                         (self.resource_count, time.time() - then))
+        self._bootstrap_capabilities()
+
+    def save(self, path):
+        """Saves the repository and change memory to a snapshot file"""
+        then = time.time()
+        snapshotfile.save(self, path)
+        self.logger.info("Saved %d resources to %s: %f" %
+                         (self.resource_count, path, time.time() - then))
+
+    def _bootstrap_resources(self, number):
+        """Creates number resources in the empty repository in bulk: the
+        payload lengths are drawn at once, the digests are computed in a
+        single loop and the records are loaded as columns. All resources
+        get the same timestamp."""
+        first = self.max_res_id
+        timestamp = time.time()
+        lengths = random_lengths(number, self.config['average_payload'],
+                                 self.random)
+        digests = dict((name, [b"\0" * DIGEST_SIZES[name] * first])
+                       for name in self.fixity)
+        hashes = [(name, getattr(hashlib, name.replace('-', '')))
+                  for name in self.fixity]
+        payload = self.payload_engine.payload
+        for i in xrange(number):
+            data = payload(str(first + i), lengths[i])
+            for (name, hash_function) in hashes:
+                digests[name].append(hash_function(data).digest())
+        columns = {'high': first + number,
+                   'live': bytearray(first) + bytearray(b"\1" * number),
+                   'timestamps': (array('d', [0.0]) * first +
+                                  array('d', [timestamp]) * number),
+                   'lengths': array('I', [0]) * first + lengths}
+        for name in self.fixity:
+            columns[name] = b"".join(digests[name])
+        self._repository.load_columns(columns)
+        self.max_res_id = first + number
+        with self._version_lock:
+            self.version += number
+            self.last_modified = max(self.last_modified, timestamp)
+
+    def _bootstrap_capabilities(self):
+        """Bootstraps the change memory and the builders once the
+        repository holds the initial resources"""
         if self.has_changememory:
             self.changememory.bootstrap()
         if self.has_resource_list_builder:
@@ -135,13 +563,26 @@ class Source(Observable):
     @property
     def resources(self):
         """Iterates over resources and yields resource objects"""
-        repository = self._repository
-        for basename in repository.keys():
-            resource = self.resource(basename)
-            if resource is None:
-                self.logger.error("Cannot create resource %s " % basename +
-                                  "because source object has been deleted.")
-            yield resource
+        return self.snapshot_resources(self.snapshot())
+
+    def snapshot(self):
+        """A consistent point-in-time view of the repository (see
+        simulator.repository.Snapshot); close it when done"""
+        return self._repository.snapshot()
+
+    def snapshot_resources(self, snapshot):
+        """Iterates over the resources of a snapshot and closes it"""
+        for (basename, record) in self.snapshot_records(snapshot):
+            yield self._resource(basename, record)
+
+    def snapshot_records(self, snapshot):
+        """Iterates over the (basename, record) pairs of a snapshot and
+        closes it"""
+        try:
+            for item in snapshot:
+                yield item
+        finally:
+            snapshot.close()
 
     @property
     def random_resource(self):
@@ -155,85 +596,288 @@ class Source(Observable):
     def resource(self, basename):
         """Creates and returns a resource object from internal resource
         repository. Repositoy values are copied into the object."""
-        if not basename in self._repository:
+        record = self._repository.get(basename)
+        if record is None:
             return None
+        return self._resource(basename, record)
+
+    def _resource(self, basename, record):
+        """Creates a resource object from a repository record"""
         uri = self.base_uri + Source.RESOURCE_PATH + "/" + basename
-        timestamp = self._repository[basename]['timestamp']
-        length = self._repository[basename]['length']
-        md5 = compute_md5_for_string(self.resource_payload(basename, length))
-        return Resource(uri=uri, timestamp=timestamp, length=length,
-                        md5=md5)
+        return Resource(uri=uri, timestamp=record['timestamp'],
+                        length=record['length'], md5=record['md5'],
+                        sha256=record['sha256'])
 
     def resource_payload(self, basename, length=None):
         """Generates dummy payload by repeating res_id x length times"""
         if length is None:
             length = self._repository[basename]['length']
-        no_repetitions = length / len(basename)
-        content = "".join([basename for x in range(no_repetitions)])
-        no_fill_chars = length % len(basename)
-        fillchars = "".join(["x" for x in range(no_fill_chars)])
-        return content + fillchars
+        return self.payload_engine.payload(basename, length)
 
     def random_resources(self, number=1):
         "Return a random set of resources, at most all resources"
-        if number > len(self._repository):
-            number = len(self._repository)
-        rand_basenames = random.sample(self._repository.keys(), number)
-        return [self.resource(basename) for basename in rand_basenames]
+        rand_basenames = self._repository.random_keys(number)
+        resources = [self.resource(basename) for basename in rand_basenames]
+        # resources deleted meanwhile by another process are skipped
+        return [resource for resource in resources if resource is not None]
 
     def simulate_changes(self):
-        """Simulate changing resources in the source"""
+        """Simulate changing resources in the source.
+
+        By default one event is simulated every change_delay seconds. If
+        events_per_second is configured, events are simulated in batches
+        per tick instead (see _simulate_rate); events_per_second: max
+        simulates max_events events without sleeping and returns the
+        achieved number of events per second."""
         self.logger.info("Starting simulation...")
-        sleep_time = self.config['change_delay']
-        while self.no_events != self.config['max_events']:
-            time.sleep(sleep_time)
-            event_type = random.choice(self.config['event_types'])
-            if event_type == "create":
-                self._create_resource()
-            elif event_type == "update" or event_type == "delete":
-                if len(self._repository.keys()) > 0:
-                    basename = random.sample(self._repository.keys(), 1)[0]
-                else:
-                    basename = None
-                if basename is None:
-                    self.no_events = self.no_events + 1
-                    continue
+        rate = self.config.get('events_per_second')
+        if rate == 'max':
+            return self._simulate_max_throughput()
+        elif rate is not None:
+            self._simulate_rate(float(rate))
+        else:
+            sleep_time = self.config['change_delay']
+            while not self._finished:
+                time.sleep(sleep_time)
+                self._simulate_event()
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        self.logger.info("Finished change simulation")
+
+    @property
+    def _finished(self):
+        return self.no_events == self.config['max_events']
+
+    @property
+    def _remaining_events(self):
+        """The number of events left to simulate or None if unlimited"""
+        if self.config['max_events'] < 0:
+            return None
+        return max(0, self.config['max_events'] - self.no_events)
+
+    def _simulate_event(self):
+        """Simulates a single random event"""
+        event_type = self.random.choice(self.config['event_types'])
+        if event_type == "create":
+            self._create_resource()
+        elif event_type == "update" or event_type == "delete":
+            basename = self._repository.random_key(self.random)
+            if basename is not None:
                 if event_type == "update":
                     self._update_resource(basename)
                 elif event_type == "delete":
                     self._delete_resource(basename)
+        else:
+            self.logger.error("Event type %s is not supported"
+                              % event_type)
+        self._count_event()
 
-            else:
-                self.logger.error("Event type %s is not supported"
-                                  % event_type)
-            self.no_events = self.no_events + 1
-            if self.no_events % self.config['stats_interval'] == 0:
-                self._log_stats()
+    def _count_event(self):
+        self.no_events = self.no_events + 1
+        if self.no_events % self.config['stats_interval'] == 0:
+            self._log_stats()
 
-        self.logger.info("Finished change simulation")
+    def _simulate_batch(self, number):
+        """Simulates number events and notifies the observers about all
+        resulting changes at once"""
+        self._apply_batch(lambda i: self._simulate_event(), xrange(number))
+
+    def _apply_batch(self, apply_event, events):
+        """Applies events and notifies the observers about all resulting
+        changes at once"""
+        self._batch = []
+        try:
+            for event in events:
+                apply_event(event)
+        finally:
+            changes = self._batch
+            self._batch = None
+        if len(changes) > 0:
+            self.notify_observers_batch(changes)
+
+    def _simulate_rate(self, rate):
+        """Simulates events_per_second events on average, applied in one
+        batch per tick (seconds). Arrivals per tick are 'poisson'
+        distributed, 'uniform' (a constant rate) or 'burst': Poisson
+        distributed bursts of burst_size events."""
+        tick = self.config.get('tick', 0.1)
+        next_tick = time.time()
+        while not self._finished:
+            next_tick += tick
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -tick:
+                self.logger.warn("Simulation is %.2fs behind schedule; "
+                                 "events_per_second too high" % -delay)
+                next_tick = time.time()
+            self._simulate_batch(self._arrivals(rate * tick))
+
+    def _arrivals(self, expected):
+        """The number of events to simulate in a period with the given
+        expected number of events, according to the arrival pattern and
+        at most the remaining events"""
+        arrival = self.config.get('arrival', 'poisson')
+        if arrival == 'uniform':
+            # carry fractional events over to the next period
+            self._carry += expected
+            number = int(self._carry)
+            self._carry -= number
+        elif arrival == 'burst':
+            burst_size = self.config.get('burst_size', 100)
+            number = poisson(expected / burst_size, self.random) * burst_size
+        else:
+            number = poisson(expected, self.random)
+        remaining = self._remaining_events
+        if remaining is not None:
+            number = min(number, remaining)
+        return number
+
+    def _simulate_max_throughput(self):
+        """Simulates the remaining max_events events in batches of
+        batch_size without sleeping; returns the events per second"""
+        if self._remaining_events is None:
+            raise ValueError("events_per_second: max requires max_events")
+        batch_size = self.config.get('batch_size', 1000)
+        number = self._remaining_events
+        then = time.time()
+        while not self._finished:
+            self._simulate_batch(min(batch_size, self._remaining_events))
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        elapsed = time.time() - then
+        events_per_second = number / elapsed if elapsed > 0 else float(number)
+        self.logger.info("Simulated %d events in %.3fs (%.1f events/s)"
+                         % (number, elapsed, events_per_second))
+        return events_per_second
+
+    ##### Event traces #####
+
+    def record_trace(self, path):
+        """Records the change events from now on to a trace file (see
+        simulator.trace)"""
+        self.trace = TraceWriter(path, {
+            'seed': self.config.get('seed'),
+            'number_of_resources': self.config['number_of_resources'],
+            'average_payload': self.config['average_payload']})
+        self.logger.info("Recording change events to %s" % path)
+
+    def stop_trace(self):
+        """Stops recording change events and closes the trace file"""
+        if self.trace is not None:
+            trace = self.trace
+            self.trace = None
+            trace.close()
+            self.logger.info("Recorded %d change events to %s" %
+                             (trace.count, trace.path))
+
+    def replay_trace(self, path, speed=1.0):
+        """Applies the change events of a trace file instead of simulating
+        random events; returns the events per second.
+
+        Events are applied at their recorded times divided by speed, in
+        batches of the events that are due. With speed 'max', they are
+        applied in batches of batch_size without waiting. Events of
+        resources that don't exist (e.g., because the source was
+        bootstrapped differently) are skipped."""
+        self.logger.info("Replaying change events from %s..." % path)
+        reader = TraceReader(path)
+        batch_size = self.config.get('batch_size', 1000)
+        number = self.no_events
+        self._skipped_events = 0
+        then = time.time()
+        try:
+            batch = []
+            for event in reader:
+                if speed != 'max':
+                    delay = then + event[0] / float(speed) - time.time()
+                    if delay > 0:
+                        self._apply_batch(self._replay_event, batch)
+                        batch = []
+                        time.sleep(delay)
+                batch.append(event)
+                if len(batch) >= batch_size:
+                    self._apply_batch(self._replay_event, batch)
+                    batch = []
+            self._apply_batch(self._replay_event, batch)
+        finally:
+            reader.close()
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        elapsed = time.time() - then
+        number = self.no_events - number
+        events_per_second = number / elapsed if elapsed > 0 else float(number)
+        self.logger.info("Replayed %d events in %.3fs (%.1f events/s), "
+                         "skipped %d" % (number, elapsed, events_per_second,
+                                         self._skipped_events))
+        return events_per_second
+
+    def _replay_event(self, event):
+        """Applies a (offset, change, basename, length) event of a trace"""
+        (offset, change, basename, length) = event
+        exists = self._repository.get(basename) is not None
+        if change == "created" and not exists:
+            if not self._create_resource(basename, length=length):
+                self._skipped_events += 1
+                return
+            self.max_res_id = max(self.max_res_id, int(basename) + 1)
+        elif change == "updated" and exists:
+            self._update_resource(basename, length=length)
+        elif change == "deleted" and exists:
+            self._delete_resource(basename)
+        else:
+            self._skipped_events += 1
+            return
+        self._count_event()
 
     # Private Methods
 
-    def _create_resource(self, basename=None, notify_observers=True):
-        """Create a new resource, add it to the source, notify observers."""
+    def _create_resource(self, basename=None, notify_observers=True,
+                         length=None):
+        """Create a new resource, add it to the source, notify observers.
+        Returns False if the repository has no room for it."""
         if basename is None:
             basename = str(self.max_res_id)
+            if not self._has_room(basename):
+                return False
             self.max_res_id += 1
+        elif not self._has_room(basename):
+            return False
         timestamp = time.time()
-        length = random.randint(0, self.config['average_payload'])
-        self._repository[basename] = {'timestamp': timestamp, 'length': length}
+        if length is None:
+            length = self.random.randint(0, self.config['average_payload'])
+        self._repository[basename] = self._record(basename, timestamp, length)
         if notify_observers:
             change = Resource(
                 resource=self.resource(basename), change="created")
-            self.notify_observers(change)
+            self._emit(change)
+        self._touch(timestamp)
+        return True
+
+    def _has_room(self, basename):
+        """Returns True if the repository can store basename; a repository
+        of fixed capacity (SharedArrayRepository) eventually fills up, in
+        which case creates are skipped with a warning"""
+        has_room = getattr(self._repository, 'has_room', None)
+        if has_room is None or has_room(basename):
+            return True
+        if not self._warned_full:
+            self.logger.warning("Repository is full, skipping creates: %s"
+                                % self._repository)
+            self._warned_full = True
+        return False
 
-    def _update_resource(self, basename):
-        """Update a resource, notify observers."""
-        self._delete_resource(basename, notify_observers=False)
-        self._create_resource(basename, notify_observers=False)
+    def _update_resource(self, basename, length=None):
+        """Update a resource, notify observers. The record is replaced in a
+        single step so that snapshots never miss the resource."""
+        timestamp = time.time()
+        if length is None:
+            length = self.random.randint(0, self.config['average_payload'])
+        self._repository[basename] = self._record(basename, timestamp, length)
         change = Resource(
             resource=self.resource(basename), change="updated")
-        self.notify_observers(change)
+        self._emit(change)
+        self._touch(timestamp)
 
     def _delete_resource(self, basename, notify_observers=True):
         """Delete a given resource, notify observers."""
@@ -243,16 +887,172 @@ class Source(Observable):
         if notify_observers:
             change = Resource(
                 resource=res, change="deleted")
+            self._emit(change)
+        self._touch(res.timestamp)
+
+    def _emit(self, change):
+        """Notifies the observers about a change, or collects it if a batch
+        of events is simulated"""
+        self.metrics.count_event(change.change)
+        if self.trace is not None:
+            self.trace.write(change)
+        if self._batch is not None:
+            self._batch.append(change)
+        else:
             self.notify_observers(change)
 
+    def _touch(self, timestamp):
+        """Records a change of the repository; called after the observers
+        were notified so that documents derived from them are current at
+        the new version"""
+        with self._version_lock:
+            self.version += 1
+            self.last_modified = max(self.last_modified, timestamp)
+
+    def batch_delivered(self, changes):
+        """Bumps the version once observers received a batch of changes,
+        which may happen later on the dispatcher's thread"""
+        self._touch(time.time())
+
+    def _record(self, basename, timestamp, length):
+        """Creates a repository record; the payload is generated and hashed
+        only once here instead of on every resource lookup."""
+        md5 = None
+        sha256 = None
+        if self.fixity:
+            digests = {}
+            for name in self.fixity:
+                digests[name] = hashlib.new(name.replace('-', ''))
+            for chunk in self.payload_engine.chunks(basename, length):
+                for digest in digests.values():
+                    digest.update(chunk)
+            if 'md5' in digests:
+                md5 = base64.b64encode(digests['md5'].digest())
+            if 'sha-256' in digests:
+                sha256 = base64.b64encode(digests['sha-256'].digest())
+        return {'timestamp': timestamp, 'length': length,
+                'md5': md5, 'sha256': sha256}
+
     def _log_stats(self):
         """Output current source statistics via the logger"""
         stats = {
             'no_resources': self.resource_count,
-            'no_events': self.no_events
+            'no_events': self.no_events,
+            'bytes_per_resource': self._repository.bytes_per_resource
         }
+        if self.dispatcher is not None:
+            stats['dispatcher'] = self.dispatcher.stats
         self.logger.info("Source stats: %s" % stats)
 
     def __str__(self):
         """Prints out the source's resources"""
         return pprint.pformat(self._repository)
+
+
+class IOLoopSimulation(object):
+    """Runs the simulation of a source as callbacks on the current Tornado
+    IOLoop, interleaved with request handling, instead of in a loop on a
+    thread of its own.
+
+    With events_per_second, each tick simulates the events that arrived
+    since the previous tick, so late ticks don't lower the rate. Otherwise
+    one event is simulated every change_delay seconds, or, if change_delay
+    is 0 or events_per_second is max, batches of batch_size events are
+    simulated back to back. A callback never simulates more than
+    batch_size events before it yields to the IOLoop again.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.config = source.config
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.batch_size = self.config.get('batch_size', 1000)
+        self.logger = logging.getLogger('simulation')
+        self._periodic = None
+        self._pending = 0  # events due but not simulated yet
+        self._last_tick = None
+        self._running = False
+        self._on_finished = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, on_finished=None):
+        """Schedules the simulation; on_finished is called once max_events
+        events were simulated and delivered"""
+        self.logger.info("Starting simulation on the IOLoop...")
+        self._running = True
+        self._on_finished = on_finished
+        rate = self.config.get('events_per_second')
+        if rate is not None and rate != 'max':
+            self.rate = float(rate)
+            self._last_tick = time.time()
+            self._periodic = tornado.ioloop.PeriodicCallback(
+                self._tick, self.config.get('tick', 0.1) * 1000)
+            self._periodic.start()
+        elif rate is None and self.config['change_delay'] > 0:
+            self._periodic = tornado.ioloop.PeriodicCallback(
+                self._step, self.config['change_delay'] * 1000)
+            self._periodic.start()
+        else:
+            self.ioloop.add_callback(self._run_batch)
+
+    def stop(self):
+        """Stops scheduling events; a batch being simulated is completed"""
+        if self._periodic is not None:
+            self._periodic.stop()
+        self._running = False
+
+    def _tick(self):
+        now = time.time()
+        self._pending += self.source._arrivals(
+            self.rate * (now - self._last_tick))
+        self._last_tick = now
+        self._simulate_pending()
+
+    def _simulate_pending(self):
+        """Simulates up to batch_size of the pending events and schedules
+        the rest for the next IOLoop iteration"""
+        if not self._running:
+            return
+        number = min(self._pending, self.batch_size)
+        self._pending -= number
+        self.source._simulate_batch(number)
+        if self._check_finished():
+            return
+        if self._pending > 0:
+            self.ioloop.add_callback(self._simulate_pending)
+
+    def _step(self):
+        if self._running:
+            self.source._simulate_event()
+            self._check_finished()
+
+    def _run_batch(self):
+        if not self._running:
+            return
+        number = self.batch_size
+        if self.source._remaining_events is not None:
+            number = min(number, self.source._remaining_events)
+        self.source._simulate_batch(number)
+        if not self._check_finished():
+            self.ioloop.add_callback(self._run_batch)
+
+    def _check_finished(self):
+        """Stops the simulation once max_events events were simulated and
+        waits for the dispatcher (if any) to deliver them"""
+        if not self.source._finished:
+            return False
+        self.stop()
+        self._wait_for_delivery()
+        return True
+
+    def _wait_for_delivery(self):
+        dispatcher = self.source.dispatcher
+        if dispatcher is not None and not dispatcher.join(timeout=0):
+            self.ioloop.call_later(0.01, self._wait_for_delivery)
+            return
+        self.logger.info("Finished change simulation")
+        if self._on_finished is not None:
+            self._on_finished()
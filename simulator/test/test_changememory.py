@@ -1,8 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 import random
 
 from simulator.resource import Resource
-from simulator.changememory import DynamicChangeList
+from simulator.changememory import DynamicChangeList, RingBufferChangeList, \
+    PersistentChangeList, ChangeListArchiver
 from simulator.source import Source
 
 class TestSource(unittest.TestCase):
@@ -59,6 +63,52 @@ class TestSource(unittest.TestCase):
         self.assertEqual(self.changememory.changes[0].length, 66)
         self.assertEqual(self.changememory.changes[49].length, 15)
         
+    def test_generate_window(self):
+        """Test restricting generated change lists to a window"""
+        self.create_dummy_changes(10)
+        changes = self.changememory.generate(from_timestamp=1234.0 * 2,
+                                             until_timestamp=1234.0 * 5)
+        self.assertEqual([c.length for c in changes], [2, 3, 4])
+        changes = self.changememory.generate(after=7)
+        self.assertEqual([c.length for c in changes], [7, 8, 9])
+        changes = self.changememory.generate(after=7,
+                                             until_timestamp=1234.0 * 9)
+        self.assertEqual([c.length for c in changes], [7, 8])
+
+    def test_notify_batch(self):
+        """Test storing a batch of changes"""
+        self.changememory.max_changes = 10
+        self.create_dummy_changes(5)
+        changes = [Resource(uri="b" + str(i), timestamp=1234.0 * (5 + i),
+                            change="updated", length=i) for i in range(8)]
+        self.changememory.notify_batch(changes)
+        self.assertEqual(self.changememory.change_count, 10)
+        self.assertEqual([c.changeid for c in self.changememory.changes],
+                         range(4, 14))
+        self.assertEqual(self.changememory.changes[-1].uri, "b7")
+
+    def test_changes_after_limit(self):
+        """Test limiting the changes after a change id"""
+        self.create_dummy_changes(10)
+        changes = self.changememory.changes_after(3, 2)
+        self.assertEqual([c.changeid for c in changes], [4, 5])
+        self.assertEqual(len(self.changememory.changes_after(8, 5)), 2)
+
+    def test_archive(self):
+        """Test archiving closed change list pages"""
+        self.changememory.archive = ChangeListArchiver(self.changememory, 4)
+        self.create_dummy_changes(10)
+        archive = self.changememory.archive
+        self.assertEqual(archive.page_count, 2)
+        self.assertEqual(archive.path, "changes-archive")
+        self.assertEqual(archive.page_path(1), "changes-00001")
+        xml = archive.generate_page(2)
+        self.assertTrue("<loc>a4</loc>" in xml)
+        self.assertFalse("<loc>a8</loc>" in xml)
+        self.assertTrue(archive.generate_page(2) is xml)
+        self.assertTrue(archive.generate_page(3) is None)
+        self.assertTrue("changes-00002" in archive.generate_index())
+
     def create_dummy_changes(self, number = 5):
         """Create a given number of dummy changes, use length as a dummy id"""
         for i in range(number):
@@ -67,5 +117,133 @@ class TestSource(unittest.TestCase):
                          length=i)
             self.changememory.notify(r)
     
+
+class TestRingBufferChangeList(TestSource):
+
+    def setUp(self):
+        """Set up a new ring buffer changememory before each test case"""
+        source = Source(None, "http://localhost:8888", "8888")
+        config = {}
+        config['uri_path'] = "changes"
+        config['max_changes'] = 100
+        self.changememory = RingBufferChangeList(source, config)
+
+    def test_change_ids(self):
+        """Test that change ids are monotonic and survive eviction"""
+        self.changememory.max_changes = 10
+        self.create_dummy_changes(25)
+        changes = self.changememory.changes
+        self.assertEqual([c.changeid for c in changes], range(16, 26))
+        self.assertEqual(self.changememory.index_of_changeid(20), 4)
+        self.assertEqual(self.changememory.index_of_changeid(1), 0)
+        self.assertEqual(self.changememory.index_of_changeid(99), 10)
+        self.assertEqual([c.changeid for c in
+                          self.changememory.changes_after(23)], [24, 25])
+
+    def test_changes_between(self):
+        """Test binary search lookup by timestamp"""
+        self.create_dummy_changes(20)
+        changes = self.changememory.changes_between(1234.0 * 5,
+                                                    1234.0 * 8)
+        self.assertEqual([c.length for c in changes], [5, 6, 7])
+        changes = self.changememory.changes_between(from_timestamp=1234.0 * 18)
+        self.assertEqual([c.length for c in changes], [18, 19])
+        self.assertEqual(len(self.changememory.changes_between()), 20)
+
+    def test_unlimited(self):
+        """Test that the buffer grows without a max_changes limit"""
+        self.changememory.max_changes = None
+        self.create_dummy_changes(RingBufferChangeList.INITIAL_CAPACITY + 5)
+        self.assertEqual(self.changememory.change_count,
+                         RingBufferChangeList.INITIAL_CAPACITY + 5)
+        self.assertEqual(self.changememory.changes[0].length, 0)
+
+
+class TestPersistentChangeList(TestSource):
+
+    def setUp(self):
+        """Set up a new persistent changememory in a temporary directory"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = Source(None, "http://localhost:8888", "8888")
+        self.config = {}
+        self.config['uri_path'] = "changes"
+        self.config['max_changes'] = 100
+        self.config['path'] = os.path.join(self.tmpdir, "changes")
+        self.changememory = PersistentChangeList(self.source, self.config)
+
+    def tearDown(self):
+        self.changememory.close()
+        shutil.rmtree(self.tmpdir)
+
+    def reopen(self):
+        self.changememory.close()
+        self.changememory = PersistentChangeList(self.source, self.config)
+
+    def test_reopen(self):
+        """Test that changes and change ids survive a restart"""
+        self.create_dummy_changes(10)
+        self.reopen()
+        self.assertEqual(self.changememory.change_count, 10)
+        self.assertEqual(self.changememory.last_changeid, 10)
+        changes = self.changememory.changes_between(1234.0 * 3, 1234.0 * 5)
+        self.assertEqual([c.length for c in changes], [3, 4])
+        self.assertEqual([c.changeid for c in changes], [4, 5])
+        self.create_dummy_changes(1)
+        self.assertEqual(self.changememory.changes[-1].changeid, 11)
+
+    def test_recover(self):
+        """Test that unindexed log lines are indexed and a partial line is
+        dropped at startup"""
+        self.create_dummy_changes(3)
+        self.changememory.close()
+        with open(self.changememory.log_path, 'ab') as log:
+            log.write("4\t4936.0\tcreated\ta4\t4\t\t\n4\t49")
+        self.changememory = PersistentChangeList(self.source, self.config)
+        self.assertEqual(self.changememory.change_count, 4)
+        self.assertEqual(self.changememory.changes[-1].uri, "a4")
+        self.create_dummy_changes(1)
+        self.assertEqual(self.changememory.changes[-1].changeid, 5)
+
+    def test_index_growth(self):
+        """Test growing the index file and keeping history beyond
+        max_changes"""
+        self.changememory.max_changes = 10
+        self.create_dummy_changes(PersistentChangeList.INDEX_GROWTH + 5)
+        self.assertEqual(self.changememory.change_count, 10)
+        self.assertEqual(self.changememory.logged_count,
+                         PersistentChangeList.INDEX_GROWTH + 5)
+        self.assertEqual([c.length for c in
+                          self.changememory.changes_after(3)[:2]], [3, 4])
+
+    def test_follow(self):
+        """Test reading the changes appended by another instance"""
+        self.create_dummy_changes(3)
+        follower = PersistentChangeList(self.source, self.config)
+        follower.follow()
+        self.assertEqual(follower.last_changeid, 3)
+        self.create_dummy_changes(PersistentChangeList.INDEX_GROWTH)
+        self.assertEqual(follower.logged_count,
+                         PersistentChangeList.INDEX_GROWTH + 3)
+        self.assertEqual(follower.last_changeid,
+                         PersistentChangeList.INDEX_GROWTH + 3)
+        self.assertEqual([c.changeid for c in follower.changes_after(3, 2)],
+                         [4, 5])
+        self.assertEqual(follower.changes[-1].length,
+                         PersistentChangeList.INDEX_GROWTH - 1)
+        follower.close()
+
+    def test_window_under_read_lock(self):
+        """Test that windows are looked up in the index under the read lock,
+        since the index may be mapped again meanwhile"""
+        self.create_dummy_changes(10)
+        timestamp = self.changememory._timestamp
+
+        def locked_timestamp(index):
+            self.assertTrue(self.changememory._read_lock.locked())
+            return timestamp(index)
+        self.changememory._timestamp = locked_timestamp
+        changes = self.changememory.changes_between(1234.0, 1234.0 * 3)
+        self.assertEqual([c.length for c in changes], [1, 2])
+
 if __name__ == '__main__':
     unittest.main()
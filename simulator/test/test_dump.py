@@ -0,0 +1,101 @@
+import base64
+import hashlib
+import unittest
+import zipfile
+from io import BytesIO
+
+from simulator.source import Source
+from simulator.changememory import DynamicChangeList
+from simulator.dump import ZipStream, ResourceDumpBuilder, ChangeDumpBuilder
+
+
+def read_zip(chunks):
+    return zipfile.ZipFile(BytesIO(b"".join(chunks)))
+
+
+class TestZipStream(unittest.TestCase):
+
+    def test_zip(self):
+        stream = ZipStream()
+        chunks = [stream.add("manifest.xml", "<urlset />", 1234567890.0)]
+        data = [memoryview(b"ab" * 1000), memoryview(b"c")]
+        chunks.extend(stream.add_chunks("data", 2001, lambda: iter(data),
+                                        1234567890.0))
+        chunks.append(stream.close())
+        zip_file = read_zip(chunks)
+        self.assertTrue(zip_file.testzip() is None)
+        self.assertEqual(zip_file.namelist(), ["manifest.xml", "data"])
+        self.assertEqual(zip_file.read("data"), b"ab" * 1000 + b"c")
+
+
+class TestDumpBuilders(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 25
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100000
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.source.add_changememory(DynamicChangeList(
+            self.source, {'uri_path': "changelist.xml", 'max_changes': 8}))
+        self.resource_dump = ResourceDumpBuilder(
+            self.source, {'uri_path': "resourcedump.xml", 'package_size': 10})
+        self.change_dump = ChangeDumpBuilder(
+            self.source, {'uri_path': "changedump.xml", 'package_size': 3,
+                          'max_cached_packages': 1})
+        self.source.bootstrap()
+
+    def test_resource_dump(self):
+        self.assertEqual(self.resource_dump.package_count, 3)
+        self.assertEqual(self.resource_dump.package_path(1),
+                         "resourcedump-00001.zip")
+        self.assertTrue("resourcedump-00003.zip" in
+                        self.resource_dump.generate())
+        self.assertTrue(self.resource_dump.generate_package(4) is None)
+        zip_file = read_zip(self.resource_dump.generate_package(1))
+        self.assertEqual(len(zip_file.namelist()), 10)  # ids 1 to 9
+        self.assertTrue("path=\"/resources/9\"" in
+                        zip_file.read("manifest.xml"))
+        payload = zip_file.read("resources/9")
+        self.assertEqual(base64.b64encode(hashlib.md5(payload).digest()),
+                         self.source.resource("9").md5)
+
+    def test_change_dump(self):
+        self.assertEqual(self.change_dump.package_count, 0)
+        for basename in ("1", "2", "3", "4"):
+            self.source._update_resource(basename)
+        self.source._delete_resource("5")
+        self.assertEqual(self.change_dump.package_count, 1)
+        self.assertTrue(self.change_dump.generate_package(2) is None)
+        zip_file = read_zip(self.change_dump.generate_package(1))
+        self.assertEqual(zip_file.namelist(),
+                         ["manifest.xml", "changes/1/1", "changes/2/2",
+                          "changes/3/3"])
+        self.assertTrue(self.source.changememory.changes[0].path is None)
+        # the complete package is cached
+        self.assertTrue(1 in self.change_dump._package_cache)
+        # packages whose changes were dropped from memory are unlisted
+        for basename in ("6", "7", "8", "9", "10", "11"):
+            self.source._update_resource(basename)
+        self.assertEqual(self.change_dump.package_count, 3)
+        self.assertEqual(self.change_dump.first_package, 2)
+        self.assertTrue("changedump-00001.zip" not in
+                        self.change_dump.generate())
+        self.assertTrue(self.change_dump.generate_package(1) is not None)
+        zip_file = read_zip(self.change_dump.generate_package(2))
+        self.assertEqual(zip_file.namelist(),
+                         ["manifest.xml", "changes/4/4", "changes/6/6"])
+        self.assertFalse(1 in self.change_dump._package_cache)
+
+    def test_change_dump_requires_changememory(self):
+        source = Source({'number_of_resources': 1, 'average_payload': 10},
+                        "http://localhost:8888", "8888")
+        self.assertRaises(ValueError, source.add_change_dump_builder,
+                          ChangeDumpBuilder(source,
+                                            {'uri_path': "changedump.xml"}))
+        self.source.add_change_dump_builder(self.change_dump)
+        self.assertTrue(self.source.has_change_dump_builder)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import gzip
+import time
+import urllib
+import unittest
+import xml.etree.cElementTree as ElementTree
+from io import BytesIO
+
+import tornado.web
+import tornado.testing
+
+from resync.w3c_datetime import datetime_to_str, str_to_datetime
+
+from simulator.source import Source, DynamicResourceListBuilder
+from simulator.resource import Resource
+from simulator.changememory import DynamicChangeList, ChangeListArchiver
+from simulator.dump import ResourceDumpBuilder, ChangeDumpBuilder
+from simulator.http import HTTPInterface, ResponseCache
+from simulator.loadgen import Sitemap, RS_NS
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=2)
+
+    def test_versions(self):
+        self.assertTrue(self.cache.get("/a", 1) is None)
+        entry = self.cache.put("/a", 1, u"<urlset />")
+        self.assertEqual(entry.body, "<urlset />")
+        self.assertTrue(self.cache.get("/a", 1) is entry)
+        self.assertTrue(self.cache.get("/a", 2) is None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_gzip(self):
+        entry = self.cache.put("/a", 1, "<urlset>" + "x" * 1000 + "</urlset>")
+        self.assertTrue(len(entry.gzipped) < len(entry.body))
+        gzip_file = gzip.GzipFile(fileobj=BytesIO(entry.gzipped))
+        self.assertEqual(gzip_file.read(), entry.body)
+
+    def test_eviction(self):
+        self.cache.put("/a", 1, "a")
+        self.cache.put("/b", 1, "b")
+        self.cache.put("/a", 2, "a")
+        self.cache.put("/c", 1, "c")
+        self.assertTrue(self.cache.get("/b", 1) is None)
+        self.assertTrue(self.cache.get("/a", 2) is not None)
+        self.assertTrue(self.cache.get("/c", 1) is not None)
+
+
+class HandlerTestCase(tornado.testing.AsyncHTTPTestCase):
+    """Serves a small source with all capabilities"""
+
+    def get_app(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 20
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['max_events'] = -1
+        self.base_uri = "http://127.0.0.1:%d" % self.get_http_port()
+        self.source = Source(config, self.base_uri, self.get_http_port())
+        self.source.add_resource_list_builder(DynamicResourceListBuilder(
+            self.source, {'class': "DynamicResourceListBuilder",
+                          'uri_path': "resourcelist.xml"}))
+        self.source.add_changememory(DynamicChangeList(
+            self.source, {'class': "DynamicChangeList",
+                          'uri_path': "changelist.xml",
+                          'max_changes': 1000,
+                          'archive_page_size': 3}))
+        self.source.add_resource_dump_builder(ResourceDumpBuilder(
+            self.source, {'uri_path': "resourcedump.xml",
+                          'package_size': 10}))
+        self.source.add_change_dump_builder(ChangeDumpBuilder(
+            self.source, {'uri_path': "changedump.xml", 'package_size': 3}))
+        self.source.bootstrap()
+        http_interface = HTTPInterface(self.source)
+        return tornado.web.Application(handlers=http_interface.handlers,
+                                       **http_interface.settings)
+
+    def sitemap(self, path, **arguments):
+        if arguments:
+            path += "?" + urllib.urlencode(arguments)
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        return Sitemap.parse(response.body)
+
+    def uri(self, basename):
+        return "%s/resources/%s" % (self.base_uri, basename)
+
+
+class TestChangeListWindow(HandlerTestCase):
+    """The from/until/after query arguments of the change list"""
+
+    def setUp(self):
+        super(TestChangeListWindow, self).setUp()
+        for basename in range(1, 7):
+            self.source._update_resource(str(basename))
+        # one change per second, well before the delivered watermark
+        self.base = int(time.time()) - 100
+        self.changes = self.source.changememory.changes
+        for (number, change) in enumerate(self.changes):
+            change.timestamp = self.base + number
+
+    def change_list(self, **arguments):
+        """The updated basenames and the from/until times of the change
+        list"""
+        path = "/changelist.xml"
+        if arguments:
+            path += "?" + urllib.urlencode(arguments)
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        md = ElementTree.fromstring(response.body).find(RS_NS + "md")
+        basenames = [loc for (loc, _) in Sitemap.parse(response.body).entries]
+        return (basenames, str_to_datetime(md.get('from')),
+                str_to_datetime(md.get('until')))
+
+    def test_all(self):
+        (basenames, md_from, md_until) = self.change_list()
+        self.assertEqual(basenames,
+                         [self.uri(basename) for basename in range(1, 7)])
+        self.assertEqual(md_from, self.base)
+        self.assertEqual(md_until, self.source.delivered_until)
+
+    def test_from_until(self):
+        (basenames, md_from, md_until) = self.change_list(
+            **{'from': datetime_to_str(self.base + 2),
+               'until': datetime_to_str(self.base + 4)})
+        self.assertEqual(basenames, [self.uri(3), self.uri(4)])
+        self.assertEqual((md_from, md_until), (self.base + 2, self.base + 4))
+        # the window ends at the delivered changes
+        (basenames, md_from, md_until) = self.change_list(
+            until=datetime_to_str(time.time() + 3600))
+        self.assertEqual(len(basenames), 6)
+        self.assertEqual(md_until, self.source.delivered_until)
+
+    def test_empty(self):
+        (basenames, md_from, md_until) = self.change_list(
+            **{'from': datetime_to_str(self.base + 50)})
+        self.assertEqual(basenames, [])
+        self.assertEqual(md_from, self.base + 50)
+
+    def test_after(self):
+        after = self.changes[3].changeid
+        (basenames, md_from, md_until) = self.change_list(after=after)
+        self.assertEqual(basenames, [self.uri(5), self.uri(6)])
+        self.assertEqual(md_from, self.base + 4)
+        (basenames, md_from, md_until) = self.change_list(
+            after=self.changes[0].changeid,
+            until=datetime_to_str(self.base + 3))
+        self.assertEqual(basenames, [self.uri(2), self.uri(3)])
+
+    def test_invalid_arguments(self):
+        for (name, value) in [('from', "yesterday"), ('until', "2013-13-01"),
+                              ('after', "x")]:
+            with tornado.testing.ExpectLog('tornado.access', "400 GET"):
+                with tornado.testing.ExpectLog('tornado.general',
+                                               "400 GET .*: Invalid %s" %
+                                               name):
+                    response = self.fetch("/changelist.xml?%s=%s" %
+                                          (name, value))
+            self.assertEqual(response.code, 400)
+
+
+class TestChangeListHandler(HandlerTestCase):
+
+    def test_md_until_during_batch(self):
+        self.source._update_resource("1")
+        change_lists = []
+
+        def event(number):
+            self.source._create_resource()
+            if number == 2:
+                # the changes of the open batch aren't delivered yet
+                change_lists.append(self.sitemap("/changelist.xml"))
+        self.source._apply_batch(event, range(5))
+        change_list = change_lists[0]
+        self.assertEqual([loc for (loc, md) in change_list.entries],
+                         [self.uri(1)])
+        change_list = self.sitemap("/changelist.xml",
+                                   **{'from': change_list.md_until})
+        self.assertEqual([loc for (loc, md) in change_list.entries
+                          if md['change'] == "created"],
+                         [self.uri(basename) for basename in range(21, 26)])
+        resource_list = self.sitemap("/resourcelist.xml")
+        self.assertTrue(resource_list.md_at <= change_list.md_until)
+
+
+class TestChangeListArchivePageHandler(HandlerTestCase):
+
+    def test_not_modified(self):
+        for basename in range(1, 8):
+            self.source._update_resource(str(basename))
+        response = self.fetch("/changelist-00001.xml")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Cache-Control'], "public, no-cache")
+        etag = response.headers['Etag']
+        response = self.fetch("/changelist-00001.xml",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        response = self.fetch("/changelist-00002.xml",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+        with tornado.testing.ExpectLog('tornado.access', "404 GET"):
+            self.assertEqual(self.fetch("/changelist-00003.xml").code, 404)
+        # the first page of a later run has other validators
+        archive = ChangeListArchiver(self.source.changememory, 3)
+        for change in self.source.changememory.changes[:3]:
+            later = Resource(resource=change)
+            later.changeid = change.changeid
+            later.timestamp += 60
+            archive.add(later)
+        self.assertNotEqual(archive.page_validators(1)[0], etag)
+
+
+class TestDumpPackageHandler(HandlerTestCase):
+
+    def test_resource_dump_package(self):
+        response = self.fetch("/resourcedump-00001.zip")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], "application/zip")
+        response = self.fetch("/resourcedump-00001.zip",
+                              headers={'If-None-Match':
+                                       response.headers['Etag']})
+        self.assertEqual(response.code, 304)
+        with tornado.testing.ExpectLog('tornado.access', "404 GET"):
+            self.assertEqual(self.fetch("/resourcedump-00004.zip").code, 404)
+
+    def test_change_dump_package(self):
+        for basename in range(1, 8):
+            self.source._update_resource(str(basename))
+        builder = self.source.change_dump_builder
+        generated = []
+        generate_package = builder.generate_package
+        builder.generate_package = lambda number: (
+            generated.append(number) or generate_package(number))
+        response = self.fetch("/changedump-00001.zip")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Cache-Control'], "public, no-cache")
+        etag = response.headers['Etag']
+        self.assertEqual(etag, builder.package_validators(1)[0])
+        # answered without generating the package
+        response = self.fetch("/changedump-00001.zip",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(generated, [1])
+        response = self.fetch("/changedump-00002.zip",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+        with tornado.testing.ExpectLog('tornado.access', "404 GET"):
+            self.assertEqual(self.fetch("/changedump-00003.zip").code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+
+import tornado.web
+import tornado.ioloop
+import tornado.testing
+
+from simulator.source import Source, DynamicResourceListBuilder
+from simulator.changememory import DynamicChangeList
+from simulator.http import HTTPInterface
+from simulator.loadgen import LoadGenerator, Sitemap, Stats, percentile
+
+
+class TestLoadGeneratorParts(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 90), 7)
+        self.assertEqual(percentile([], 90), None)
+
+    def test_sitemap(self):
+        sitemap = Sitemap.parse(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" '
+            'xmlns:rs="http://www.openarchives.org/rs/terms/">'
+            '<rs:md capability="changelist" from="2013-01-01T00:00:00Z" '
+            'until="2013-01-02T00:00:00Z" />'
+            '<url><loc>http://example.org/resources/1</loc>'
+            '<rs:md change="created" /></url>'
+            '<url><loc>http://example.org/resources/2</loc>'
+            '<rs:md change="deleted" /></url></urlset>')
+        self.assertFalse(sitemap.is_index)
+        self.assertEqual(sitemap.capability, "changelist")
+        self.assertEqual(sitemap.md_until, "2013-01-02T00:00:00Z")
+        self.assertEqual(sitemap.entries,
+                         [("http://example.org/resources/1",
+                           {'change': "created"}),
+                          ("http://example.org/resources/2",
+                           {'change': "deleted"})])
+        index = Sitemap.parse(
+            '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            '<sitemap><loc>http://example.org/rl-1.xml</loc></sitemap>'
+            '</sitemapindex>')
+        self.assertTrue(index.is_index)
+        self.assertEqual(index.entries, [("http://example.org/rl-1.xml", {})])
+
+    def test_stats(self):
+        stats = Stats()
+        stats.record('resource', 0.1, 200, 100)
+        stats.record('resource', 0.3, 404, 0)
+        stats.record('resource', 0.2, 599, 0)
+        summary = stats.summary(elapsed=2.0)['endpoints']['resource']
+        self.assertEqual(summary['requests'], 3)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['codes'], {'200': 1, '404': 1, '599': 1})
+        self.assertEqual(summary['requests_per_second'], 1.5)
+        self.assertEqual(summary['p50_seconds'], 0.2)
+        self.assertEqual(summary['max_seconds'], 0.3)
+        self.assertTrue("resource" in stats.report(elapsed=2.0))
+
+    def test_pattern(self):
+        self.assertRaises(ValueError, LoadGenerator, "http://localhost",
+                          pattern='random')
+
+
+class TestLoadGenerator(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 20
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['max_events'] = -1
+        base_uri = "http://127.0.0.1:%d" % self.get_http_port()
+        self.source = Source(config, base_uri, self.get_http_port())
+        self.source.add_resource_list_builder(DynamicResourceListBuilder(
+            self.source, {'class': "DynamicResourceListBuilder",
+                          'uri_path': "resourcelist.xml"}))
+        self.source.add_changememory(DynamicChangeList(
+            self.source, {'class': "DynamicChangeList",
+                          'uri_path': "changelist.xml",
+                          'max_changes': 1000}))
+        self.source.bootstrap()
+        http_interface = HTTPInterface(self.source)
+        return tornado.web.Application(handlers=http_interface.handlers,
+                                       **http_interface.settings)
+
+    def change(self):
+        self.source._create_resource()
+        self.source._update_resource("1")
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_full(self):
+        callback = tornado.ioloop.PeriodicCallback(self.change, 50)
+        callback.start()
+        generator = LoadGenerator(self.get_url(""), destinations=3,
+                                  duration=1.0, poll_interval=0.2,
+                                  parallel=2)
+        try:
+            stats = yield generator.run()
+        finally:
+            callback.stop()
+        summary = stats.summary()
+        endpoints = summary['endpoints']
+        for endpoint in ('description', 'capabilitylist', 'resourcelist'):
+            self.assertEqual(endpoints[endpoint]['requests'], 3)
+            self.assertEqual(endpoints[endpoint]['codes'], {'200': 3})
+        self.assertTrue(endpoints['changelist']['requests'] >= 3)
+        self.assertEqual(endpoints['changelist']['errors'], 0)
+        # all 20 resources of each baseline, then the changed ones
+        self.assertTrue(endpoints['resource']['codes']['200'] > 60)
+        self.assertEqual(summary['syncs']['baseline'], 3)
+        self.assertTrue(summary['syncs']['incremental'] >= 3)
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_baseline(self):
+        generator = LoadGenerator(self.get_url(""), destinations=2,
+                                  duration=0.5, pattern='baseline',
+                                  poll_interval=0.1, max_fetch=5)
+        stats = yield generator.run()
+        summary = stats.summary()
+        self.assertTrue('changelist' not in summary['endpoints'])
+        self.assertTrue(summary['syncs']['baseline'] > 2)
+        # at most 5 resources per sync, and a sync may be cut short
+        requests = summary['endpoints']['resource']['requests']
+        self.assertTrue(5 * summary['syncs']['baseline'] <= requests <
+                        5 * (summary['syncs']['baseline'] + 2))
+
+if __name__ == '__main__':
+    unittest.main()
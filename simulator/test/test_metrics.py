@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import unittest
+
+import tornado.web
+import tornado.testing
+
+from simulator.source import Source, DynamicResourceListBuilder
+from simulator.changememory import DynamicChangeList
+from simulator.http import HTTPInterface
+from simulator.repository import SharedArrayRepository
+from simulator.metrics import Histogram, Metrics, RATE_WINDOW
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.as_dict(),
+                         {'count': 4, 'sum': 2.65,
+                          'buckets': [['0.1', 2], ['1.0', 3], ['+Inf', 4]]})
+
+    def test_event_rates(self):
+        metrics = Metrics()
+        for i in range(30):
+            metrics.count_event('created')
+        metrics.count_event('deleted')
+        self.assertEqual(metrics.events,
+                         {'created': 30, 'updated': 0, 'deleted': 1})
+        # events of the current second aren't included yet
+        seconds = metrics.event_counts.seconds
+        slot = max(range(len(seconds)), key=lambda slot: seconds[slot])
+        second = seconds[slot]
+        seconds[slot] = second - 1
+        rates = metrics.event_rates()
+        self.assertEqual(rates['created'], 30.0 / RATE_WINDOW)
+        self.assertEqual(rates['deleted'], 1.0 / RATE_WINDOW)
+        seconds[slot] = second - RATE_WINDOW - 1
+        self.assertEqual(metrics.event_rates()['created'], 0.0)
+
+    def test_shared_events(self):
+        config = {'number_of_resources': 10, 'average_payload': 100}
+        source = Source(config, "http://localhost:8888", "8888")
+        source.add_repository(SharedArrayRepository(source))
+        source.bootstrap()
+        # events counted by the simulating process are seen by workers
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                source._update_resource("1")
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(source.metrics.events['updated'], 1)
+        self.assertEqual(sum(source.metrics.event_counts.recent[slot][1]
+                             for slot in range(RATE_WINDOW + 1)), 1)
+
+
+class TestMetricsHandler(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 100
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['max_events'] = -1
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.source.add_resource_list_builder(DynamicResourceListBuilder(
+            self.source, {'class': "DynamicResourceListBuilder",
+                          'uri_path': "resourcelist.xml"}))
+        self.source.add_changememory(DynamicChangeList(
+            self.source, {'class': "DynamicChangeList",
+                          'uri_path': "changelist.xml",
+                          'max_changes': 1000}))
+        self.source.bootstrap()
+        http_interface = HTTPInterface(self.source)
+        return tornado.web.Application(handlers=http_interface.handlers,
+                                       **http_interface.settings)
+
+    def test_prometheus(self):
+        self.source._create_resource()
+        self.source._update_resource("1")
+        self.assertEqual(self.fetch("/resourcelist.xml").code, 200)
+        self.assertEqual(self.fetch("/changelist.xml").code, 200)
+        with tornado.testing.ExpectLog('tornado.access', "404 GET"):
+            self.assertEqual(self.fetch("/resources/100000").code, 404)
+        response = self.fetch("/metrics")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            "text/plain"))
+        lines = response.body.splitlines()
+        for line in (
+                'simulator_http_requests_total'
+                '{code="200",handler="ResourceListHandler"} 1',
+                'simulator_http_requests_total'
+                '{code="404",handler="ResourceHandler"} 1',
+                'simulator_http_request_duration_seconds_count'
+                '{handler="DynamicChangeListHandler"} 1',
+                'simulator_document_generation_seconds_count'
+                '{document="ResourceListHandler"} 1',
+                'simulator_events_total{type="created"} 1',
+                'simulator_events_total{type="updated"} 1',
+                'simulator_resources 101',
+                'simulator_changememory_changes 2',
+                'simulator_changememory_max_changes 1000',
+                '# TYPE simulator_http_request_duration_seconds histogram'):
+            self.assertTrue(line in lines, line)
+        self.assertTrue(any(line.startswith("simulator_resident_memory_bytes")
+                            for line in lines))
+
+    def test_json(self):
+        self.fetch("/capabilitylist.xml")
+        metrics = json.loads(self.fetch("/metrics?format=json").body)
+        self.assertEqual(metrics['resources'], 100)
+        self.assertEqual(metrics['requests'],
+                         [{'handler': "CapabilityListHandler", 'code': 200,
+                           'count': 1}])
+        histogram = metrics['request_latency']['CapabilityListHandler']
+        self.assertEqual(histogram['count'], 1)
+        self.assertEqual(histogram['buckets'][-1], ['+Inf', 1])
+        self.assertTrue(metrics['rss_bytes'] > 0)
+        self.assertTrue(metrics['start_time'] <= time.time())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import time
+import threading
+import unittest
+
+from simulator.observer import Observer, Observable, AsyncDispatcher
+from simulator.resource import Resource
+
+
+class RecordingObserver(Observer):
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def notify_batch(self, events):
+        self.release.wait()
+        self.batches.append(list(events))
+
+    @property
+    def events(self):
+        return [event for batch in self.batches for event in batch]
+
+
+class TestAsyncDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.observable = Observable()
+        self.observer = RecordingObserver()
+        self.observable.register_observer(self.observer)
+
+    def tearDown(self):
+        self.observer.release.set()
+        self.dispatcher.stop()
+
+    def dispatch(self, **config):
+        self.dispatcher = AsyncDispatcher(self.observable, config)
+        self.observable.set_dispatcher(self.dispatcher)
+
+    def wait_until_taken(self, timeout=2.0):
+        """Waits for the worker to take all queued changes"""
+        deadline = time.time() + timeout
+        while self.dispatcher.depth > 0:
+            if time.time() > deadline:
+                self.fail("The worker didn't take the queued changes")
+            time.sleep(0.001)
+
+    def change(self, basename, change="updated"):
+        return Resource(uri="http://localhost/resources/%s" % basename,
+                        change=change)
+
+    def test_batches(self):
+        self.dispatch(batch_size=3)
+        self.observer.release.clear()
+        for i in range(7):
+            self.observable.notify_observers(self.change(i))
+        self.observer.release.set()
+        self.assertTrue(self.dispatcher.join(5))
+        self.assertEqual([c.uri[-1] for c in self.observer.events],
+                         [str(i) for i in range(7)])
+        self.assertTrue(max([len(b) for b in self.observer.batches]) <= 3)
+        self.assertEqual(self.dispatcher.stats['delivered'], 7)
+        self.assertEqual(self.dispatcher.depth, 0)
+
+    def test_drop(self):
+        self.dispatch(policy='drop', max_queue=2, batch_size=1)
+        self.observer.release.clear()
+        self.observable.notify_observers(self.change(0))
+        self.wait_until_taken()
+        self.observable.notify_observers_batch(
+            [self.change(i) for i in range(1, 5)])
+        self.assertEqual(self.dispatcher.dropped, 2)
+        self.assertEqual(self.dispatcher.max_depth, 2)
+        self.observer.release.set()
+        self.dispatcher.join(5)
+        self.assertEqual(len(self.observer.events), 3)
+
+    def test_coalesce(self):
+        self.dispatch(policy='coalesce', batch_size=100)
+        self.observer.release.clear()
+        self.observable.notify_observers(self.change("x"))
+        self.wait_until_taken()
+        self.observable.notify_observers_batch([
+            self.change(1, "created"), self.change(2), self.change(1),
+            self.change(3, "created"), self.change(3, "deleted"),
+            self.change(2, "deleted")])
+        self.assertEqual(self.dispatcher.coalesced, 3)
+        self.observer.release.set()
+        self.dispatcher.join(5)
+        self.assertEqual([(c.uri[-1], c.change) for c in self.observer.events],
+                         [("x", "updated"), ("1", "created"),
+                          ("2", "deleted")])
+
+    def test_block(self):
+        self.dispatch(policy='block', max_queue=1, batch_size=1)
+        self.observer.release.clear()
+        producer = threading.Thread(target=self.observable.notify_observers_batch,
+                                    args=([self.change(i) for i in range(3)],))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())  # blocked on the full queue
+        self.observer.release.set()
+        producer.join(5)
+        self.dispatcher.join(5)
+        self.assertEqual(len(self.observer.events), 3)
+
+if __name__ == '__main__':
+    unittest.main()
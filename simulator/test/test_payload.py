@@ -0,0 +1,48 @@
+import unittest
+
+from simulator.payload import PayloadEngine, byte_range
+
+
+class TestPayloadEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = PayloadEngine(chunk_size=10)
+
+    def payload(self, basename, length, start=0, stop=None):
+        return "".join([chunk.tobytes() for chunk in
+                        self.engine.chunks(basename, length, start, stop)])
+
+    def test_payload(self):
+        self.assertEqual(self.engine.payload("12", 5), "1212x")
+        self.assertEqual(self.engine.payload("123", 0), "")
+        self.assertEqual(self.payload(u"12", 5), "1212x")
+        self.assertEqual(self.payload(u"12", 25), "12" * 12 + "x")
+
+    def test_chunks(self):
+        for length in (0, 5, 10, 11, 29, 100):
+            expected = self.engine.payload("123", length)
+            self.assertEqual(self.payload("123", length), expected)
+            for (start, stop) in ((0, 1), (4, 17), (8, 9), (length - 1, 200)):
+                self.assertEqual(self.payload("123", length, start, stop),
+                                 expected[max(start, 0):stop])
+        for chunk in self.engine.chunks("123", 100):
+            self.assertTrue(len(chunk) <= 10)
+
+
+class TestByteRange(unittest.TestCase):
+
+    def test_byte_range(self):
+        self.assertEqual(byte_range(None, 100), None)
+        self.assertEqual(byte_range("bytes=0-9", 100), (0, 10))
+        self.assertEqual(byte_range("bytes=90-", 100), (90, 100))
+        self.assertEqual(byte_range("bytes=90-200", 100), (90, 100))
+        self.assertEqual(byte_range("bytes=-10", 100), (90, 100))
+        self.assertEqual(byte_range("bytes=-200", 100), (0, 100))
+        self.assertEqual(byte_range("bytes=0-1,5-6", 100), None)
+        self.assertEqual(byte_range("bytes=5-1", 100), None)
+        self.assertEqual(byte_range("items=0-1", 100), None)
+        self.assertRaises(ValueError, byte_range, "bytes=100-", 100)
+        self.assertRaises(ValueError, byte_range, "bytes=-0", 100)
+
+if __name__ == '__main__':
+    unittest.main()
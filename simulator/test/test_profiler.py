@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tornado.web
+import tornado.testing
+
+from simulator.profiler import Profiler
+from simulator.http import ProfileHandler
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=busy, args=(self.stop,),
+                                       name="busy")
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def profile(self, profiler, seconds=0.2):
+        profiler.start()
+        time.sleep(seconds)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+
+    def test_collapsed(self):
+        profiler = Profiler(interval=0.001)
+        self.profile(profiler)
+        self.assertTrue(profiler.sample_count > 0)
+        lines = profiler.collapsed().splitlines()
+        busy_lines = [line for line in lines if line.startswith("busy;")]
+        self.assertTrue(busy_lines)
+        for line in lines:
+            (stack, count) = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
+            self.assertFalse(stack.startswith("profiler;"))
+        self.assertTrue(any("busy (test_profiler.py:" in line
+                            for line in busy_lines))
+
+    def test_pstats(self):
+        profiler = Profiler(interval=0.001)
+        self.profile(profiler)
+        path = os.path.join(self.tmpdir, "profile.pstats")
+        profiler.save(path)
+        stats = pstats.Stats(path)
+        functions = dict(((name, count) for ((filename, line, name),
+                                             (count, calls, tottime, cumtime,
+                                              callers))
+                          in stats.stats.items()))
+        self.assertTrue(0 < functions['busy'] <= profiler.sample_count)
+        self.assertTrue("busy" in profiler.report())
+
+    def test_save_collapsed(self):
+        profiler = Profiler(interval=0.001)
+        self.profile(profiler, 0.05)
+        path = os.path.join(self.tmpdir, "profile.collapsed")
+        profiler.save(path)
+        with open(path) as collapsed:
+            self.assertEqual(collapsed.read(), profiler.collapsed())
+
+    def test_start_twice(self):
+        profiler = Profiler()
+        profiler.start()
+        try:
+            self.assertRaises(ValueError, profiler.start)
+        finally:
+            profiler.stop()
+
+    def test_seconds(self):
+        profiler = Profiler(interval=0.001)
+        path = os.path.join(self.tmpdir, "profile.collapsed")
+        profiler.start(seconds=0.05, path=path)
+        profiler._thread.join(5)
+        self.assertFalse(profiler.running)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(profiler.stopped >= profiler.started)
+
+
+class TestProfileHandler(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.profiler = Profiler(interval=0.001)
+        return tornado.web.Application(
+            handlers=[(r"/admin/profile", ProfileHandler,
+                       dict(profiler=self.profiler))])
+
+    def tearDown(self):
+        self.profiler.stop()
+        super(TestProfileHandler, self).tearDown()
+
+    def test_profile(self):
+        response = self.fetch("/admin/profile?seconds=60", method="POST",
+                              body="")
+        self.assertEqual(response.code, 202)
+        self.assertTrue(json.loads(response.body)['running'])
+        with tornado.testing.ExpectLog('tornado.general', "409 POST"), \
+                tornado.testing.ExpectLog('tornado.access', "409 POST"):
+            response = self.fetch("/admin/profile", method="POST", body="")
+        self.assertEqual(response.code, 409)
+        time.sleep(0.05)
+        response = self.fetch("/admin/profile", method="DELETE")
+        status = json.loads(response.body)
+        self.assertFalse(status['running'])
+        self.assertTrue(status['samples'] > 0)
+        response = self.fetch("/admin/profile?format=collapsed")
+        self.assertEqual(response.body, self.profiler.collapsed())
+        response = self.fetch("/admin/profile?format=pstats")
+        self.assertEqual(response.code, 200)
+        self.assertTrue("cumulative time" in
+                        self.fetch("/admin/profile?format=text").body)
+        with tornado.testing.ExpectLog('tornado.general', "400 GET"), \
+                tornado.testing.ExpectLog('tornado.access', "400 GET"):
+            response = self.fetch("/admin/profile?format=svg")
+        self.assertEqual(response.code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
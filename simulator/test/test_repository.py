@@ -0,0 +1,284 @@
+import os
+import unittest
+import random
+
+from simulator.repository import DictRepository, ArrayRepository, \
+    SharedArrayRepository
+from simulator.source import Source
+
+
+class TestArrayRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = ArrayRepository(config={'initial_capacity': 4})
+
+    def record(self, length=10):
+        return {'timestamp': 1234.5, 'length': length,
+                'md5': "Q2hlY2sgSW50ZWdyaXR5IQ==", 'sha256': None}
+
+    def test_set_and_get(self):
+        self.repository["7"] = self.record(length=42)
+        self.assertEqual(len(self.repository), 1)
+        self.assertTrue("7" in self.repository)
+        self.assertFalse("6" in self.repository)
+        self.assertFalse("abc" in self.repository)
+        self.assertFalse(-10 in self.repository)
+        self.assertEqual(self.repository["7"], self.record(length=42))
+        self.assertTrue(self.repository.capacity >= 8)
+
+    def test_overwrite(self):
+        self.repository["1"] = self.record(length=1)
+        self.repository["1"] = self.record(length=2)
+        self.assertEqual(len(self.repository), 1)
+        self.assertEqual(self.repository["1"]['length'], 2)
+
+    def test_delete(self):
+        self.repository["1"] = self.record()
+        self.repository["2"] = self.record()
+        del self.repository["1"]
+        self.assertEqual(len(self.repository), 1)
+        self.assertEqual(self.repository.keys(), ["2"])
+        self.assertRaises(KeyError, self.repository.__getitem__, "1")
+        self.assertRaises(KeyError, self.repository.__delitem__, "1")
+
+    def test_random_keys(self):
+        for i in range(10):
+            self.repository[str(i)] = self.record()
+        del self.repository["3"]
+        del self.repository["9"]
+        self.repository["20"] = self.record()
+        self.assertEqual(sorted(self.repository.slots),
+                         [0, 1, 2, 4, 5, 6, 7, 8, 20])
+        keys = self.repository.random_keys(100)
+        self.assertEqual(sorted(keys), sorted(self.repository.keys()))
+        self.assertTrue(self.repository.random_key() in self.repository)
+        for key in self.repository.keys():
+            del self.repository[key]
+        self.assertEqual(self.repository.random_key(), None)
+        self.assertEqual(self.repository.random_keys(5), [])
+
+    def test_invalid_basename(self):
+        self.assertRaises(KeyError, self.repository.__setitem__, "a1",
+                          self.record())
+
+    def test_size(self):
+        for i in range(100):
+            self.repository[str(i)] = self.record()
+        self.assertTrue(self.repository.bytes_per_resource < 64)
+        dict_repository = DictRepository()
+        for i in range(100):
+            dict_repository[str(i)] = self.record()
+        self.assertTrue(dict_repository.bytes_per_resource >
+                        self.repository.bytes_per_resource)
+
+
+class TestDictRepository(unittest.TestCase):
+
+    def test_random_keys(self):
+        repository = DictRepository()
+        for i in range(10):
+            repository[str(i)] = {}
+        repository["1"] = {'length': 1}
+        del repository["0"]
+        del repository["9"]
+        self.assertEqual(sorted(repository._basenames),
+                         sorted(repository.keys()))
+        self.assertEqual(sorted(repository.random_keys(100)),
+                         sorted(repository.keys()))
+        self.assertEqual(len(repository.random_keys(3)), 3)
+        self.assertTrue(repository.random_key() in repository)
+
+    def test_dict_methods(self):
+        repository = DictRepository()
+        repository.update({"1": {'length': 1}, "2": {'length': 2}},
+                          **{"3": {'length': 3}})
+        self.assertEqual(repository.setdefault("4", {'length': 4}),
+                         {'length': 4})
+        self.assertEqual(repository.setdefault("4", {}), {'length': 4})
+        self.assertEqual(repository.pop("2"), {'length': 2})
+        self.assertEqual(repository.pop("2", None), None)
+        self.assertRaises(KeyError, repository.pop, "2")
+        (basename, record) = repository.popitem()
+        self.assertEqual(record, {'length': int(basename)})
+        self.assertEqual(sorted(repository._basenames),
+                         sorted(repository.keys()))
+        self.assertEqual(sorted(repository._positions.keys()),
+                         sorted(repository.keys()))
+        self.assertEqual(len(repository), 2)
+        with repository.snapshot() as snapshot:
+            repository.clear()
+            self.assertEqual(len(snapshot), 2)
+        self.assertEqual(len(repository), 0)
+        self.assertEqual(repository._basenames, [])
+        self.assertEqual(repository._positions, {})
+        self.assertEqual(repository.random_key(), None)
+        self.assertRaises(KeyError, repository.popitem)
+
+
+class SnapshotTests(object):
+    """Snapshot tests for all repository implementations"""
+
+    def record(self, length=10):
+        return {'timestamp': 1234.5, 'length': length,
+                'md5': "Q2hlY2sgSW50ZWdyaXR5IQ==", 'sha256': None}
+
+    def setUp(self):
+        self.repository = self.repository_class()
+        for i in range(10):
+            self.repository[str(i)] = self.record(length=i)
+
+    def test_snapshot(self):
+        snapshot = self.repository.snapshot()
+        self.repository["3"] = self.record(length=33)
+        self.repository["3"] = self.record(length=333)
+        del self.repository["5"]
+        self.repository["10"] = self.record()
+        self.assertEqual(len(snapshot), 10)
+        records = dict(snapshot)
+        self.assertEqual(sorted(records.keys()),
+                         sorted(str(i) for i in range(10)))
+        self.assertEqual(records["3"]['length'], 3)
+        self.assertEqual(records["5"]['length'], 5)
+        self.assertEqual(snapshot.get("10"), None)
+        self.assertEqual(self.repository["3"]['length'], 333)
+        self.assertFalse("5" in self.repository)
+
+    def test_release(self):
+        snapshot = self.repository.snapshot()
+        self.assertEqual(self.repository.open_snapshots, 1)
+        snapshot.close()
+        self.assertEqual(self.repository.open_snapshots, 0)
+        self.repository["3"] = self.record(length=33)
+        self.assertEqual(snapshot._saved, {})
+        with self.repository.snapshot():
+            self.assertEqual(self.repository.open_snapshots, 1)
+        self.assertEqual(self.repository.open_snapshots, 0)
+        snapshot = self.repository.snapshot()
+        del snapshot  # released when garbage collected
+        self.repository["3"] = self.record(length=34)
+        self.assertEqual(self.repository.open_snapshots, 0)
+        self.assertEqual(self.repository._snapshots, [])
+
+    def test_version(self):
+        version = self.repository.version
+        self.repository["3"] = self.record()
+        del self.repository["3"]
+        self.assertEqual(self.repository.snapshot().version, version + 2)
+
+
+class TestDictRepositorySnapshots(SnapshotTests, unittest.TestCase):
+    repository_class = DictRepository
+
+
+class TestArrayRepositorySnapshots(SnapshotTests, unittest.TestCase):
+    repository_class = ArrayRepository
+
+
+class TestSharedArrayRepositorySnapshots(SnapshotTests, unittest.TestCase):
+    repository_class = SharedArrayRepository
+
+
+class TestSharedArrayRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = SharedArrayRepository(config={'capacity': 16})
+
+    def record(self, length=10):
+        return {'timestamp': 1234.5, 'length': length,
+                'md5': "Q2hlY2sgSW50ZWdyaXR5IQ==", 'sha256': None}
+
+    def test_set_and_delete(self):
+        for i in range(10):
+            self.repository[str(i)] = self.record(length=i)
+        del self.repository["3"]
+        self.repository["7"] = self.record(length=77)
+        self.assertEqual(len(self.repository), 9)
+        self.assertEqual(self.repository["7"], self.record(length=77))
+        self.assertEqual(sorted(self.repository.random_keys(100)),
+                         sorted(self.repository.keys()))
+        self.assertTrue(self.repository.random_key() in self.repository)
+        self.assertRaises(ValueError, self.repository.__setitem__, "16",
+                          self.record())
+
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.repository["5"] = self.record(length=5)
+                self.repository.state.version = 42
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.repository["5"], self.record(length=5))
+        self.assertEqual(self.repository.keys(), ["5"])
+        self.assertEqual(self.repository.state.version, 42)
+
+    def test_source_state(self):
+        config = {'number_of_resources': 10, 'average_payload': 100}
+        source = Source(config, "http://localhost:8888", "8888")
+        source.add_repository(SharedArrayRepository(source))
+        self.assertEqual(source._repository.capacity, 1024)
+        source.bootstrap()
+        self.assertEqual(source._repository.state.max_res_id, 11)
+        self.assertEqual(source._repository.state.version, source.version)
+
+    def test_simulate_past_capacity(self):
+        config = {'number_of_resources': 10, 'average_payload': 100,
+                  'event_types': ['create'], 'max_events': 1100,
+                  'events_per_second': 'max', 'stats_interval': 10000}
+        source = Source(config, "http://localhost:8888", "8888")
+        source.add_repository(SharedArrayRepository(source))
+        source.bootstrap()
+        source.simulate_changes()
+        self.assertEqual(source.no_events, 1100)
+        self.assertEqual(source.resource_count, 1024 - 1)
+        self.assertEqual(source.max_res_id, 1024)
+        self.assertFalse(source._create_resource())
+        del source._repository["5"]
+        self.assertFalse(source._create_resource())
+        self.assertEqual(source.resource_count, 1024 - 2)
+
+
+class TestSourceWithArrayRepository(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 1000
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 1000
+        config['fixity'] = ['md5', 'sha-256']
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.source.add_repository(ArrayRepository(self.source))
+        self.source.bootstrap()
+
+    def test_resources(self):
+        self.assertEqual(self.source.resource_count, 1000)
+        resources = [resource for resource in self.source.resources]
+        self.assertEqual(len(resources), 1000)
+
+    def test_resource(self):
+        rand_basename = random.choice(self.source._repository.keys())
+        resource = self.source.resource(rand_basename)
+        self.assertEqual(resource.uri,
+            "http://localhost:8888/resources/%s" % rand_basename)
+        self.assertEqual(len(self.source.resource_payload(rand_basename)),
+                         resource.length)
+        self.assertTrue(resource.md5 is not None)
+        self.assertTrue(resource.sha256 is not None)
+        self.assertTrue(self.source.resource(-10) is None)
+
+    def test_random_resources(self):
+        self.assertEqual(len(self.source.random_resources(17)), 17)
+
+    def test_changes(self):
+        rand_basename = self.source.random_resource.basename
+        self.source._update_resource(rand_basename)
+        self.source._delete_resource(rand_basename)
+        self.source._create_resource()
+        self.assertEqual(self.source.resource_count, 1000)
+
+if __name__ == '__main__':
+    unittest.main()
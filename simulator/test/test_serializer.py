@@ -0,0 +1,138 @@
+import random
+import unittest
+
+from resync.resource_list import ResourceList
+from resync.change_list import ChangeList
+from resync.list_base_with_index import ListBaseIndexError
+from resync.w3c_datetime import datetime_to_str
+
+from simulator.resource import Resource
+from simulator.source import Source, DynamicResourceListBuilder
+from simulator.repository import ArrayRepository
+from simulator.serializer import sitemap_chunks, sitemap_entry, \
+    sitemap_xml, resource_entry, lastmod
+
+
+class TestSerializer(unittest.TestCase):
+
+    def resources(self, number=25):
+        for i in range(number):
+            yield Resource(uri="http://localhost:8888/resources/%d" % i,
+                           timestamp=1234567890.5 + i, length=i,
+                           md5="Q2hlY2sgSW50ZWdyaXR5IQ==")
+
+    def resource_list(self, number=25):
+        resource_list = ResourceList(resources=self.resources(number),
+                                     count=number)
+        resource_list.describedby = "http://localhost:8888"
+        resource_list.up = "http://localhost:8888/capabilitylist.xml"
+        resource_list.md_from = "2013-01-01T00:00:00Z"
+        return resource_list
+
+    def test_resource_list_chunks(self):
+        chunks = list(sitemap_chunks(self.resource_list(), chunk_size=10))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual("".join(chunks), self.resource_list().as_xml())
+
+    def test_empty_resource_list(self):
+        chunks = list(sitemap_chunks(self.resource_list(0)))
+        self.assertEqual("".join(chunks), self.resource_list(0).as_xml())
+
+    def test_change_list(self):
+        change_list = ChangeList()
+        change_list.md_from = "2013-01-01T00:00:00Z"
+        for resource in self.resources(5):
+            change_list.add(Resource(resource=resource, change="updated"))
+        xml = "".join(sitemap_chunks(change_list, chunk_size=2))
+        self.assertEqual(xml, change_list.as_xml())
+        self.assertEqual(sitemap_xml(change_list), change_list.as_xml())
+
+    def test_lastmod(self):
+        generator = random.Random(42)
+        timestamps = [0.0, 1.0, 1.9999994, 1.9999996, 1234567890.0000005,
+                      1234567890.9999995, 1381052096.123456, -1.25]
+        timestamps += [generator.uniform(0, 2e9) for i in range(10000)]
+        timestamps += [int(generator.uniform(0, 2e9)) +
+                       generator.randint(0, 999999) / 1e6
+                       for i in range(10000)]
+        for timestamp in timestamps:
+            self.assertEqual(lastmod(timestamp), datetime_to_str(timestamp))
+
+    def test_resource_entry(self):
+        resources = [
+            Resource(uri="http://localhost:8888/resources/1"),
+            Resource(uri="http://localhost:8888/resources/2",
+                     timestamp=1234567890.25, length=0, md5="a+b/c==",
+                     sha256="d=", change="deleted"),
+            Resource(uri="http://localhost:8888/resources/3",
+                     timestamp=1234567890, sha256="d="),
+            Resource(uri="http://localhost:8888/resources?a=1&b=<2>",
+                     length=long(10), md5='"&\n'),
+            Resource(resource=Resource(uri="http://localhost:8888/4",
+                                       length=4), change="created"),
+            Resource(uri="http://localhost:8888/5", path="/tmp/5"),
+            Resource(uri="http://localhost:8888/6", capability="changelist",
+                     md_from="2013-01-01T00:00:00Z"),
+            Resource(uri=u"http://localhost:8888/r\xe9source", length=7)]
+        resources[1].link_add(rel='duplicate', href="http://example.org/2")
+        for resource in resources:
+            self.assertEqual(resource_entry(resource),
+                             sitemap_entry(resource))
+
+    def test_too_many_entries(self):
+        change_list = ChangeList()
+        change_list.max_sitemap_entries = 3
+        for resource in self.resources(4):
+            change_list.add(Resource(resource=resource, change="updated"))
+        self.assertRaises(ListBaseIndexError, sitemap_xml, change_list)
+
+
+class TestRecordSerializer(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 500
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['fixity'] = ['md5', 'sha-256']
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.source.add_repository(ArrayRepository(self.source, {}))
+        self.builder = DynamicResourceListBuilder(
+            self.source, {'uri_path': "resourcelist.xml"})
+        self.source.add_resource_list_builder(self.builder)
+        self.source.bootstrap()
+        self.source._update_resource("5")
+        self.source._delete_resource("6")
+
+    def generate(self):
+        """The records and the resources of the same snapshot"""
+        (resource_list, records) = self.builder.generate_records()
+        records = list(records)
+        expected = ResourceList(resources=[self.source._resource(*item)
+                                           for item in records])
+        for document in (resource_list, expected):
+            document.md_at = "2013-01-01T00:00:00Z"
+            document.describedby = "http://localhost:8888/about"
+        return (resource_list, records, expected)
+
+    def test_as_xml(self):
+        (resource_list, records, expected) = self.generate()
+        self.assertEqual(len(records), 499)
+        self.assertEqual(self.source.serializer.as_xml(resource_list, records),
+                         expected.as_xml())
+
+    def test_chunks(self):
+        (resource_list, records, expected) = self.generate()
+        chunks = list(self.source.serializer.chunks(resource_list, records,
+                                                    chunk_size=100))
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual("".join(chunks), expected.as_xml())
+
+    def test_entry(self):
+        record = self.source._repository["7"]
+        self.assertEqual(self.source.serializer.entry("7", record),
+                         sitemap_entry(self.source.resource("7")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from resync.utils import compute_md5_for_string
+
+from simulator.source import Source, compute_sha256_for_string
+from simulator.changememory import DynamicChangeList
+from simulator.repository import DictRepository, ArrayRepository, \
+    SharedArrayRepository
+
+
+class SnapshotFileTests(object):
+    """Save and restore tests for all repository implementations"""
+
+    def make_source(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 100
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['max_events'] = -1
+        source = Source(config, "http://localhost:8888", "8888")
+        source.fixity = ['md5', 'sha-256']
+        source.add_repository(self.repository_class(source, {}))
+        source.add_changememory(DynamicChangeList(
+            source, {'uri_path': "changelist.xml", 'max_changes': 100}))
+        return source
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "source.snapshot")
+        self.source = self.make_source()
+        self.source.bootstrap()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_bootstrap(self):
+        self.assertEqual(self.source.resource_count, 100)
+        self.assertEqual(self.source.version, 100)
+        self.assertEqual(self.source.max_res_id, 101)
+        for resource in self.source.resources:
+            payload = self.source.resource_payload(resource.basename)
+            self.assertEqual(resource.length, len(payload))
+            self.assertEqual(resource.md5, compute_md5_for_string(payload))
+            self.assertEqual(resource.sha256,
+                             compute_sha256_for_string(payload))
+
+    def test_save_restore(self):
+        self.source._update_resource("7")
+        self.source._delete_resource("8")
+        self.source._create_resource()
+        self.source.save(self.path)
+        restored = self.make_source()
+        restored.restore(self.path)
+        self.assertEqual(restored.resource_count, 100)
+        self.assertEqual(restored.version, self.source.version)
+        self.assertEqual(restored.last_modified, self.source.last_modified)
+        self.assertEqual(restored.max_res_id, self.source.max_res_id)
+        self.assertEqual(
+            [(r.uri, r.timestamp, r.length, r.md5, r.sha256)
+             for r in restored.resources],
+            [(r.uri, r.timestamp, r.length, r.md5, r.sha256)
+             for r in self.source.resources])
+        self.assertEqual(
+            [(c.changeid, c.uri, c.change)
+             for c in restored.changememory.changes],
+            [(c.changeid, c.uri, c.change)
+             for c in self.source.changememory.changes])
+        # the restored source goes on where the saved one stopped
+        restored._create_resource()
+        self.assertEqual(restored.changememory.changes[-1].changeid, 4)
+        self.assertTrue(restored.resource(str(self.source.max_res_id))
+                        is not None)
+
+    def test_restore_errors(self):
+        self.source.save(self.path)
+        self.assertRaises(ValueError, self.source.restore, self.path)
+        restored = self.make_source()
+        restored.fixity = ['md5']
+        self.assertRaises(ValueError, restored.restore, self.path)
+        for (name, value) in (('number_of_resources', 99),
+                              ('average_payload', 1000)):
+            restored = self.make_source()
+            restored.config[name] = value
+            self.assertRaises(ValueError, restored.restore, self.path)
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write(b"not a snapshot")
+        self.assertRaises(ValueError, self.make_source().restore, self.path)
+
+
+class TestDictRepositorySnapshotFile(SnapshotFileTests, unittest.TestCase):
+    repository_class = DictRepository
+
+
+class TestArrayRepositorySnapshotFile(SnapshotFileTests, unittest.TestCase):
+    repository_class = ArrayRepository
+
+
+class TestSharedArrayRepositorySnapshotFile(SnapshotFileTests,
+                                            unittest.TestCase):
+    repository_class = SharedArrayRepository
+
+if __name__ == '__main__':
+    unittest.main()
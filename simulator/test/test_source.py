@@ -1,8 +1,21 @@
 import unittest
 import random
+import time
+
+import tornado.ioloop
+
+from resync.utils import compute_md5_for_string
 
 from simulator.resource import Resource
-from simulator.source import Source
+from resync.resource_list import ResourceList
+from resync.w3c_datetime import str_to_datetime
+
+from simulator.source import Source, DynamicResourceListBuilder, \
+    IncrementalResourceListBuilder, IOLoopSimulation, \
+    compute_sha256_for_string, poisson
+from simulator.changememory import DynamicChangeList
+from simulator.observer import AsyncDispatcher
+from simulator.serializer import sitemap_entry
 
 class TestSource(unittest.TestCase):
 
@@ -34,6 +47,33 @@ class TestSource(unittest.TestCase):
     def test_resources(self):
         resources = [resource for resource in self.source.resources]
         self.assertEqual(len(resources), 1000)
+
+    def test_resource_list_snapshot(self):
+        builder = DynamicResourceListBuilder(self.source,
+                                             {'uri_path': "resourcelist.xml"})
+        then = time.time()
+        resource_list = builder.generate()
+        basename = self.source.random_resource.basename
+        self.source._delete_resource(basename)
+        self.source._create_resource()
+        md_at = str_to_datetime(resource_list.md_at)
+        self.assertTrue(then <= md_at < self.source.last_modified)
+        uris = [resource.uri for resource in resource_list]
+        self.assertEqual(len(uris), 1000)
+        self.assertTrue(self.source.base_uri + "/resources/" + basename in uris)
+        self.assertEqual(self.source._repository.open_snapshots, 0)
+
+    def test_version(self):
+        version = self.source.version
+        self.assertEqual(version, 1000)
+        rand_basename = self.source.random_resource.basename
+        self.source._update_resource(rand_basename)
+        self.assertTrue(self.source.version > version)
+        version = self.source.version
+        self.source._delete_resource(rand_basename)
+        self.assertEqual(self.source.version, version + 1)
+        self.assertTrue(self.source.last_modified >=
+                        self.source._repository.values()[0]['timestamp'])
     
     def test_resource(self):
         # Fetch a random basename from the source repository
@@ -53,6 +93,26 @@ class TestSource(unittest.TestCase):
         resource = self.source.resource(-10)
         self.assertTrue(resource is None)
     
+    def test_resource_fixity(self):
+        rand_basename = random.choice(self.source._repository.keys())
+        payload = self.source.resource_payload(rand_basename)
+        resource = self.source.resource(rand_basename)
+        self.assertEqual(resource.md5, compute_md5_for_string(payload))
+        self.assertTrue(resource.sha256 is None)
+        # Fixity is updated together with the payload
+        self.source._update_resource(rand_basename)
+        payload = self.source.resource_payload(rand_basename)
+        resource = self.source.resource(rand_basename)
+        self.assertEqual(resource.md5, compute_md5_for_string(payload))
+
+    def test_resource_fixity_sha256(self):
+        self.source.fixity = ['md5', 'sha-256']
+        self.source._create_resource(basename="1177")
+        payload = self.source.resource_payload("1177")
+        resource = self.source.resource("1177")
+        self.assertEqual(resource.md5, compute_md5_for_string(payload))
+        self.assertEqual(resource.sha256, compute_sha256_for_string(payload))
+
     def test_resource_payload(self):
         # Fetch a random basename from the source repository
         rand_basename = random.choice(self.source._repository.keys())        
@@ -82,5 +142,185 @@ class TestSource(unittest.TestCase):
         self.source._update_resource(basename=rand_basename)
         self.assertEqual(self.source.resource_count, len_before)
 
+    def test_simulate_max_throughput(self):
+        changememory = DynamicChangeList(self.source, {'uri_path': "changes",
+                                                       'max_changes': 1000})
+        self.source.add_changememory(changememory)
+        self.source.config['events_per_second'] = 'max'
+        self.source.config['max_events'] = 250
+        self.source.config['batch_size'] = 100
+        self.source.config['stats_interval'] = 100
+        version = self.source.version
+        self.assertTrue(self.source.simulate_changes() > 0)
+        self.assertEqual(self.source.no_events, 250)
+        self.assertEqual(changememory.last_changeid, changememory.change_count)
+        self.assertTrue(self.source.version > version)
+
+    def test_simulate_with_dispatcher(self):
+        changememory = DynamicChangeList(self.source, {'uri_path': "changes",
+                                                       'max_changes': None})
+        self.source.add_changememory(changememory)
+        dispatcher = AsyncDispatcher(self.source, {'batch_size': 50})
+        self.source.set_dispatcher(dispatcher)
+        self.source.config['events_per_second'] = 'max'
+        self.source.config['max_events'] = 200
+        self.source.config['batch_size'] = 30
+        self.source.config['stats_interval'] = 100
+        version = self.source.version
+        self.source.simulate_changes()
+        dispatcher.stop()
+        self.assertEqual(dispatcher.depth, 0)
+        self.assertEqual(dispatcher.delivered, changememory.change_count)
+        self.assertTrue(changememory.change_count > 0)
+        self.assertTrue(self.source.version > version)
+
+    def test_simulate_rate(self):
+        for arrival in ('poisson', 'uniform', 'burst'):
+            self.source.no_events = 0
+            self.source.config['events_per_second'] = 5000
+            self.source.config['tick'] = 0.01
+            self.source.config['arrival'] = arrival
+            self.source.config['burst_size'] = 10
+            self.source.config['max_events'] = 100
+            self.source.config['stats_interval'] = 100
+            self.source.simulate_changes()
+            self.assertEqual(self.source.no_events, 100)
+
+    def run_on_ioloop(self, config):
+        """Runs an IOLoopSimulation until it finished; returns the number
+        of other callbacks that ran meanwhile"""
+        self.source.no_events = 0
+        self.source.config['stats_interval'] = 1000
+        self.source.config.update(config)
+        ioloop = tornado.ioloop.IOLoop()
+        ioloop.make_current()
+        interleaved = []
+        ticker = tornado.ioloop.PeriodicCallback(
+            lambda: interleaved.append(1), 1)
+        ticker.start()
+        simulation = IOLoopSimulation(self.source)
+        simulation.start(on_finished=ioloop.stop)
+        timeout = ioloop.call_later(10, ioloop.stop)
+        try:
+            ioloop.start()
+        finally:
+            ioloop.remove_timeout(timeout)
+            ticker.stop()
+            ioloop.clear_current()
+            ioloop.close()
+        self.assertFalse(simulation.running)
+        return len(interleaved)
+
+    def test_simulate_on_ioloop(self):
+        self.run_on_ioloop({'events_per_second': 'max', 'max_events': 250,
+                            'batch_size': 50})
+        self.assertEqual(self.source.no_events, 250)
+        self.run_on_ioloop({'events_per_second': 20000, 'tick': 0.01,
+                            'arrival': 'uniform', 'max_events': 400,
+                            'batch_size': 50})
+        self.assertEqual(self.source.no_events, 400)
+        interleaved = self.run_on_ioloop({'events_per_second': None,
+                                          'change_delay': 0.002,
+                                          'max_events': 20})
+        self.assertEqual(self.source.no_events, 20)
+        self.assertTrue(interleaved > 0)
+
+    def test_simulate_on_ioloop_with_dispatcher(self):
+        changememory = DynamicChangeList(self.source, {'uri_path': "changes",
+                                                       'max_changes': None})
+        self.source.add_changememory(changememory)
+        dispatcher = AsyncDispatcher(self.source, {'batch_size': 50})
+        self.source.set_dispatcher(dispatcher)
+        self.run_on_ioloop({'events_per_second': 'max', 'max_events': 200,
+                            'batch_size': 30})
+        self.assertEqual(dispatcher.depth, 0)
+        self.assertEqual(dispatcher.delivered, changememory.change_count)
+        dispatcher.stop()
+
+    def test_poisson(self):
+        self.assertEqual(poisson(0), 0)
+        for expected in (3, 1000):
+            mean = sum([poisson(expected) for i in range(2000)]) / 2000.0
+            self.assertTrue(abs(mean - expected) < expected * 0.1)
+
+
+class TestPagedResourceListBuilder(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 250
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.builder = DynamicResourceListBuilder(self.source,
+            {'uri_path': "resourcelist.xml", 'page_size': 100})
+        self.source.add_resource_list_builder(self.builder)
+        self.source.bootstrap()
+
+    def test_pages(self):
+        self.assertEqual(self.builder.page_count, 3)
+        self.assertEqual(self.builder.page_path(2), "resourcelist-00002.xml")
+        self.assertEqual(self.builder.page_number("99"), 1)
+        self.assertEqual(self.builder.page_number("100"), 2)
+        basenames = [r.basename for r in self.builder.page_resources(1)]
+        self.assertEqual(basenames, [str(i) for i in range(1, 100)])
+        self.assertTrue(self.builder.generate_page(4) is None)
+        self.assertTrue("resourcelist-00003.xml" in
+                        self.builder.generate_index())
+
+    def test_page_cache(self):
+        xml = self.builder.generate_page(2)
+        self.assertEqual(self.builder.generate_page(2), xml)
+        self.assertEqual(self.builder.cache_hits, 1)
+        # Changes on other pages keep the page cached
+        self.source._update_resource("5")
+        self.assertEqual(self.builder.generate_page(2), xml)
+        self.assertEqual(self.builder.cache_hits, 2)
+        self.source._delete_resource("150")
+        self.assertFalse("resources/150<" in self.builder.generate_page(2))
+        self.assertEqual(self.builder.cache_misses, 2)
+        # New resources open new pages
+        self.source._create_resource("300")
+        self.assertEqual(self.builder.page_count, 4)
+
+class TestIncrementalResourceListBuilder(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = 250
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        self.source = Source(config, "http://localhost:8888", "8888")
+        self.builder = IncrementalResourceListBuilder(self.source,
+            {'uri_path': "resourcelist.xml", 'bucket_size': 100})
+        self.source.add_resource_list_builder(self.builder)
+        self.source.bootstrap()
+
+    def entries(self):
+        """The <url> elements of the builder's resource list"""
+        xml = self.builder.generate_xml(ResourceList())
+        body = xml[xml.index("<url>"):xml.rindex("</urlset>")]
+        return sorted("<url>" + e for e in body.split("<url>")[1:])
+
+    def expected_entries(self):
+        return sorted(sitemap_entry(r) for r in self.source.resources)
+
+    def test_generate(self):
+        self.assertEqual(len(self.entries()), 250)
+        self.assertEqual(self.entries(), self.expected_entries())
+
+    def test_changes(self):
+        self.entries()
+        unchanged_bucket = self.builder._bucket_xml[2]
+        self.source._update_resource("5")
+        self.source._delete_resource("150")
+        self.assertEqual(self.entries(), self.expected_entries())
+        # Only the changed buckets are joined again
+        self.assertTrue(self.builder._bucket_xml[2] is unchanged_bucket)
+        self.source._create_resource()
+        self.assertEqual(self.entries(), self.expected_entries())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,105 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from simulator.source import Source
+from simulator.resource import Resource
+from simulator.changememory import DynamicChangeList
+from simulator.trace import TraceWriter, TraceReader
+
+
+class TestTrace(unittest.TestCase):
+
+    def make_source(self, seed=42, number_of_resources=100):
+        config = {}
+        config['name'] = "ResourceSync Simulator"
+        config['number_of_resources'] = number_of_resources
+        config['event_types'] = ['create', 'update', 'delete']
+        config['average_payload'] = 100
+        config['max_events'] = 500
+        config['stats_interval'] = 1000
+        config['events_per_second'] = 'max'
+        config['seed'] = seed
+        source = Source(config, "http://localhost:8888", "8888")
+        source.add_changememory(DynamicChangeList(
+            source, {'uri_path': "changelist.xml", 'max_changes': 1000}))
+        source.bootstrap()
+        return source
+
+    def state(self, source):
+        return sorted((resource.uri, resource.length, resource.md5)
+                      for resource in source.resources)
+
+    def changes(self, source):
+        return [(change.uri, change.change, change.length)
+                for change in source.changememory.changes]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "events.trace")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_seed(self):
+        first = self.make_source()
+        second = self.make_source()
+        self.assertEqual(self.state(first), self.state(second))
+        first.simulate_changes()
+        second.simulate_changes()
+        self.assertEqual(self.changes(first), self.changes(second))
+        self.assertEqual(self.state(first), self.state(second))
+        other = self.make_source(seed=43)
+        self.assertNotEqual(self.state(first), self.state(other))
+
+    def test_record_replay(self):
+        recorded = self.make_source()
+        recorded.record_trace(self.path)
+        recorded.simulate_changes()
+        recorded.stop_trace()
+        self.assertEqual(TraceReader(self.path).header['seed'], 42)
+        self.assertEqual(len(list(TraceReader(self.path))),
+                         len(recorded.changememory.changes))
+        replayed = self.make_source()
+        replayed.replay_trace(self.path, 'max')
+        self.assertEqual(replayed._skipped_events, 0)
+        self.assertEqual(self.changes(replayed), self.changes(recorded))
+        self.assertEqual(self.state(replayed), self.state(recorded))
+        self.assertEqual(replayed.max_res_id, recorded.max_res_id)
+        # events of missing resources are skipped
+        other = self.make_source(seed=43, number_of_resources=10)
+        other.replay_trace(self.path, 'max')
+        self.assertTrue(other._skipped_events > 0)
+
+    def test_replay_timing(self):
+        writer = TraceWriter(self.path)
+        for (offset, basename) in ((0.0, "1000"), (0.2, "1001")):
+            writer.write(Resource(uri="http://localhost:8888/resources/" +
+                                  basename, timestamp=writer.start + offset,
+                                  length=10, change="created"))
+        writer.close()
+        source = self.make_source()
+        then = time.time()
+        source.replay_trace(self.path, speed=2)
+        self.assertTrue(0.1 <= time.time() - then < 0.5)
+        self.assertEqual(source.resource("1001").length, 10)
+        self.assertEqual(source.max_res_id, 1002)
+
+    def test_truncated_trace(self):
+        source = self.make_source()
+        source.record_trace(self.path)
+        source.simulate_changes()
+        source.stop_trace()
+        events = list(TraceReader(self.path, block_size=7))
+        self.assertEqual(len(events), 500)
+        with open(self.path, 'ab') as trace:
+            trace.write(b"\0" * 5)
+        self.assertEqual(list(TraceReader(self.path, block_size=7)), events)
+        with open(self.path, 'wb') as trace:
+            trace.write(b"no trace\n")
+        self.assertRaises(ValueError, TraceReader, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+trace.py: Recording and replaying the change events of a simulation.
+
+A trace file starts with a magic line and a JSON header line describing the
+recorded simulation (seed, number of resources, start time). Each change
+event follows as a fixed-size binary record: the seconds since the start of
+the recording (double), the change type (byte), the integer basename and
+the payload length (unsigned ints), i.e. 17 bytes per event.
+
+Replaying a trace against a source bootstrapped the same way (with the same
+seed or from the same snapshot file) reproduces the recorded workload.
+"""
+
+import json
+import time
+import struct
+
+MAGIC = b"ResourceSync Simulator trace 1\n"
+EVENT = struct.Struct('<dBII')
+CHANGES = ('created', 'updated', 'deleted')  # indexed by the change type
+
+
+class TraceWriter(object):
+    """Appends change events to a trace file"""
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.start = time.time()
+        self.count = 0
+        self._types = dict((change, i) for (i, change) in enumerate(CHANGES))
+        self._file = open(path, 'wb')
+        header = dict(header or {}, start=self.start)
+        self._file.write(MAGIC + json.dumps(header) + b"\n")
+
+    def write(self, change):
+        """Records a change (a Resource with change, timestamp and length)"""
+        self._file.write(EVENT.pack(change.timestamp - self.start,
+                                    self._types[change.change],
+                                    int(change.basename),
+                                    change.length or 0))
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+
+class TraceReader(object):
+    """Iterates the events of a trace file as (offset, change, basename,
+    length) tuples; offset is the number of seconds since the start of the
+    recording"""
+
+    def __init__(self, path, block_size=4096):
+        self.path = path
+        self.block_size = block_size  # events read at once
+        self._file = open(path, 'rb')
+        if self._file.readline() != MAGIC:
+            self._file.close()
+            raise ValueError("%s is not a trace file" % path)
+        self.header = json.loads(self._file.readline())
+
+    def __iter__(self):
+        size = EVENT.size
+        unpack_from = EVENT.unpack_from
+        while True:
+            data = self._file.read(size * self.block_size)
+            # a partial record at the end was cut off while recording
+            for position in xrange(0, len(data) - size + 1, size):
+                (offset, change, basename, length) = unpack_from(data,
+                                                                 position)
+                yield (offset, CHANGES[change], str(basename), length)
+            if len(data) < size * self.block_size:
+                return
+
+    def close(self):
+        self._file.close()